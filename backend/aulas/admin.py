@@ -1,8 +1,20 @@
 from django.contrib import admin
-from aulas.models import Aula
+from django.db import transaction
+from aulas.cache import invalidar_aulas_fins
+from aulas.models import Aula, HashAulasSala
 
 
 class AulaAdmin(admin.ModelAdmin):
     list_display = ('disciplina', 'professor', 'sala', 'inicio', 'fim')
 
+    def delete_queryset(self, request, queryset):
+        # A exclusão em massa não passa por Aula.delete()
+        fins = list(queryset.values_list('fim', flat=True).distinct())
+        super().delete_queryset(request, queryset)
+        transaction.on_commit(lambda: invalidar_aulas_fins(fins))
+
+class HashAulasSalaAdmin(admin.ModelAdmin):
+    list_display = ('sala', 'inicio', 'fim', 'atualizado')
+
 admin.site.register(Aula, AulaAdmin)
+admin.site.register(HashAulasSala, HashAulasSalaAdmin)
@@ -1,16 +1,23 @@
 from .serializers import AulaSerializer
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.utils.timezone import now, localtime
 from datetime import timedelta
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
+from aulas.cache import AULAS_DIA_TIMEOUT, chave_aulas_dia
 from aulas.models import Aula
 from root.models import Sala
+from root.utils import filtro_dias
+import hashlib
 
 
 class AulasViewSet(ModelViewSet):
-    queryset = Aula.objects.all()
+    # O serializer expõe campos da sala em todas as aulas
+    queryset = Aula.objects.select_related('sala')
     serializer_class = AulaSerializer
     permission_classes = []
 
@@ -41,38 +48,54 @@ class AulasViewSet(ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
 
-        aulas = Aula.objects.filter(
-            sala=sala,
-            inicio__date__gte=inicio,
-            inicio__date__lte=fim,
-        )
+        try:
+            aulas = self.get_queryset().filter(
+                sala=sala,
+                **filtro_dias('inicio', inicio, fim),
+            )
+        except ValueError:
+            return Response(
+                {"detail": "Datas devem estar no formato AAAA-MM-DD."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         serializer = self.get_serializer(aulas, many=True)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
-    @action(detail=False, methods=['get'], url_path='hoje')
-    def get_for_today(self, request, *args, **kwargs):
-        fim = localtime(now())
+    def _aulas_do_dia(self, request, dia):
+        """
+        Lista as aulas do dia a partir do cache, respondendo 304 se o
+        cliente já tiver a versão atual (If-None-Match).
+        """
+        chave = chave_aulas_dia(dia)
+        cached = cache.get(chave)
+
+        if cached is None:
+            aulas = self.get_queryset().filter(
+                **filtro_dias('fim', dia),
+            )
+            data = list(self.get_serializer(aulas, many=True).data)
+            etag = hashlib.md5(JSONRenderer().render(data)).hexdigest()
+            cached = {'etag': f'"{etag}"', 'data': data}
+            cache.set(chave, cached, AULAS_DIA_TIMEOUT)
 
-        aulas = Aula.objects.filter(
-            fim__date=fim.date(),
-        )
+        response = get_conditional_response(request, etag=cached['etag'])
+        if response is None:
+            response = Response(cached['data'], status=status.HTTP_200_OK)
 
-        serializer = self.get_serializer(aulas, many=True)
+        response['ETag'] = cached['etag']
+        patch_cache_control(response, no_cache=True)
+        return response
 
-        return Response(serializer.data, status=status.HTTP_200_OK)
+    @action(detail=False, methods=['get'], url_path='hoje')
+    def get_for_today(self, request, *args, **kwargs):
+        return self._aulas_do_dia(request, localtime(now()).date())
 
     @action(detail=False, methods=['get'], url_path='amanha')
     def get_for_tomorrow(self, request, *args, **kwargs):
         tomorrow = localtime(now()).date() + timedelta(days=1)
+        return self._aulas_do_dia(request, tomorrow)
 
-        aulas = Aula.objects.filter(
-            fim__date=tomorrow,
-        )
-
-        serializer = self.get_serializer(aulas, many=True)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
     @action(detail=False, methods=['get'], url_path='data')
     def get_for_date(self, request, *args, **kwargs):
         date_str = request.query_params.get('date')
@@ -82,9 +105,15 @@ class AulasViewSet(ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        aulas = Aula.objects.filter(
-            inicio__date=date_str,
-        )
+        try:
+            aulas = self.get_queryset().filter(
+                **filtro_dias('inicio', date_str),
+            )
+        except ValueError:
+            return Response(
+                {"detail": "Data deve estar no formato AAAA-MM-DD."},
+                status=status.HTTP_400_BAD_REQUEST
+            )
 
         serializer = self.get_serializer(aulas, many=True)
 
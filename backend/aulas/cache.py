@@ -0,0 +1,19 @@
+from django.core.cache import cache
+from django.utils.timezone import localtime
+
+# Tempo máximo que a lista de aulas de um dia fica em cache. A sincronização
+# com o CPD e as escritas em Aula invalidam as entradas antes disso.
+AULAS_DIA_TIMEOUT = 60 * 15
+
+
+def chave_aulas_dia(dia):
+    return f"aulas:dia:{dia.isoformat()}"
+
+
+def invalidar_aulas_dias(dias):
+    cache.delete_many([chave_aulas_dia(dia) for dia in dias])
+
+
+def invalidar_aulas_fins(fins):
+    """ Invalida os dias (locais) em que terminam as aulas com esses `fins` """
+    invalidar_aulas_dias({localtime(fim).date() for fim in fins if fim is not None})
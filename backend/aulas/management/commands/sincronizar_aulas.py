@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from aulas.tasks import sync_last_year_aulas_task, update_aulas_task
+
+
+class Command(BaseCommand):
+    help = "Sincroniza as aulas com o CPD"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help="Reconcilia todas as salas, mesmo as sem alterações no CPD",
+        )
+        parser.add_argument(
+            '--ultimo-ano',
+            action='store_true',
+            help="Sincroniza o último ano (backfill) em vez do restante do ano",
+        )
+
+    def handle(self, *args, **options):
+        if options['ultimo_ano']:
+            resultado = sync_last_year_aulas_task(force=options['force'])
+        else:
+            resultado = update_aulas_task(force=options['force'])
+        self.stdout.write(self.style.SUCCESS(resultado))
@@ -1,4 +1,5 @@
-from django.db import models
+from aulas.cache import invalidar_aulas_fins
+from django.db import models, transaction
 from root.models import Sala
 
 class Aula(models.Model):
@@ -8,6 +9,21 @@ class Aula(models.Model):
     professor = models.CharField(max_length = 100, default="")
     disciplina = models.CharField(max_length = 100, default="")
 
+    # As listas de aulas por dia em cache (hoje/amanhã) são agrupadas por
+    # "fim"; os dias do valor anterior e do novo são invalidados
+    def save(self, *args, **kwargs):
+        fins = [self.fim]
+        if self.pk is not None:
+            fins += Aula.objects.filter(pk=self.pk).values_list('fim', flat=True)
+        super().save(*args, **kwargs)
+        transaction.on_commit(lambda: invalidar_aulas_fins(fins))
+
+    def delete(self, *args, **kwargs):
+        fins = [self.fim]
+        resultado = super().delete(*args, **kwargs)
+        transaction.on_commit(lambda: invalidar_aulas_fins(fins))
+        return resultado
+
     class Meta:
         ordering = ['inicio']
         constraints = [
@@ -15,3 +31,27 @@ class Aula(models.Model):
                 fields=["inicio", "fim", "sala"], name="unique_aula"
             )
         ]
+        # Buscas por dia usam intervalos em "inicio" (coberto pelo índice de
+        # unique_aula) ou em "fim"; o calendário filtra também pela sala
+        indexes = [
+            models.Index(fields=["sala", "inicio"], name="aula_sala_inicio_idx"),
+            models.Index(fields=["fim"], name="aula_fim_idx"),
+        ]
+
+
+class HashAulasSala(models.Model):
+    """ Hash da resposta normalizada do CPD para uma sala em um período """
+    sala = models.ForeignKey(Sala, on_delete=models.CASCADE)
+    inicio = models.DateField()
+    fim = models.DateField()
+    hash = models.CharField(max_length=64)
+    atualizado = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name = 'Hash de aulas da sala'
+        verbose_name_plural = 'Hashes de aulas das salas'
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sala", "inicio", "fim"], name="unique_hash_aulas_sala"
+            )
+        ]
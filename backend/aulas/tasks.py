@@ -1,16 +1,18 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from django.conf import settings
-from django.db import IntegrityError
-from django.db.models import Q
+from django.db import transaction
 from django.utils.timezone import localtime, make_aware, now
-from aulas.models import Aula
-from aulas.api.serializers import AulaSerializer
+from aulas.cache import invalidar_aulas_dias
+from aulas.models import Aula, HashAulasSala
 from root.models import Sala
-from zoneinfo import ZoneInfo
+from root.utils import filtro_dias
+import hashlib
 import json
 import httpx
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -37,125 +39,296 @@ ROOM_ID_TO_NAME = {
     "3005": "215",
 }
 
-def _perform_aulas_sync(inicio_total, fim_total, should_delete_missing=False):
-    def title_split(titulo):
-        if '/' in titulo:
-            return titulo.split('/')
-        return titulo.split('-')
+# Busca no CPD: um único cliente HTTP (keep-alive) compartilhado entre as
+# threads, com timeout por requisição e retentativas com backoff exponencial.
+CPD_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+CPD_MAX_CONCURRENCY = 6
+CPD_MAX_TENTATIVAS = 3
+CPD_BACKOFF = 0.5
 
-    url = settings.URL_CPD
-    salas = Sala.objects.values_list('codigo', flat=True)
-    data_atual = now()
+# Tamanho dos lotes de bulk_create/bulk_update na reconciliação
+AULAS_BATCH_SIZE = 500
+
+
+def _fetch_aulas_sala(client, url, sala, inicio_total, fim_total):
+    """ Busca as aulas de uma sala no CPD, com retentativas """
+    data = {
+        "espaco": sala,
+        "inicio": inicio_total,
+        "fim": fim_total,
+        "apenasDeferidos": True,
+    }
 
-    for sala in salas:
-        chaves_api = []
-        data = {
-            "espaco": sala,
-            "inicio": inicio_total,
-            "fim": fim_total,
-            "apenasDeferidos": True,
+    for tentativa in range(1, CPD_MAX_TENTATIVAS + 1):
+        try:
+            response = client.post(url, json=data)
+            response.raise_for_status()
+            return json.loads(response.text)
+        except (httpx.TransportError, httpx.HTTPStatusError) as e:
+            # Erros do cliente (4xx) não melhoram com retentativas
+            retentavel = (
+                not isinstance(e, httpx.HTTPStatusError)
+                or e.response.status_code >= 500
+            )
+            if not retentavel or tentativa == CPD_MAX_TENTATIVAS:
+                raise
+            espera = CPD_BACKOFF * 2 ** (tentativa - 1)
+            logger.warning(
+                f"Falha ao buscar aulas para sala {sala} "
+                f"(tentativa {tentativa}/{CPD_MAX_TENTATIVAS}): {e}. "
+                f"Nova tentativa em {espera:.1f} s."
+            )
+            time.sleep(espera)
+
+
+def _fetch_aulas_cpd(salas, inicio_total, fim_total):
+    """
+    Busca as aulas de todas as salas no CPD em paralelo.
+
+    Retorna um dicionário {codigo: resposta}. Salas cuja busca falhou
+    ficam de fora, para que a reconciliação não apague suas aulas.
+    """
+    url = settings.URL_CPD
+    limits = httpx.Limits(
+        max_connections=CPD_MAX_CONCURRENCY,
+        max_keepalive_connections=CPD_MAX_CONCURRENCY,
+    )
+    respostas = {}
+
+    with httpx.Client(timeout=CPD_TIMEOUT, limits=limits) as client, \
+            ThreadPoolExecutor(max_workers=CPD_MAX_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(
+                _fetch_aulas_sala, client, url, sala, inicio_total, fim_total
+            ): sala
+            for sala in salas
         }
+        for future in as_completed(futures):
+            sala = futures[future]
+            try:
+                respostas[sala] = future.result()
+            except Exception as e:
+                logger.error(f"Erro ao buscar aulas para sala {sala}: {e}")
 
+    return respostas
+
+
+def _title_split(titulo):
+    if '/' in titulo:
+        return titulo.split('/')
+    return titulo.split('-')
+
+
+def _parse_aulas_cpd(response):
+    """
+    Normaliza a resposta do CPD em {(inicio, fim): (professor, disciplina)}.
+    """
+    aulas_api = {}
+    for aula in response:
         try:
-            response = json.loads(httpx.post(url, json=data).text)
-        except Exception as e:
-            logger.error(f"Erro ao buscar aulas para sala {sala}: {e}")
+            inicio = make_aware(datetime.strptime(aula['start'], "%Y-%m-%d %H:%M:%S"))
+            fim = make_aware(datetime.strptime(aula['end'], "%Y-%m-%d %H:%M:%S"))
+        except ValueError:
             continue
 
-        sala_object = Sala.objects.filter(codigo=sala).first()
-        if not sala_object:
-            continue
+        titulo_split = _title_split(aula['title'])
+        disciplina = titulo_split[1].strip()[:100] if len(titulo_split) > 1 else "Não informada"
+        professor = titulo_split[0].strip()[:100] if titulo_split[0] else "Desconhecido"
 
-        aulas_existentes = Aula.objects.filter(sala=sala_object).values(
-            "inicio", "fim", "sala"
-        )
+        aulas_api[(inicio, fim)] = (professor, disciplina)
+    return aulas_api
 
-        aulas_existentes_set = set(
-            (aula["inicio"], aula["fim"], aula["sala"]) for aula in aulas_existentes
-        )
 
-        for aula in response:
-            try:
-                inicio = make_aware(datetime.strptime(aula['start'], "%Y-%m-%d %H:%M:%S"))
-                fim = make_aware(datetime.strptime(aula['end'], "%Y-%m-%d %H:%M:%S"))
-            except ValueError:
-                continue
-
-            chave_aula = (inicio, fim, sala_object.id)
-            chaves_api.append(chave_aula)
-
-            titulo = aula['title']
-            titulo_split = title_split(titulo)
-            disciplina = titulo_split[1].strip()[:100] if len(titulo_split) > 1 else "Não informada"
-            professor = titulo_split[0].strip()[:100] if titulo_split[0] else "Desconhecido"
-
-            if chave_aula not in aulas_existentes_set:
-                nova_aula = {
-                    'inicio': inicio,
-                    'fim': fim,
-                    'sala': sala_object.pk,
-                    'professor': professor,
-                    'disciplina': disciplina
-                }
-                serializer = AulaSerializer(data=nova_aula)
-                try:
-                    serializer.is_valid(raise_exception=True)
-                    serializer.save()
-                except IntegrityError:
-                    pass
-            else:
-                Aula.objects.filter(inicio=inicio, fim=fim, sala=sala_object).update(
+def _hash_aulas(aulas_api):
+    """ Hash estável das aulas normalizadas de uma sala """
+    normalizadas = sorted(
+        (inicio.isoformat(), fim.isoformat(), professor, disciplina)
+        for (inicio, fim), (professor, disciplina) in aulas_api.items()
+    )
+    return hashlib.sha256(
+        json.dumps(normalizadas, ensure_ascii=False).encode()
+    ).hexdigest()
+
+
+def _janela_sync(inicio_total, fim_total):
+    """
+    Converte o período consultado no CPD (dd/mm/aaaa, inclusivo) no
+    intervalo local [inicio, fim).
+    """
+    inicio = make_aware(datetime.strptime(inicio_total, '%d/%m/%Y'))
+    fim = make_aware(datetime.strptime(fim_total, '%d/%m/%Y') + timedelta(days=1))
+    return inicio, fim
+
+
+def _reconcile_sala(sala_object, aulas_api, janela, limite_exclusao=None):
+    """
+    Aplica as aulas do CPD de uma sala no banco em uma única transação.
+
+    As chaves (inicio, fim) da API são comparadas em memória com as
+    existentes na janela consultada; aulas novas são inseridas com
+    bulk_create e apenas as que tiveram professor/disciplina alterados
+    são atualizadas com bulk_update. Se `limite_exclusao` for informado,
+    as aulas da janela a partir dele que sumiram do CPD são removidas.
+    """
+    contagem = Counter()
+
+    with transaction.atomic():
+        existentes = {
+            (aula.inicio, aula.fim): aula
+            for aula in Aula.objects.filter(
+                sala=sala_object,
+                inicio__gte=janela[0],
+                inicio__lt=janela[1],
+            ).only("id", "inicio", "fim", "professor", "disciplina")
+        }
+
+        novas = []
+        alteradas = []
+        for (inicio, fim), (professor, disciplina) in aulas_api.items():
+            aula = existentes.get((inicio, fim))
+            if aula is None:
+                novas.append(Aula(
+                    inicio=inicio,
+                    fim=fim,
+                    sala=sala_object,
                     professor=professor,
-                    disciplina=disciplina
-                )
-
-        if should_delete_missing:
-            sao_paulo_timezone = ZoneInfo("America/Sao_Paulo")
-            aulas_existentes_set_sp = [
-                (
-                    item[0].astimezone(sao_paulo_timezone),
-                    item[1].astimezone(sao_paulo_timezone),
-                    item[2],
-                )
-                for item in aulas_existentes_set
-            ]
+                    disciplina=disciplina,
+                ))
+            elif (aula.professor, aula.disciplina) != (professor, disciplina):
+                aula.professor = professor
+                aula.disciplina = disciplina
+                alteradas.append(aula)
+            else:
+                contagem['inalteradas'] += 1
 
-            # Só deletar se estiver no range pesquisado e for do presente/futuro
-            chaves_excluir = {
-                k for k in (set(aulas_existentes_set_sp) - set(chaves_api))
-                if k[0].date() >= data_atual.date()
-            }
-
-            if chaves_excluir:
-                Aula.objects.filter(
-                    Q(inicio__in=[k[0] for k in chaves_excluir]) &
-                    Q(fim__in=[k[1] for k in chaves_excluir]) &
-                    Q(sala__in=[k[2] for k in chaves_excluir])
+        Aula.objects.bulk_create(
+            novas, batch_size=AULAS_BATCH_SIZE, ignore_conflicts=True
+        )
+        Aula.objects.bulk_update(
+            alteradas, ["professor", "disciplina"], batch_size=AULAS_BATCH_SIZE
+        )
+        contagem['inseridas'] += len(novas)
+        contagem['atualizadas'] += len(alteradas)
+
+        if limite_exclusao is not None:
+            # Remove pela chave primária apenas as aulas que sumiram do CPD
+            ids_excluir = [
+                aula.pk for chave, aula in existentes.items()
+                if chave not in aulas_api and aula.inicio >= limite_exclusao
+            ]
+            for i in range(0, len(ids_excluir), AULAS_BATCH_SIZE):
+                removidas, _ = Aula.objects.filter(
+                    pk__in=ids_excluir[i:i + AULAS_BATCH_SIZE]
                 ).delete()
+                contagem['removidas'] += removidas
 
+    return contagem
+
+
+def _perform_aulas_sync(inicio_total, fim_total, should_delete_missing=False,
+                        force=False):
+    """
+    Sincroniza as aulas de todas as salas no período informado.
 
-def update_aulas_task():
+    Salas cuja resposta do CPD tem o mesmo hash da última sincronização do
+    mesmo período não são reconciliadas, a menos que `force` seja True.
+    """
+    salas = {}
+    for sala_object in Sala.objects.exclude(codigo__isnull=True):
+        salas.setdefault(sala_object.codigo, sala_object)
+
+    janela = _janela_sync(inicio_total, fim_total)
+    limite_exclusao = None
+    if should_delete_missing:
+        # Só deletar se estiver no range pesquisado e for do presente/futuro
+        inicio_hoje = localtime(now()).replace(hour=0, minute=0, second=0, microsecond=0)
+        limite_exclusao = max(janela[0], inicio_hoje)
+
+    inicio_fetch = time.monotonic()
+    respostas = _fetch_aulas_cpd(list(salas), inicio_total, fim_total)
+    logger.info(
+        f"Aulas de {len(respostas)}/{len(salas)} salas obtidas do CPD "
+        f"em {time.monotonic() - inicio_fetch:.2f} s."
+    )
+
+    periodo = {
+        'inicio': janela[0].date(),
+        'fim': janela[1].date() - timedelta(days=1),
+    }
+    hashes = dict(
+        HashAulasSala.objects.filter(**periodo).values_list('sala_id', 'hash')
+    )
+
+    contagem = Counter()
+    for sala, response in respostas.items():
+        sala_object = salas[sala]
+        aulas_api = _parse_aulas_cpd(response)
+        hash_aulas = _hash_aulas(aulas_api)
+
+        if not force and hashes.get(sala_object.id) == hash_aulas:
+            logger.debug(f"Sala {sala}: sem alterações no CPD.")
+            contagem['salas_ignoradas'] += 1
+            continue
+
+        contagem_sala = _reconcile_sala(
+            sala_object, aulas_api, janela, limite_exclusao
+        )
+        HashAulasSala.objects.update_or_create(
+            sala=sala_object, **periodo, defaults={'hash': hash_aulas}
+        )
+        logger.debug(f"Sala {sala}: {dict(contagem_sala)}")
+        contagem.update(contagem_sala)
+
+    resumo = (
+        f"{contagem['salas_ignoradas']} salas sem alterações, "
+        f"{contagem['inseridas']} inseridas, "
+        f"{contagem['atualizadas']} atualizadas, "
+        f"{contagem['removidas']} removidas, "
+        f"{contagem['inalteradas']} inalteradas"
+    )
+    logger.info(f"Sincronização de aulas concluída: {resumo}.")
+
+    # As listas de aulas de hoje e amanhã em cache podem ter mudado
+    hoje = localtime(now()).date()
+    invalidar_aulas_dias([hoje, hoje + timedelta(days=1)])
+
+    return resumo
+
+
+def update_aulas_task(force=False):
     data_atual = now()
     inicio_total = data_atual.strftime('%d/%m/%Y')
     fim_total = data_atual.strftime('31/12/%Y')
 
-    _perform_aulas_sync(inicio_total, fim_total, should_delete_missing=True)
+    resumo = _perform_aulas_sync(
+        inicio_total, fim_total, should_delete_missing=True, force=force
+    )
 
     # Limpeza de histórico antigo (> 1 ano / 365 dias)
     limite_historico = data_atual - timedelta(days=365)
     Aula.objects.filter(inicio__lt=limite_historico).delete()
 
+    # A janela começa hoje, então hashes de janelas que começaram antes (e
+    # de períodos que já terminaram, com fim >= inicio) não serão mais consultados
+    HashAulasSala.objects.filter(inicio__lt=data_atual.date()).delete()
 
-def sync_last_year_aulas_task():
+    return f"Aulas sincronizadas: {resumo}."
+
+
+def sync_last_year_aulas_task(force=False):
     data_atual = now()
     # De 1 ano atrás até hoje
     inicio_total = (data_atual - timedelta(days=365)).strftime('%d/%m/%Y')
     fim_total = data_atual.strftime('%d/%m/%Y')
 
     logger.info(f"Iniciando backfill de aulas de {inicio_total} até {fim_total}")
-    _perform_aulas_sync(inicio_total, fim_total, should_delete_missing=False)
+    resumo = _perform_aulas_sync(
+        inicio_total, fim_total, should_delete_missing=False, force=force
+    )
     logger.info("Backfill concluído.")
 
+    return f"Backfill de aulas: {resumo}."
+
 
 def escape_markdown_v2(text):
     """
@@ -181,7 +354,7 @@ def notify_aulas_task():
 
     tomorrow = localtime(now()).date() + timedelta(days=1)
 
-    aulas = Aula.objects.filter(inicio__date=tomorrow).order_by(
+    aulas = Aula.objects.filter(**filtro_dias('inicio', tomorrow)).order_by(
         'sala__andar', 'inicio', 'sala__codigo'
     ).select_related('sala')
 
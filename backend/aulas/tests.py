@@ -1,3 +1,344 @@
-from django.test import TestCase
+from datetime import timedelta
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import localtime, now
+from unittest import mock, skipUnless
+from aulas import tasks
+from aulas.models import Aula, HashAulasSala
+from root.models import Sala
+from root.utils import filtro_dias
+import httpx
+import io
+import json
+import logging
+import os
+import threading
+import time
 
-# Create your tests here.
+CACHE_LOCAL = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class ConsultasAulasTests(TestCase):
+    """ O número de consultas de cada listagem não depende de quantas aulas há """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.salas = [
+            Sala.objects.create(numero=str(100 + i), nome=f'Sala {i}', codigo=f'S{i}')
+            for i in range(3)
+        ]
+        cls.hoje = localtime(now()).replace(hour=8, minute=0, second=0, microsecond=0)
+        cls.amanha = cls.hoje + timedelta(days=1)
+
+    def setUp(self):
+        cache.clear()
+
+    def criar_aulas(self, quantidade):
+        """ `quantidade` aulas hoje e amanhã, distribuídas entre as salas """
+        existentes = Aula.objects.count()
+        aulas = []
+        for dia in (self.hoje, self.amanha):
+            for i in range(quantidade):
+                inicio = dia + timedelta(minutes=10 * (existentes + i))
+                aulas.append(Aula(
+                    inicio=inicio,
+                    fim=inicio + timedelta(minutes=50),
+                    sala=self.salas[i % len(self.salas)],
+                    disciplina=f'Disciplina {i}',
+                ))
+        Aula.objects.bulk_create(aulas)
+
+    def assertConsultasConstantes(self, url, consultas, **params):
+        for quantidade in (5, 25):
+            self.criar_aulas(quantidade)
+            cache.clear()
+            with self.assertNumQueries(consultas):
+                resposta = self.client.get(url, params)
+            self.assertEqual(resposta.status_code, 200)
+            self.assertTrue(resposta.json())
+
+    def test_lista(self):
+        self.assertConsultasConstantes('/api/aulas/aulas/', 1)
+
+    def test_hoje(self):
+        self.assertConsultasConstantes('/api/aulas/aulas/hoje/', 1)
+
+    def test_amanha(self):
+        self.assertConsultasConstantes('/api/aulas/aulas/amanha/', 1)
+
+    def test_hoje_em_cache(self):
+        self.criar_aulas(5)
+        self.client.get('/api/aulas/aulas/hoje/')
+        with self.assertNumQueries(0):
+            resposta = self.client.get('/api/aulas/aulas/hoje/')
+        self.assertEqual(resposta.status_code, 200)
+
+    def test_data(self):
+        self.assertConsultasConstantes(
+            '/api/aulas/aulas/data/', 1, date=self.hoje.date().isoformat()
+        )
+
+    def test_calendario(self):
+        self.assertConsultasConstantes(
+            '/api/aulas/aulas/calendario/', 2,
+            codigo=self.salas[0].codigo,
+            inicio=self.hoje.date().isoformat(),
+            fim=self.amanha.date().isoformat(),
+        )
+
+
+@skipUnless(connection.vendor == 'postgresql', "EXPLAIN depende do planejador do PostgreSQL")
+class IndicesAulasTests(TestCase):
+    """ As buscas por dia usam os índices de Aula em vez de varrer a tabela """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sala = Sala.objects.create(numero='101', nome='Sala', codigo='S1')
+        cls.hoje = localtime(now()).date()
+
+    def plano(self, queryset):
+        # Com poucas linhas o planejador prefere a varredura sequencial;
+        # desligá-la mostra se há um índice utilizável para a consulta
+        with connection.cursor() as cursor:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+        return queryset.explain()
+
+    def assertUsaIndice(self, queryset, indice):
+        plano = self.plano(queryset)
+        self.assertRegex(plano, rf'Index (Only )?Scan (using|on) {indice}\b')
+
+    def test_calendario_usa_sala_inicio(self):
+        aulas = Aula.objects.filter(sala=self.sala, **filtro_dias('inicio', self.hoje))
+        self.assertUsaIndice(aulas, 'aula_sala_inicio_idx')
+
+    def test_dia_por_fim_usa_fim(self):
+        aulas = Aula.objects.filter(**filtro_dias('fim', self.hoje))
+        self.assertUsaIndice(aulas, 'aula_fim_idx')
+
+
+class CpdFalso:
+    """
+    CPD simulado com httpx.MockTransport: `respostas` dá, para cada sala, a
+    lista de respostas das tentativas sucessivas (status, corpo ou exceção);
+    a última se repete. Conta as tentativas e as requisições simultâneas.
+    """
+
+    def __init__(self, respostas=None, latencia=0):
+        self.respostas = respostas or {}
+        self.latencia = latencia
+        self.tentativas = {}
+        self.simultaneas = self.maximo_simultaneas = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        sala = json.loads(request.content)['espaco']
+        with self.lock:
+            tentativa = self.tentativas[sala] = self.tentativas.get(sala, 0) + 1
+            self.simultaneas += 1
+            self.maximo_simultaneas = max(self.maximo_simultaneas, self.simultaneas)
+        try:
+            if self.latencia:
+                time.sleep(self.latencia)
+            sequencia = self.respostas.get(sala, [(200, [])])
+            resposta = sequencia[min(tentativa, len(sequencia)) - 1]
+            if isinstance(resposta, Exception):
+                raise resposta
+            status, corpo = resposta
+            return httpx.Response(status, json=corpo)
+        finally:
+            with self.lock:
+                self.simultaneas -= 1
+
+    def ativo(self):
+        cliente = httpx.Client
+        return mock.patch.object(
+            tasks.httpx, 'Client',
+            lambda **kwargs: cliente(transport=httpx.MockTransport(self), **kwargs),
+        )
+
+
+def aula_cpd(inicio, fim, titulo='Prof. Ana / Circuitos'):
+    return {'start': inicio, 'end': fim, 'title': titulo}
+
+
+@override_settings(URL_CPD='http://cpd.teste/aulas')
+class BuscaCpdTests(SimpleTestCase):
+
+    def setUp(self):
+        # Sem o log INFO de cada requisição do httpx
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def buscar(self, cpd, salas):
+        with cpd.ativo():
+            return tasks._fetch_aulas_cpd(salas, '01/03/2024', '31/12/2024')
+
+    def test_busca_em_paralelo_limitada(self):
+        cpd = CpdFalso(latencia=0.05)
+        salas = [str(i) for i in range(3 * tasks.CPD_MAX_CONCURRENCY)]
+        respostas = self.buscar(cpd, salas)
+        self.assertEqual(set(respostas), set(salas))
+        self.assertEqual(cpd.maximo_simultaneas, tasks.CPD_MAX_CONCURRENCY)
+
+    def test_retentativas_e_falha_de_uma_sala(self):
+        aula = aula_cpd('2024-03-04 08:30:00', '2024-03-04 10:20:00')
+        cpd = CpdFalso({
+            'instavel': [(503, None), httpx.ConnectError('recusada'), (200, [aula])],
+            'inexistente': [(404, None)],
+            'fora': [httpx.ConnectTimeout('timeout')],
+        })
+        with mock.patch.object(tasks.time, 'sleep') as sleep, \
+                self.assertLogs('aulas.tasks', 'WARNING') as logs:
+            respostas = self.buscar(cpd, ['ok', 'instavel', 'inexistente', 'fora'])
+
+        # Só as salas que responderam entram; as outras não são reconciliadas
+        self.assertEqual(respostas, {'ok': [], 'instavel': [aula]})
+        self.assertEqual(
+            cpd.tentativas,
+            {'ok': 1, 'instavel': 3, 'inexistente': 1, 'fora': tasks.CPD_MAX_TENTATIVAS},
+        )
+        # Backoff exponencial de 'instavel' e 'fora', 4xx sem retentativa
+        esperas = [tasks.CPD_BACKOFF, tasks.CPD_BACKOFF * 2]
+        self.assertCountEqual([c.args[0] for c in sleep.call_args_list], esperas * 2)
+        erros = [r.getMessage() for r in logs.records if r.levelno == logging.ERROR]
+        self.assertEqual(len(erros), 2)
+
+
+class ReconciliacaoAulasTests(TestCase):
+    """ _reconcile_sala com a janela de março de 2030 """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sala = Sala.objects.create(numero='101', nome='Sala', codigo='S1')
+        cls.outra_sala = Sala.objects.create(numero='102', nome='Outra', codigo='S2')
+        cls.janela = tasks._janela_sync('01/03/2030', '31/03/2030')
+
+    def cpd(self, *aulas):
+        return tasks._parse_aulas_cpd([aula_cpd(*aula) for aula in aulas])
+
+    def sincronizar(self, *aulas, limite_exclusao=None):
+        return dict(tasks._reconcile_sala(
+            self.sala, self.cpd(*aulas), self.janela, limite_exclusao
+        ))
+
+    def aulas(self, sala=None):
+        return sorted(
+            (localtime(aula.inicio).strftime('%d %H:%M'), localtime(aula.fim).strftime('%H:%M'),
+             aula.professor, aula.disciplina)
+            for aula in Aula.objects.filter(sala=sala or self.sala)
+        )
+
+    def test_insere_atualiza_e_mantem(self):
+        self.assertEqual(
+            self.sincronizar(
+                ('2030-03-04 08:30:00', '2030-03-04 10:20:00'),
+                ('2030-03-05 08:30:00', '2030-03-05 10:20:00', 'Prof. Bia - Sinais'),
+            ),
+            {'inseridas': 2, 'atualizadas': 0},
+        )
+        self.assertEqual(
+            self.sincronizar(
+                ('2030-03-04 08:30:00', '2030-03-04 10:20:00'),
+                ('2030-03-05 08:30:00', '2030-03-05 10:20:00', 'Prof. Caio / Sinais'),
+                ('2030-03-06 13:30:00', '2030-03-06 15:20:00'),
+            ),
+            {'inseridas': 1, 'atualizadas': 1, 'inalteradas': 1},
+        )
+        self.assertEqual(self.aulas(), [
+            ('04 08:30', '10:20', 'Prof. Ana', 'Circuitos'),
+            ('05 08:30', '10:20', 'Prof. Caio', 'Sinais'),
+            ('06 13:30', '15:20', 'Prof. Ana', 'Circuitos'),
+        ])
+
+    def test_remove_so_as_aulas_que_sumiram(self):
+        self.sincronizar(
+            ('2030-03-04 08:30:00', '2030-03-04 10:20:00'),
+            ('2030-03-04 08:30:00', '2030-03-04 12:10:00'),
+            ('2030-03-11 08:30:00', '2030-03-11 10:20:00'),
+            ('2030-03-20 08:30:00', '2030-03-20 10:20:00'),
+        )
+        # Mesmo horário em outra sala e aula fora da janela
+        Aula.objects.create(
+            sala=self.outra_sala,
+            inicio=self.janela[0].replace(day=20, hour=8, minute=30),
+            fim=self.janela[0].replace(day=20, hour=10, minute=20),
+        )
+        Aula.objects.create(
+            sala=self.sala,
+            inicio=self.janela[1].replace(hour=8, minute=30),
+            fim=self.janela[1].replace(hour=10, minute=20),
+        )
+
+        # Somem a aula de 04 até 12:10 (mesmo início de outra que fica) e a
+        # de 20, mas só as a partir do dia 10 podem ser removidas
+        contagem = self.sincronizar(
+            ('2030-03-04 08:30:00', '2030-03-04 10:20:00'),
+            ('2030-03-11 08:30:00', '2030-03-11 10:20:00'),
+            limite_exclusao=self.janela[0].replace(day=10),
+        )
+        self.assertEqual(contagem, {'inalteradas': 2, 'inseridas': 0, 'atualizadas': 0, 'removidas': 1})
+        self.assertEqual([aula[:2] for aula in self.aulas()], [
+            ('01 08:30', '10:20'),
+            ('04 08:30', '10:20'),
+            ('04 08:30', '12:10'),
+            ('11 08:30', '10:20'),
+        ])
+        self.assertEqual(len(self.aulas(self.outra_sala)), 1)
+
+
+@override_settings(CACHES=CACHE_LOCAL, URL_CPD='http://cpd.teste/aulas')
+class HashAulasTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sala = Sala.objects.create(numero='101', nome='Sala', codigo='S1')
+
+    def setUp(self):
+        logging.disable(logging.INFO)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def sincronizar(self, *args):
+        cpd = CpdFalso({'S1': [(200, [])]})
+        with cpd.ativo(), mock.patch.object(
+            tasks, '_reconcile_sala', wraps=tasks._reconcile_sala
+        ) as reconciliar:
+            call_command('sincronizar_aulas', *args, stdout=io.StringIO())
+        return reconciliar.call_count
+
+    def test_sala_sem_alteracoes_nao_e_reconciliada(self):
+        self.assertEqual(self.sincronizar(), 1)
+        self.assertEqual(HashAulasSala.objects.count(), 1)
+        self.assertEqual(self.sincronizar(), 0)
+        self.assertEqual(self.sincronizar('--force'), 1)
+
+    def test_hashes_de_janelas_passadas_sao_apagados(self):
+        hoje = now().date()
+        for inicio, fim in (
+            (hoje - timedelta(days=1), hoje + timedelta(days=30)),
+            (hoje - timedelta(days=40), hoje - timedelta(days=1)),
+        ):
+            HashAulasSala.objects.create(sala=self.sala, inicio=inicio, fim=fim, hash='x')
+
+        self.sincronizar()
+        self.assertEqual(
+            list(HashAulasSala.objects.values_list('inicio', flat=True)), [hoje]
+        )
+
+
+@skipUnless(os.environ.get('BENCHMARK'), "Defina BENCHMARK=1 para medir")
+@override_settings(URL_CPD='http://cpd.teste/aulas')
+class BuscaCpdBenchmarkTests(SimpleTestCase):
+    """ Busca de 20 salas num CPD com 100 ms de latência, em série e em paralelo """
+
+    def test_busca_em_paralelo(self):
+        salas = [str(i) for i in range(20)]
+        for concorrencia in (1, tasks.CPD_MAX_CONCURRENCY):
+            cpd = CpdFalso(latencia=0.1)
+            with mock.patch.object(tasks, 'CPD_MAX_CONCURRENCY', concorrencia), cpd.ativo():
+                inicio = time.perf_counter()
+                tasks._fetch_aulas_cpd(salas, '01/03/2024', '31/12/2024')
+                segundos = time.perf_counter() - inicio
+            print(f"\nCPD com {concorrencia} conexões: {len(salas)} salas em {segundos:.2f} s")
@@ -0,0 +1,65 @@
+from django.db import connection
+from django.utils import timezone
+from controle.models import ControleAcesso, PessoaResumo
+from root.models import Pessoa, Sala
+
+ACESSO = ControleAcesso._meta.db_table
+PESSOA = Pessoa._meta.db_table
+SALA = Sala._meta.db_table
+
+# Colunas devolvidas pelos dois comandos: as do registro mais o que o
+# ControleAcessoSerializer mostra de pessoa e sala, sem outra consulta
+RETORNO_ACESSO = f"""
+    RETURNING id, pessoa_id, sala_id, hora_entrada, hora_saida,
+        (SELECT nome FROM {PESSOA} WHERE {PESSOA}.id = {ACESSO}.pessoa_id) AS pessoa_nome,
+        (SELECT matricula FROM {PESSOA} WHERE {PESSOA}.id = {ACESSO}.pessoa_id) AS pessoa_matricula,
+        (SELECT numero FROM {SALA} WHERE {SALA}.id = {ACESSO}.sala_id) AS sala_numero
+"""
+
+SQL_SAIDA = f"""
+    UPDATE {ACESSO} SET hora_saida = %s
+    WHERE hora_saida IS NULL
+      AND pessoa_id = (SELECT id FROM {PESSOA} WHERE matricula = %s)
+""" + RETORNO_ACESSO
+
+SQL_ENTRADA = f"""
+    INSERT INTO {ACESSO} (pessoa_id, sala_id, hora_entrada, hora_saida)
+    SELECT id, %s, %s, NULL FROM {PESSOA} WHERE matricula = %s
+""" + RETORNO_ACESSO
+
+
+def _registro(sql, params):
+    """ Executa `sql` e monta o ControleAcesso devolvido, já com pessoa e sala """
+    registro = next(iter(ControleAcesso.objects.raw(sql, params)), None)
+    if registro is None:
+        return None
+
+    registro.pessoa = Pessoa(
+        id=registro.pessoa_id,
+        nome=registro.pessoa_nome,
+        matricula=registro.pessoa_matricula,
+    )
+    registro.sala = Sala(id=registro.sala_id, numero=registro.sala_numero)
+    return registro
+
+
+def registrar_saida(matricula):
+    """
+    Fecha o registro em aberto da matrícula, se houver, com um UPDATE; a
+    saída não muda o PessoaResumo, que só guarda a última entrada.
+    """
+    agora = connection.ops.adapt_datetimefield_value(timezone.now())
+    return _registro(SQL_SAIDA, [agora, matricula])
+
+
+def registrar_entrada(matricula, sala_id):
+    """
+    Abre um registro da matrícula na sala com um INSERT ... SELECT; devolve
+    None se não houver pessoa com essa matrícula. Uma entrada simultânea já
+    em aberto é recusada pela constraint acesso_aberto_unico_pessoa.
+    """
+    agora = connection.ops.adapt_datetimefield_value(timezone.now())
+    registro = _registro(SQL_ENTRADA, [sala_id, agora, matricula])
+    if registro is not None:
+        PessoaResumo.objects.atualizar([registro.pessoa_id], emprestimos=False)
+    return registro
@@ -0,0 +1,172 @@
+from collections import defaultdict
+from datetime import datetime
+from django.db.models import F
+from django.http import StreamingHttpResponse
+from django.utils.timezone import localtime
+from itertools import chain, islice
+from controle.models import ItemEmprestimo
+from root.utils import intervalo_dias
+import csv
+import json
+
+# Linhas lidas do banco por vez (cursor no servidor no PostgreSQL)
+EXPORTACAO_CHUNK_SIZE = 2000
+
+FORMATOS_EXPORTACAO = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+}
+
+CAMPOS_ACESSOS = [
+    'id',
+    'pessoa_nome',
+    'pessoa_matricula',
+    'sala_numero',
+    'hora_entrada',
+    'hora_saida',
+]
+
+CAMPOS_EMPRESTIMOS = [
+    'identificador',
+    'items_nomes',
+    'funcionario_nome',
+    'responsavel_nome',
+    'responsavel_matricula',
+    'local',
+    'encerrado',
+    'retirada',
+    'devolucao',
+    'quem_recebeu',
+]
+
+
+class _Eco:
+    """ Pseudo-arquivo que só devolve o que recebe, para o csv.writer """
+
+    def write(self, value):
+        return value
+
+
+def filtro_periodo(campo, inicio=None, fim=None):
+    """
+    Filtro opcional de um DateTimeField entre os dias locais `inicio` e
+    `fim` (inclusivos). Levanta ValueError se alguma data for inválida.
+    """
+    filtro = {}
+    if inicio:
+        filtro[f'{campo}__gte'] = intervalo_dias(inicio)[0]
+    if fim:
+        filtro[f'{campo}__lt'] = intervalo_dias(fim)[1]
+    return filtro
+
+
+def _formatar(valor):
+    if isinstance(valor, datetime):
+        return localtime(valor).isoformat()
+    return valor
+
+
+def _nome_usuario(first_name, last_name, username):
+    """ Mesmo formato de get_user_full_name, a partir das colunas """
+    if username is None:
+        return ""
+    if first_name or last_name:
+        return f"{first_name} {last_name}".strip()
+    return username
+
+
+def resposta_exportacao(linhas, campos, formato, nome_arquivo):
+    """ Resposta em streaming com `linhas` (dicionários) em CSV ou NDJSON """
+    if formato == 'csv':
+        writer = csv.writer(_Eco())
+        conteudo = chain(
+            [writer.writerow(campos)],
+            (
+                writer.writerow([_formatar(linha[campo]) for campo in campos])
+                for linha in linhas
+            ),
+        )
+    else:
+        conteudo = (
+            json.dumps(
+                {campo: _formatar(linha[campo]) for campo in campos},
+                ensure_ascii=False,
+            ) + '\n'
+            for linha in linhas
+        )
+
+    response = StreamingHttpResponse(
+        conteudo, content_type=FORMATOS_EXPORTACAO[formato]
+    )
+    response['Content-Disposition'] = (
+        f'attachment; filename="{nome_arquivo}.{formato}"'
+    )
+    return response
+
+
+def linhas_acessos(queryset):
+    return queryset.order_by('pk').values(
+        'id',
+        'hora_entrada',
+        'hora_saida',
+        pessoa_nome=F('pessoa__nome'),
+        pessoa_matricula=F('pessoa__matricula'),
+        sala_numero=F('sala__numero'),
+    ).iterator(chunk_size=EXPORTACAO_CHUNK_SIZE)
+
+
+def linhas_emprestimos(queryset):
+    """
+    Empréstimos com os mesmos campos do EmprestimoSerializer. Os itens são
+    buscados com uma consulta por lote de empréstimos.
+    """
+    emprestimos = queryset.order_by('pk').values(
+        'id',
+        'identificador',
+        'local',
+        'encerrado',
+        'retirada',
+        'devolucao',
+        'funcionario__first_name',
+        'funcionario__last_name',
+        'funcionario__username',
+        responsavel_nome=F('responsavel__nome'),
+        responsavel_matricula=F('responsavel__matricula'),
+    ).iterator(chunk_size=EXPORTACAO_CHUNK_SIZE)
+
+    while lote := list(islice(emprestimos, EXPORTACAO_CHUNK_SIZE)):
+        itens = defaultdict(list)
+        for item in ItemEmprestimo.objects.filter(
+            emprestimo_id__in=[emprestimo['id'] for emprestimo in lote]
+        ).order_by('pk').values(
+            'emprestimo_id',
+            'nome',
+            'equipamento_id',
+            'equipamento__nome',
+            'recebente__first_name',
+            'recebente__last_name',
+            'recebente__username',
+        ):
+            itens[item['emprestimo_id']].append(item)
+
+        for emprestimo in lote:
+            itens_emprestimo = itens[emprestimo['id']]
+            recebente = next(
+                (i for i in itens_emprestimo if i['recebente__username'] is not None),
+                None,
+            )
+            emprestimo['items_nomes'] = '; '.join(
+                (i['equipamento__nome'] if i['equipamento_id'] else i['nome']) or ""
+                for i in itens_emprestimo
+            )
+            emprestimo['funcionario_nome'] = _nome_usuario(
+                emprestimo['funcionario__first_name'],
+                emprestimo['funcionario__last_name'],
+                emprestimo['funcionario__username'],
+            )
+            emprestimo['quem_recebeu'] = _nome_usuario(
+                recebente['recebente__first_name'],
+                recebente['recebente__last_name'],
+                recebente['recebente__username'],
+            ) if recebente else ""
+            yield emprestimo
@@ -0,0 +1,39 @@
+from rest_framework import status
+from rest_framework.pagination import CursorPagination
+from rest_framework.response import Response
+
+
+class CursorOpcionalPagination(CursorPagination):
+    """
+    Paginação por cursor (keyset), dos registros mais novos para os mais
+    antigos.
+
+    Só é aplicada quando o cliente envia ?cursor= ou ?page_size=. Sem esses
+    parâmetros a lista completa é retornada, como antes, para que os
+    clientes ainda não migrados continuem funcionando.
+    """
+    page_size = 100
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    ordering = '-pk'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        parametros = (self.cursor_query_param, self.page_size_query_param)
+        if not any(p in request.query_params for p in parametros):
+            return None
+        return super().paginate_queryset(queryset, request, view)
+
+
+class ListaPaginadaMixin:
+    """ Viewsets com paginação opcional por cursor """
+    pagination_class = CursorOpcionalPagination
+
+    def listar(self, queryset):
+        """ Serializa `queryset`, paginando se o cliente pediu """
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data, status=status.HTTP_200_OK)
@@ -1,4 +1,5 @@
 import rest_framework.serializers as serializers
+from rest_framework.permissions import SAFE_METHODS
 from controle.models import (
     Ausencia,
     Compras,
@@ -19,7 +20,36 @@ def get_user_full_name(user):
         return f"{user.first_name} {user.last_name}".strip()
     return user.username
 
-class AusenciaSerializer(serializers.ModelSerializer):
+class CamposOpcionaisMixin:
+    """
+    Permite ao cliente limitar os campos da resposta com ?fields=a,b,c.
+
+    Só vale para leituras; os campos omitidos nem chegam a ser calculados.
+    Campos que o serializer não tem são recusados com 400.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        request = self.context.get('request')
+        if request is None or request.method not in SAFE_METHODS:
+            return
+
+        campos = request.query_params.get('fields')
+        if not campos:
+            return
+
+        permitidos = {campo.strip() for campo in campos.split(',') if campo.strip()}
+        desconhecidos = permitidos - set(self.fields)
+        if desconhecidos:
+            raise serializers.ValidationError(
+                {'detail': f"Campos desconhecidos: {', '.join(sorted(desconhecidos))}."}
+            )
+
+        for campo in set(self.fields) - permitidos:
+            self.fields.pop(campo)
+
+class AusenciaSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     funcionario_nome = serializers.SerializerMethodField()
 
     class Meta:
@@ -29,7 +59,7 @@ class AusenciaSerializer(serializers.ModelSerializer):
     def get_funcionario_nome(self, obj):
         return get_user_full_name(obj.funcionario)
 
-class ComprasSerializer(serializers.ModelSerializer):
+class ComprasSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     funcionario_nome = serializers.SerializerMethodField()
 
     class Meta:
@@ -66,7 +96,7 @@ class ComprasSerializer(serializers.ModelSerializer):
     def get_funcionario_nome(self, obj):
         return get_user_full_name(obj.funcionario)
 
-class ControleAcessoSerializer(serializers.ModelSerializer):
+class ControleAcessoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     pessoa_nome = serializers.SerializerMethodField()
     pessoa_matricula = serializers.SerializerMethodField()
     sala_numero = serializers.SerializerMethodField()
@@ -84,7 +114,7 @@ class ControleAcessoSerializer(serializers.ModelSerializer):
     def get_sala_numero(self, obj):
         return obj.sala.numero if obj.sala else None
 
-class ItemEmprestimoSerializer(serializers.ModelSerializer):
+class ItemEmprestimoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     equipamento_nome = serializers.StringRelatedField(
         source="equipamento.nome", read_only=True
     )
@@ -109,7 +139,7 @@ class ItemEmprestimoSerializer(serializers.ModelSerializer):
             "equipamento_patrimonio",
         ]
 
-class EmprestimoSerializer(serializers.ModelSerializer):
+class EmprestimoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     responsavel_nome = serializers.SerializerMethodField()
     responsavel_matricula = serializers.SerializerMethodField()
     funcionario_nome = serializers.SerializerMethodField()
@@ -140,16 +170,17 @@ class EmprestimoSerializer(serializers.ModelSerializer):
     def get_funcionario_nome(self, obj):
         return get_user_full_name(obj.funcionario)
 
+    # Os itens são lidos de obj.emprestimo.all() para aproveitar o
+    # prefetch feito por EmprestimoViewSet.get_queryset
     def get_quem_recebeu(self, obj):
-        item = ItemEmprestimo.objects.filter(emprestimo=obj, recebente__isnull=False).first()
-        if item:
-            return get_user_full_name(item.recebente)
+        for item in obj.emprestimo.all():
+            if item.recebente_id is not None:
+                return get_user_full_name(item.recebente)
         return ""
 
     def get_items_nomes(self, obj):
-        items = ItemEmprestimo.objects.filter(emprestimo=obj)
         item_names = []
-        for item in items:
+        for item in obj.emprestimo.all():
             if not item.equipamento:
                 item_names.append(item.nome)
             else:
@@ -157,7 +188,7 @@ class EmprestimoSerializer(serializers.ModelSerializer):
         return '; '.join(item_names)
 
 
-class EquipamentoSerializer(serializers.ModelSerializer):
+class EquipamentoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     num_manutencao = serializers.IntegerField(read_only=True)
     num_emprestimo = serializers.IntegerField(read_only=True)
     sala_numero = serializers.SerializerMethodField()
@@ -165,22 +196,24 @@ class EquipamentoSerializer(serializers.ModelSerializer):
     class Meta:
         model = Equipamento
         fields = ['id', 'nome', 'descricao', 'patrimonio', 'sala', 'sala_numero',
-                  'defeito', 'foto', 'manual', 'num_manutencao', 'num_emprestimo']
+                  'defeito', 'foto', 'foto_lista', 'foto_detalhe', 'manual',
+                  'num_manutencao', 'num_emprestimo']
 
     def get_sala_numero(self, obj):
         return obj.sala.numero if obj.sala else None
 
-class EquipamentoPublicoSerializer(serializers.ModelSerializer):
+class EquipamentoPublicoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     sala_numero = serializers.SerializerMethodField()
 
     class Meta:
         model = Equipamento
-        fields = ['nome', 'patrimonio', 'sala_numero', 'foto', 'manual']
+        fields = ['nome', 'patrimonio', 'sala_numero', 'foto', 'foto_lista',
+                  'foto_detalhe', 'manual']
 
     def get_sala_numero(self, obj):
         return obj.sala.numero if obj.sala else None
 
-class HorarioTrabalhoSerializer(serializers.ModelSerializer):
+class HorarioTrabalhoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     funcionario_nome = serializers.SerializerMethodField()
 
     class Meta:
@@ -191,7 +224,7 @@ class HorarioTrabalhoSerializer(serializers.ModelSerializer):
         return get_user_full_name(obj.funcionario)
 
 
-class ManutencaoSerializer(serializers.ModelSerializer):
+class ManutencaoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     equipamento_nome = serializers.SerializerMethodField()
     funcionario_nome = serializers.SerializerMethodField()
 
@@ -205,18 +238,18 @@ class ManutencaoSerializer(serializers.ModelSerializer):
     def get_funcionario_nome(self, obj):
         return get_user_full_name(obj.funcionario)
 
-class OrcamentoSerializer(serializers.ModelSerializer):
+class OrcamentoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Orcamento
         fields = '__all__'
 
-class ComponenteSerializer(serializers.ModelSerializer):
+class ComponenteSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     class Meta:
         model = Componente
         fields = '__all__'
 
-class ComponentePublicoSerializer(serializers.ModelSerializer):
+class ComponentePublicoSerializer(CamposOpcionaisMixin, serializers.ModelSerializer):
     class Meta:
         model = Componente
         fields = ['nome', 'descricao', 'quantidade', 'datasheet', 'categoria', 'tipo']
@@ -1,3 +1,14 @@
+from controle.api.acessos import registrar_entrada, registrar_saida
+from controle.api.exportacao import (
+    CAMPOS_ACESSOS,
+    CAMPOS_EMPRESTIMOS,
+    FORMATOS_EXPORTACAO,
+    filtro_periodo,
+    linhas_acessos,
+    linhas_emprestimos,
+    resposta_exportacao,
+)
+from controle.api.pagination import ListaPaginadaMixin
 from controle.api.serializers import (
     AusenciaSerializer,
     ComprasSerializer,
@@ -12,11 +23,23 @@ from controle.api.serializers import (
     ManutencaoSerializer,
     OrcamentoSerializer,
 )
+from controle.reports.demapa import (
+    caminho_demapa,
+    chave_demapa,
+    render_demapa,
+)
+from controle.reports.folha import FOLHA_MAX_PAGINAS, render_folha_emprestimo
 
 from django.contrib.auth.models import User
-from django.db.models import Count
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Avg, Case, Count, F, Max, Prefetch, Value, When, prefetch_related_objects
+from django.db.models.functions import TruncDate
 from django.http import FileResponse
 from django.utils import timezone
+from django_q.models import Failure
+from django_q.tasks import async_task
 from rest_framework import viewsets, status
 from rest_framework.authentication import SessionAuthentication
 from rest_framework.decorators import action
@@ -38,20 +61,13 @@ from controle.models import (
 )
 from aulas.models import Aula
 from root.models import Pessoa, Sala
+from root.utils import filtro_dias, sala_id_por_numero
 
-from barcode import Code39
-from barcode.writer import ImageWriter
-from datetime import datetime
 from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.utils import ImageReader
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib import colors
-from reportlab.lib.units import cm
-
-class AusenciaViewSet(ModelViewSet):
+from itertools import groupby
+from operator import itemgetter
+
+class AusenciaViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Ausencia.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = AusenciaSerializer
@@ -64,8 +80,7 @@ class AusenciaViewSet(ModelViewSet):
         if mine:
             queryset = queryset.filter(funcionario=request.user)
 
-        serializer = self.get_serializer(queryset, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.listar(queryset)
 
     def create(self, request):
         data = {
@@ -90,7 +105,7 @@ class AusenciaViewSet(ModelViewSet):
     def perform_create(self, serializer):
         serializer.save()
 
-class ComprasViewSet(ModelViewSet):
+class ComprasViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Compras.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = ComprasSerializer
@@ -102,180 +117,72 @@ class ComprasViewSet(ModelViewSet):
     def demapa(self, request, pk=None):
         obj = self.get_object()
         buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
-        elements = []
-
-        styles = getSampleStyleSheet()
-        style_title = styles['Normal']
-        style_title.fontSize = 10
-        style_title.leading = 12
-
-        style_content = ParagraphStyle(
-            'Content',
-            parent=styles['Normal'],
-            fontSize=9,
-            leading=11
-        )
-
-        def check_source(source_val, target):
-            return "(x)" if source_val == target else "( )"
-
-        # Calculate max price (average + 20%)
-        prices = [p for p in [obj.preco_orcamento_1, obj.preco_orcamento_2, obj.preco_orcamento_3] if p is not None]
-        preco_maximo = obj.preco_maximo
-        if (preco_maximo is None or preco_maximo == 0) and prices:
-            avg = sum(prices) / 3
-            preco_maximo = round(float(avg) * 1.2, 2)
-
-        data = [
-            ["Nome do item", Paragraph(obj.titulo, style_content), "Quantidade", str(obj.quantidade), "Preço Máximo\n(R$)", f"R$ {preco_maximo or '0,00'}"],
-            ["Descrição", Paragraph(obj.descricao.replace('\n', '<br/>'), style_content), "", "", "", ""],
-            ["Justificativa", Paragraph(obj.justificativa.replace('\n', '<br/>'), style_content), "", "", "", ""],
-            ["Empresa\nConsultada", "Data da Consulta", "Preço (R$)", "Fonte", "", ""],
-        ]
-
-        def add_budget_row(data_list, empresa, data_cons, preco, url, fonte):
-            source_options = [
-                f"{'(x)' if fonte == 'website' else '( )'} website",
-                f"{'(x)' if fonte == 'telefone' else '( )'} telefone",
-                f"{'(x)' if fonte == 'email' else '( )'} email"
-            ]
-            source_str = " ".join(source_options)
-            data_list.append([empresa, data_cons.strftime('%d/%m/%Y') if data_cons else "", f"R$ {preco or '0,00'}", source_str, "", ""])
-            data_list.append(["", Paragraph(f"<b>Fonte:</b> {url or ''}", style_content), "", "", "", ""])
-
-        add_budget_row(data, obj.empresa_orcamento_1, obj.data_orcamento_1, obj.preco_orcamento_1, obj.url_orcamento_1, obj.fonte_orcamento_1)
-        add_budget_row(data, obj.empresa_orcamento_2, obj.data_orcamento_2, obj.preco_orcamento_2, obj.url_orcamento_2, obj.fonte_orcamento_2)
-        add_budget_row(data, obj.empresa_orcamento_3, obj.data_orcamento_3, obj.preco_orcamento_3, obj.url_orcamento_3, obj.fonte_orcamento_3)
-
-        col_widths = [2.5*cm, 5.5*cm, 2.5*cm, 2.5*cm, 3.5*cm, 2.5*cm]
-
-        table = Table(data, colWidths=col_widths)
-
-        table_style = TableStyle([
-            ('GRID', (0,0), (-1,-1), 0.5, colors.black),
-            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
-            ('FONTSIZE', (0,0), (-1,-1), 9),
-
-            ('BACKGROUND', (0,0), (0,0), colors.whitesmoke),
-            ('BACKGROUND', (2,0), (2,0), colors.whitesmoke),
-            ('BACKGROUND', (4,0), (4,0), colors.whitesmoke),
-
-            ('SPAN', (1,1), (5,1)), # Descrição content
-            ('SPAN', (1,2), (5,2)), # Justificativa content
-            ('SPAN', (3,3), (5,3)), # Fonte header
-            ('SPAN', (0,4), (0,5)), # Budget 1 name
-            ('SPAN', (1,5), (5,5)), # Budget 1 URL
-            ('SPAN', (3,4), (5,4)), # Budget 1 source selection
-            ('SPAN', (0,6), (0,7)), # Budget 2 name
-            ('SPAN', (1,7), (5,7)), # Budget 2 URL
-            ('SPAN', (3,6), (5,6)), # Budget 2 source selection
-            ('SPAN', (0,8), (0,9)), # Budget 3 name
-            ('SPAN', (1,9), (5,9)), # Budget 3 URL
-            ('SPAN', (3,8), (5,8)), # Budget 3 source selection
-
-            ('ALIGN', (0,0), (-1,-1), 'LEFT'),
-            ('ALIGN', (2,0), (5,0), 'CENTER'),
-            ('ALIGN', (0,0), (0,-1), 'CENTER'), # Labels col 0
-        ])
-        table.setStyle(table_style)
-        elements.append(table)
-
-        doc.build(elements)
+        render_demapa([obj], buffer)
         buffer.seek(0)
         return FileResponse(buffer, as_attachment=True, filename=f"demapa_{obj.id}.pdf")
 
     @action(detail=False, methods=['post'])
     def demapa_agregado(self, request):
+        """
+        Gera o DEMAPA de vários itens. Com "assincrono": true, o PDF é
+        gerado em segundo plano e a resposta traz o id do trabalho, para
+        consultar em demapa_agregado/<id>/ e baixar em .../download/; esses
+        PDFs são apagados depois de DEMAPA_RETENCAO_HORAS.
+        """
         ids = request.data.get('ids', [])
         if not ids:
             return Response({'detail': 'Nenhum ID fornecido.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        objs = Compras.objects.filter(id__in=ids).order_by('titulo')
+        objs = Compras.objects.filter(id__in=ids).order_by('titulo', 'pk')
         if not objs:
             return Response({'detail': 'Nenhum registro encontrado.'}, status=status.HTTP_404_NOT_FOUND)
 
-        buffer = BytesIO()
-        doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
-        elements = []
-
-        styles = getSampleStyleSheet()
-        style_content = ParagraphStyle(
-            'Content',
-            parent=styles['Normal'],
-            fontSize=9,
-            leading=11
+        chave = chave_demapa(objs)
+        caminho = caminho_demapa(chave)
+
+        if not request.data.get('assincrono'):
+            # Gerado na memória; só reaproveita o arquivo se já existir
+            if default_storage.exists(caminho):
+                arquivo = default_storage.open(caminho)
+            else:
+                arquivo = BytesIO()
+                render_demapa(objs, arquivo, agregado=True)
+                arquivo.seek(0)
+            return FileResponse(arquivo, as_attachment=True, filename="demapa_agregado.pdf")
+
+        if default_storage.exists(caminho):
+            return Response({'id': chave, 'estado': 'pronto'}, status=status.HTTP_200_OK)
+
+        nome_tarefa = f"demapa_{chave}"
+        Failure.objects.filter(name=nome_tarefa).delete()
+        async_task(
+            'controle.tasks.gerar_demapa_agregado',
+            [obj.pk for obj in objs],
+            chave,
+            task_name=nome_tarefa,
+        )
+        return Response({'id': chave, 'estado': 'processando'}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], url_path=r'demapa_agregado/(?P<chave>[0-9a-f]{64})')
+    def demapa_agregado_estado(self, request, chave=None):
+        if default_storage.exists(caminho_demapa(chave)):
+            estado = 'pronto'
+        elif Failure.objects.filter(name=f"demapa_{chave}").exists():
+            estado = 'erro'
+        else:
+            estado = 'processando'
+        return Response({'id': chave, 'estado': estado})
+
+    @action(detail=False, methods=['get'], url_path=r'demapa_agregado/(?P<chave>[0-9a-f]{64})/download')
+    def demapa_agregado_download(self, request, chave=None):
+        caminho = caminho_demapa(chave)
+        if not default_storage.exists(caminho):
+            return Response({'detail': 'Documento não encontrado.'}, status=status.HTTP_404_NOT_FOUND)
+        return FileResponse(
+            default_storage.open(caminho), as_attachment=True, filename="demapa_agregado.pdf"
         )
 
-        col_widths = [2.5*cm, 5.5*cm, 2.5*cm, 2.5*cm, 3.5*cm, 2.5*cm]
-
-        for i, obj in enumerate(objs):
-            # Calculate max price (average + 20%) if it's not set in the database but budgets exist
-            prices = [p for p in [obj.preco_orcamento_1, obj.preco_orcamento_2, obj.preco_orcamento_3] if p is not None]
-            preco_maximo = obj.preco_maximo
-            if (preco_maximo is None or preco_maximo == 0) and prices:
-                avg = sum(prices) / 3
-                preco_maximo = round(float(avg) * 1.2, 2)
-
-            data = [
-                ["Nome do item", Paragraph(obj.titulo, style_content), "Quantidade", str(obj.quantidade), "Preço Máximo\n(R$)", f"R$ {preco_maximo or '0,00'}"],
-                ["Descrição", Paragraph((obj.descricao or '').replace('\n', '<br/>'), style_content), "", "", "", ""],
-                ["Justificativa", Paragraph((obj.justificativa or '').replace('\n', '<br/>'), style_content), "", "", "", ""],
-                ["Empresa\nConsultada", "Data da Consulta", "Preço (R$)", "Fonte", "", ""],
-            ]
-
-            def add_budget_row(data_list, empresa, data_cons, preco, url, fonte):
-                source_options = [
-                    f"{'(x)' if fonte == 'website' else '( )'} website",
-                    f"{'(x)' if fonte == 'telefone' else '( )'} telefone",
-                    f"{'(x)' if fonte == 'email' else '( )'} email"
-                ]
-                source_str = " ".join(source_options)
-                data_list.append([empresa or "", data_cons.strftime('%d/%m/%Y') if data_cons else "", f"R$ {preco or '0,00'}", source_str, "", ""])
-                data_list.append(["", Paragraph(f"<b>Fonte:</b> {url or ''}", style_content), "", "", "", ""])
-
-            add_budget_row(data, obj.empresa_orcamento_1, obj.data_orcamento_1, obj.preco_orcamento_1, obj.url_orcamento_1, obj.fonte_orcamento_1)
-            add_budget_row(data, obj.empresa_orcamento_2, obj.data_orcamento_2, obj.preco_orcamento_2, obj.url_orcamento_2, obj.fonte_orcamento_2)
-            add_budget_row(data, obj.empresa_orcamento_3, obj.data_orcamento_3, obj.preco_orcamento_3, obj.url_orcamento_3, obj.fonte_orcamento_3)
-
-            table = Table(data, colWidths=col_widths, repeatRows=0)
-            table_style = TableStyle([
-                ('GRID', (0,0), (-1,-1), 0.5, colors.black),
-                ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-                ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
-                ('FONTSIZE', (0,0), (-1,-1), 9),
-                ('BACKGROUND', (0,0), (0,0), colors.whitesmoke),
-                ('BACKGROUND', (2,0), (2,0), colors.whitesmoke),
-                ('BACKGROUND', (4,0), (4,0), colors.whitesmoke),
-                ('SPAN', (1,1), (5,1)),
-                ('SPAN', (1,2), (5,2)),
-                ('SPAN', (3,3), (5,3)),
-                ('SPAN', (0,4), (0,5)),
-                ('SPAN', (1,5), (5,5)),
-                ('SPAN', (3,4), (5,4)),
-                ('SPAN', (0,6), (0,7)),
-                ('SPAN', (1,7), (5,7)),
-                ('SPAN', (3,6), (5,6)),
-                ('SPAN', (0,8), (0,9)),
-                ('SPAN', (1,9), (5,9)),
-                ('SPAN', (3,8), (5,8)),
-                ('ALIGN', (0,0), (-1,-1), 'LEFT'),
-                ('ALIGN', (2,0), (5,0), 'CENTER'),
-                ('ALIGN', (0,0), (0,-1), 'CENTER'),
-                ('NOSPLIT', (0,0), (-1,-1)), # Keep each item together on one page
-            ])
-            table.setStyle(table_style)
-            elements.append(table)
-
-            if i < len(objs) - 1:
-                elements.append(Spacer(1, 1*cm)) # Add margin between items
-
-        doc.build(elements)
-        buffer.seek(0)
-        return FileResponse(buffer, as_attachment=True, filename="demapa_agregado.pdf")
-
-class ControleAcessoViewSet(ModelViewSet):
+class ControleAcessoViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = ControleAcesso.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = ControleAcessoSerializer
@@ -292,11 +199,9 @@ class ControleAcessoViewSet(ModelViewSet):
         all = request.query_params.get('all', None)
 
         if not all:
-            queryset = queryset.exclude(hora_saida__isnull=False)
-
-        serializer = self.get_serializer(queryset, many=True)
+            queryset = queryset.filter(hora_saida__isnull=True)
 
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.listar(queryset)
 
     def create(self, request, *args, **kwargs):
 
@@ -313,11 +218,12 @@ class ControleAcessoViewSet(ModelViewSet):
         except Sala.DoesNotExist:
             return Response({'detail': 'Não há uma sala correspondente'})
 
-        aluno_registrado = ControleAcesso.objects.filter(
-            pessoa=aluno, hora_saida__isnull=True
-        ).exists()
-
-        if aluno_registrado:
+        # Um único INSERT: a constraint acesso_aberto_unico_pessoa recusa uma
+        # segunda entrada em aberto, mesmo com leituras simultâneas
+        try:
+            with transaction.atomic():
+                obj = ControleAcesso.objects.create(pessoa=aluno, sala=sala)
+        except IntegrityError:
             return Response(
                 {
                     'detail': 'O aluno não pode estar em duas salas ao mesmo tempo!'
@@ -325,62 +231,118 @@ class ControleAcessoViewSet(ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        data = {
-            'pessoa': aluno.id,
-            'sala': sala.id,
-            'hora_saida': None
-        }
+        serializer = self.get_serializer(obj)
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data, status=status.HTTP_201_CREATED, headers=headers
+        )
 
-        serializer = self.get_serializer(data=data)
+    @action(detail=False, methods=['patch'], url_path='bymatricula')
+    def patch_by_matricula(self, request, *args, **kwargs):
+        """ Registra a saída da matrícula, com o mesmo UPDATE do scan """
+        matricula = request.data.get('matricula', None)
+        if not matricula:
+            return Response({'detail': 'Matrícula do aluno é necessária.'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            serializer.is_valid(raise_exception=True)
-            self.perform_create(serializer)
-            headers = self.get_success_headers(serializer.data)
-            return Response(
-                serializer.data, status=status.HTTP_201_CREATED, headers=headers
-            )
-        except ValidationError as e:
-            return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        obj = registrar_saida(matricula)
+        if obj is None:
+            if not Pessoa.objects.filter(matricula=matricula).exists():
+                return Response({'detail': 'Aluno não encontrado.'},
+                                status=status.HTTP_404_NOT_FOUND)
+            return Response({'detail': 'Acesso não encontrado.'},
+                            status=status.HTTP_404_NOT_FOUND)
 
-    def perform_create(self, serializer):
-        serializer.save()
+        return Response(self.get_serializer(obj).data)
 
-    @action(detail=False, methods=['patch'], url_path='bymatricula')
-    def patch_by_matricula(self, request, *args, **kwargs):
+    @action(detail=False, methods=['post'], url_path='scan')
+    def scan(self, request, *args, **kwargs):
+        """
+        Leitura da matrícula no balcão: fecha o registro em aberto da pessoa
+        ou, se não houver, abre um na sala informada. Cada caso é um único
+        comando SQL, numa transação.
+        """
         matricula = request.data.get('matricula', None)
         if not matricula:
             return Response({'detail': 'Matrícula do aluno é necessária.'},
                             status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            pessoa = Pessoa.objects.get(matricula=matricula)
-        except Pessoa.DoesNotExist:
+            with transaction.atomic():
+                obj = registrar_saida(matricula)
+                if obj is not None:
+                    data = self.get_serializer(obj).data
+                    return Response({**data, 'acao': 'saida'})
+
+                sala_id = sala_id_por_numero(request.data.get('sala'))
+                if sala_id is None:
+                    return Response({'detail': 'Não há uma sala correspondente'},
+                                    status=status.HTTP_400_BAD_REQUEST)
+
+                obj = registrar_entrada(matricula, sala_id)
+        except IntegrityError:
+            # Outra leitura da mesma matrícula abriu um registro antes desta
+            return Response(
+                {
+                    'detail': 'O aluno não pode estar em duas salas ao mesmo tempo!'
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        if obj is None:
             return Response({'detail': 'Aluno não encontrado.'},
                             status=status.HTTP_404_NOT_FOUND)
 
+        data = self.get_serializer(obj).data
+        return Response({**data, 'acao': 'entrada'}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['get'], url_path='exportar')
+    def exportar(self, request, *args, **kwargs):
+        """
+        Exporta o histórico de acessos em CSV ou NDJSON (?formato=), com
+        filtros opcionais ?inicio=, ?fim= (AAAA-MM-DD) e ?sala= (número).
+        """
+        formato = request.query_params.get('formato', 'csv')
+        if formato not in FORMATOS_EXPORTACAO:
+            return Response({'detail': 'Formato deve ser "csv" ou "ndjson".'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
         try:
-            obj = ControleAcesso.objects.get(pessoa=pessoa, hora_saida__isnull=True)
-        except ControleAcesso.DoesNotExist:
-            return Response({'detail': 'Acesso não encontrado.'},
-                            status=status.HTTP_404_NOT_FOUND)
+            filtro = filtro_periodo(
+                'hora_entrada',
+                request.query_params.get('inicio'),
+                request.query_params.get('fim'),
+            )
+        except ValueError:
+            return Response({'detail': 'Datas devem estar no formato AAAA-MM-DD.'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        obj.hora_saida = timezone.now()
-        obj.save()
+        queryset = ControleAcesso.objects.filter(**filtro)
 
-        serializer = self.get_serializer(obj, data=request.data, partial=True)
-        serializer.is_valid(raise_exception=True)
-        self.perform_update(serializer)
+        sala = request.query_params.get('sala')
+        if sala:
+            queryset = queryset.filter(sala__numero=sala)
 
-        return Response(serializer.data)
+        return resposta_exportacao(
+            linhas_acessos(queryset), CAMPOS_ACESSOS, formato, 'registros'
+        )
 
-class EmprestimoViewSet(viewsets.ModelViewSet):
+class EmprestimoViewSet(ListaPaginadaMixin, viewsets.ModelViewSet):
     queryset = Emprestimo.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = EmprestimoSerializer
 
     def get_queryset(self):
-        queryset = Emprestimo.objects.all()
+        queryset = Emprestimo.objects.select_related(
+            'responsavel', 'funcionario'
+        ).prefetch_related(
+            Prefetch(
+                'emprestimo',
+                queryset=ItemEmprestimo.objects.select_related(
+                    'equipamento', 'recebente'
+                ).order_by('pk'),
+            )
+        )
         identificador = self.request.query_params.get('identificador', None)
         if identificador is not None:
             queryset = queryset.filter(identificador=identificador)
@@ -400,9 +362,7 @@ class EmprestimoViewSet(viewsets.ModelViewSet):
         if not all:
             queryset = queryset.exclude(devolucao__isnull=False)
 
-        serializer = self.get_serializer(queryset, many=True)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.listar(queryset)
 
     def create(self, request, *args, **kwargs):
 
@@ -428,38 +388,28 @@ class EmprestimoViewSet(viewsets.ModelViewSet):
 
         try:
             serializer.is_valid(raise_exception=True)
-            emprestimo = serializer.save(
-                responsavel=Pessoa.objects.get(
-                    matricula=self.request.data["matricula"]
-                ),
-                funcionario=self.request.user,
-            )
-
-            for item in items:
-                try:
-                    equipamento = Equipamento.objects.get(patrimonio=item)
-                    data = {
-                        'emprestimo': emprestimo.pk,
-                        'equipamento': equipamento.pk,
-                    }
-                    item_serializer = ItemEmprestimoSerializer(data=data)
-                    item_serializer.is_valid(raise_exception=True)
-                    item_serializer.save()
-                except Equipamento.DoesNotExist:
-                    data = {
-                        'emprestimo': emprestimo.pk,
-                        'nome': item,
-                    }
-                    item_serializer = ItemEmprestimoSerializer(data=data)
-                    item_serializer.is_valid(raise_exception=True)
-                    item_serializer.save()
-
-            headers = self.get_success_headers(serializer.data)
-            return Response(
-                serializer.data, status=status.HTTP_201_CREATED, headers=headers
-            )
+            # Empréstimo e itens são gravados juntos, ou nenhum deles
+            with transaction.atomic():
+                emprestimo = serializer.save(
+                    responsavel=responsavel,
+                    funcionario=self.request.user,
+                )
+                ItemEmprestimo.objects.criar_itens(emprestimo, items or [])
         except ValidationError as e:
             return Response({'detail': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except DjangoValidationError as e:
+            return Response({'detail': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
+
+        prefetch_related_objects([emprestimo], Prefetch(
+            'emprestimo',
+            queryset=ItemEmprestimo.objects.select_related(
+                'equipamento', 'recebente'
+            ).order_by('pk'),
+        ))
+        headers = self.get_success_headers(serializer.data)
+        return Response(
+            serializer.data, status=status.HTTP_201_CREATED, headers=headers
+        )
 
     @action(detail=False, methods=['patch'], url_path='byidentifier')
     def patch_by_identifier(self, request, *args, **kwargs):
@@ -468,130 +418,71 @@ class EmprestimoViewSet(viewsets.ModelViewSet):
             return Response({'detail': 'Identificador de empréstimo é necessário.'},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            obj = Emprestimo.objects.get(identificador=identificador)
-        except Emprestimo.DoesNotExist:
-            return Response({'detail': 'Não encontrado.'},
-                            status=status.HTTP_404_NOT_FOUND)
-
-        # Mark all pending items as returned by the current user
-        now = timezone.now()
-        itens_pendentes = ItemEmprestimo.objects.filter(emprestimo=obj, devolvido=False)
-        for item in itens_pendentes:
-            item.devolvido = True
-            item.devolucao = now
-            item.recebente = request.user
-            item.save()
+        with transaction.atomic():
+            try:
+                obj = Emprestimo.objects.select_for_update().get(identificador=identificador)
+            except Emprestimo.DoesNotExist:
+                return Response({'detail': 'Não encontrado.'},
+                                status=status.HTTP_404_NOT_FOUND)
 
-        # Close the loan
-        obj.encerrado = True
-        obj.devolucao = now
-        obj.save()
+            # Devolve todos os itens pendentes, recebidos pelo usuário atual
+            ItemEmprestimo.objects.devolver(obj, request.user)
 
-        serializer = self.get_serializer(obj)
+        serializer = self.get_serializer(self.get_queryset().get(pk=obj.pk))
         return Response(serializer.data)
 
-    @action(detail=False, methods=['get'], url_path='printsheet')
-    def print_sheet(self, request, *args, **kwargs):
-        start = int(request.query_params.get('inicio'))
-        pages = int(request.query_params.get('paginas'))
-
-        fig_w, fig_h = 113, 62
-        text_size = 12
-
-        buffer = BytesIO()
-
-        c = canvas.Canvas(buffer, pagesize=A4)
-
-        margin = 28
-
-        width, height = A4
-
-        num_columns = 3
-        num_rows = 9
-
-        code_list = range(start, start + num_columns*num_rows*pages)
-
-        code_iter = iter(code_list)
-
-        for page in range(1, pages + 1):
-
-            cell_width = (width - 2 * margin) / num_columns
-            cell_height = (height - 2 * margin) / num_rows
-
-            for i in range(num_columns + 1):
-                x = margin + i * cell_width
-                c.line(x, margin, x, height - margin)
-
-            for j in range(num_rows + 1):
-                y = margin + j * cell_height
-                c.line(margin, y, width - margin, y)
-
-            for row in range(num_rows):
-                for col in range(num_columns):
-
-                    img = BytesIO()
-
-                    Code39(
-                        str(next(code_iter)),
-                        writer=ImageWriter(),
-                        add_checksum=False,
-                    ).write(img)
-
-                    code = ImageReader(img)
-
-                    x = margin + col * cell_width
-                    y = margin + (num_rows - row - 1) * cell_height
-
-                    cell_center_x = x + cell_width / 2
-                    cell_center_y = y + cell_height / 2
-
-                    center_x = cell_center_x - fig_w / 2
-                    center_y = cell_center_y - fig_h / 2
-
-                    text_pipe = '|'
-                    text_sign = '__________'
-                    text_retdev = 'Retirada / Devolução'
-                    text_under = "NUPEDEE - Autenticação de Registros de Empréstimo"
-                    text_pages = f"{page}/{pages}"
-                    text_date = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
-
-                    text_pipe_w = c.stringWidth(text_pipe, "Helvetica", text_size)
-                    text_sign_w = c.stringWidth(text_sign, "Helvetica", text_size)
-                    text_retdev_w = c.stringWidth(text_retdev, "Helvetica", text_size)
-                    text_h = text_size
-
-                    centered_pipe_x = cell_center_x - text_pipe_w / 2
-                    centered_sign_x = cell_center_x - text_sign_w / 2
-                    centered_retdev_x = cell_center_x - text_retdev_w / 2
+    @action(detail=False, methods=['get'], url_path='exportar')
+    def exportar(self, request, *args, **kwargs):
+        """
+        Exporta o histórico de empréstimos em CSV ou NDJSON (?formato=), com
+        filtros opcionais de retirada ?inicio= e ?fim= (AAAA-MM-DD).
+        """
+        formato = request.query_params.get('formato', 'csv')
+        if formato not in FORMATOS_EXPORTACAO:
+            return Response({'detail': 'Formato deve ser "csv" ou "ndjson".'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-                    centered_y = cell_center_y - text_h / 2
+        try:
+            filtro = filtro_periodo(
+                'retirada',
+                request.query_params.get('inicio'),
+                request.query_params.get('fim'),
+            )
+        except ValueError:
+            return Response({'detail': 'Datas devem estar no formato AAAA-MM-DD.'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-                    c.drawImage(
-                        code,
-                        center_x,
-                        center_y + 10,
-                        width=fig_w,
-                        height=fig_h,
-                    )
-                    c.drawString(centered_sign_x - 35, centered_y - 20, text_sign)
-                    c.drawString(centered_pipe_x, centered_y - 25, text_pipe)
-                    c.drawString(centered_sign_x + 35, centered_y - 20, text_sign)
-                    c.drawString(centered_retdev_x + 5, centered_y - 35, text_retdev)
-                    c.drawString(50, 820, text_date)
-                    c.drawString(50, 10, text_under)
-                    c.drawString(500, 10, text_pages)
+        return resposta_exportacao(
+            linhas_emprestimos(Emprestimo.objects.filter(**filtro)),
+            CAMPOS_EMPRESTIMOS,
+            formato,
+            'emprestimos',
+        )
 
-            c.showPage()
+    @action(detail=False, methods=['get'], url_path='printsheet')
+    def print_sheet(self, request, *args, **kwargs):
+        try:
+            start = int(request.query_params.get('inicio'))
+            pages = int(request.query_params.get('paginas'))
+        except (TypeError, ValueError):
+            return Response({'detail': 'Parâmetros "inicio" e "paginas" devem ser números inteiros.'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
-        c.save()
+        if start < 0:
+            return Response({'detail': 'O código inicial não pode ser negativo.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if not 1 <= pages <= FOLHA_MAX_PAGINAS:
+            return Response({'detail': f'O número de páginas deve estar entre 1 e {FOLHA_MAX_PAGINAS}.'},
+                            status=status.HTTP_400_BAD_REQUEST)
 
+        buffer = BytesIO()
+        render_folha_emprestimo(start, pages, buffer)
         buffer.seek(0)
         return FileResponse(
             buffer, as_attachment=True, filename=f"folha_{start}.pdf",
         )
 
-class EquipamentoViewSet(ModelViewSet):
+class EquipamentoViewSet(ListaPaginadaMixin, ModelViewSet):
     permission_classes = (IsAuthenticated,)
     serializer_class = EquipamentoSerializer
 
@@ -623,12 +514,12 @@ class EquipamentoViewSet(ModelViewSet):
             return Response(serializer.data, status=status.HTTP_200_OK)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
-class EquipamentoPublicoViewSet(ModelViewSet):
+class EquipamentoPublicoViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Equipamento.objects.all()
     permission_classes = []
     serializer_class = EquipamentoPublicoSerializer
 
-class HorarioTrabalhoViewSet(ModelViewSet):
+class HorarioTrabalhoViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = HorarioTrabalho.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = HorarioTrabalhoSerializer
@@ -642,9 +533,7 @@ class HorarioTrabalhoViewSet(ModelViewSet):
             user_pk = request.user.pk
             queryset = queryset.filter(funcionario=user_pk)
 
-        serializer = self.get_serializer(queryset, many=True)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.listar(queryset)
 
     @action(detail=False, methods=['patch'], url_path='byday')
     def patch_by_day(self, request, *args, **kwargs):
@@ -668,7 +557,7 @@ class HorarioTrabalhoViewSet(ModelViewSet):
         serializer = self.get_serializer(horario)
         return Response(serializer.data)
 
-class ItemViewSet(ModelViewSet):
+class ItemViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = ItemEmprestimo.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = ItemEmprestimoSerializer
@@ -686,9 +575,7 @@ class ItemViewSet(ModelViewSet):
         if emprestimo:
             queryset = queryset.filter(emprestimo=emprestimo.pk)
 
-        serializer = self.get_serializer(queryset, many=True)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.listar(queryset)
 
     def perform_create(self, serializer):
         serializer.save()
@@ -737,28 +624,13 @@ class ItemViewSet(ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST,
             )
 
-        created_items = []
-        for item in items:
-            item = item.strip()
-            if not item:
-                continue
-            try:
-                equipamento = Equipamento.objects.get(patrimonio=item)
-                data = {
-                    'emprestimo': emprestimo_obj.pk,
-                    'equipamento': equipamento.pk,
-                }
-            except Equipamento.DoesNotExist:
-                data = {
-                    'emprestimo': emprestimo_obj.pk,
-                    'nome': item,
-                }
-
-            item_serializer = ItemEmprestimoSerializer(data=data)
-            item_serializer.is_valid(raise_exception=True)
-            item_serializer.save()
-            created_items.append(item_serializer.data)
+        try:
+            with transaction.atomic():
+                criados = ItemEmprestimo.objects.criar_itens(emprestimo_obj, items)
+        except DjangoValidationError as e:
+            return Response({'detail': e.messages[0]}, status=status.HTTP_400_BAD_REQUEST)
 
+        created_items = ItemEmprestimoSerializer(criados, many=True).data
         return Response(created_items, status=status.HTTP_201_CREATED)
 
     @action(detail=False, methods=['patch'], url_path='return')
@@ -770,51 +642,63 @@ class ItemViewSet(ModelViewSet):
             return Response({'detail': 'Identificador do empréstimo e nome/patrimônio são necessários.'},
                             status=status.HTTP_400_BAD_REQUEST)
 
-        try:
-            emprestimo_obj = Emprestimo.objects.get(identificador=identificador)
-        except Emprestimo.DoesNotExist:
-            return Response({'detail': 'Empréstimo não encontrado.'},
-                            status=status.HTTP_404_NOT_FOUND)
+        with transaction.atomic():
+            try:
+                emprestimo_obj = Emprestimo.objects.select_for_update().get(
+                    identificador=identificador
+                )
+            except Emprestimo.DoesNotExist:
+                return Response({'detail': 'Empréstimo não encontrado.'},
+                                status=status.HTTP_404_NOT_FOUND)
 
-        # Try to find the item
-        obj = None
+            itens, _ = ItemEmprestimo.objects.pendentes_por_nome(emprestimo_obj, [nome])
+            if not itens:
+                return Response({'detail': 'Item não encontrado ou já devolvido.'},
+                                status=status.HTTP_404_NOT_FOUND)
 
-        # 1. Try by name
-        obj = ItemEmprestimo.objects.filter(
-            emprestimo=emprestimo_obj, nome=nome, devolvido=False
-        ).first()
+            ItemEmprestimo.objects.devolver(emprestimo_obj, request.user, itens)
 
-        # 2. If not found by name, try by equipment patrimonio
-        if not obj:
+        serializer = self.get_serializer(itens[0])
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['patch'], url_path='return-batch')
+    def devolver_lote(self, request, *args, **kwargs):
+        """
+        Devolução de vários itens de um empréstimo numa só leitura: um item
+        pendente para cada nome ou patrimônio em `items`.
+        """
+        identificador = request.data.get('emprestimo', None)
+        nomes = request.data.get('items', [])
+        if isinstance(nomes, str):
+            nomes = [nomes]
+
+        if not identificador or not nomes:
+            return Response({'detail': 'Identificador do empréstimo e itens são necessários.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        with transaction.atomic():
             try:
-                equipamento = Equipamento.objects.get(patrimonio=nome)
-                obj = ItemEmprestimo.objects.filter(
-                    emprestimo=emprestimo_obj, equipamento=equipamento, devolvido=False
-                ).first()
-            except (Equipamento.DoesNotExist, ValueError):
-                pass
-
-        if not obj:
-            return Response({'detail': 'Item não encontrado ou já devolvido.'},
-                            status=status.HTTP_404_NOT_FOUND)
+                emprestimo_obj = Emprestimo.objects.select_for_update().get(
+                    identificador=identificador
+                )
+            except Emprestimo.DoesNotExist:
+                return Response({'detail': 'Empréstimo não encontrado.'},
+                                status=status.HTTP_404_NOT_FOUND)
 
-        # Record return
-        obj.recebente = request.user
-        obj.devolucao = timezone.now()
-        obj.devolvido = True
-        obj.save()
+            itens, faltando = ItemEmprestimo.objects.pendentes_por_nome(emprestimo_obj, nomes)
+            if not itens:
+                return Response({'detail': 'Itens não encontrados ou já devolvidos.'},
+                                status=status.HTTP_404_NOT_FOUND)
 
-        # Check if all items are now returned to close the loan
-        items_pendentes = ItemEmprestimo.objects.filter(emprestimo=emprestimo_obj, devolvido=False).exists()
-        if not items_pendentes:
-            emprestimo_obj.encerrado = True
-            emprestimo_obj.devolucao = timezone.now()
-            emprestimo_obj.save()
+            ItemEmprestimo.objects.devolver(emprestimo_obj, request.user, itens)
 
-        serializer = self.get_serializer(obj)
-        return Response(serializer.data)
+        return Response({
+            'devolvidos': self.get_serializer(itens, many=True).data,
+            'nao_encontrados': faltando,
+            'encerrado': emprestimo_obj.encerrado,
+        })
 
-class ManutencaoViewSet(ModelViewSet):
+class ManutencaoViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Manutencao.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = ManutencaoSerializer
@@ -832,9 +716,7 @@ class ManutencaoViewSet(ModelViewSet):
         if patrimonio:
             queryset = queryset.filter(equipamento=equipamento).reverse()
 
-        serializer = self.get_serializer(queryset, many=True)
-
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        return self.listar(queryset)
 
     def create(self, request):
 
@@ -869,7 +751,7 @@ class ManutencaoViewSet(ModelViewSet):
             funcionario=self.request.user
         )
 
-class OrcamentoViewSet(ModelViewSet):
+class OrcamentoViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Orcamento.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = OrcamentoSerializer
@@ -896,12 +778,12 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
         except User.DoesNotExist:
             return Response({"error": "Usuário não encontrado"}, status=404)
 
-class ComponenteViewSet(ModelViewSet):
+class ComponenteViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Componente.objects.all()
     permission_classes = (IsAuthenticated,)
     serializer_class = ComponenteSerializer
 
-class ComponentePublicoViewSet(ModelViewSet):
+class ComponentePublicoViewSet(ListaPaginadaMixin, ModelViewSet):
     queryset = Componente.objects.all()
     permission_classes = []
     serializer_class = ComponentePublicoSerializer
@@ -919,8 +801,14 @@ class PolareViewSet(viewsets.ViewSet):
         if not start_date or not end_date:
             return Response({'detail': 'start_date and end_date are required.'}, status=400)
 
+        try:
+            filtro_aulas = filtro_dias('inicio', start_date, end_date)
+            filtro_acessos = filtro_dias('hora_entrada', start_date, end_date)
+        except ValueError:
+            return Response({'detail': 'start_date and end_date must be YYYY-MM-DD.'}, status=400)
+
         # Aulas Report
-        aulas_qs = Aula.objects.filter(inicio__date__gte=start_date, inicio__date__lte=end_date)
+        aulas_qs = Aula.objects.filter(**filtro_aulas)
         
         if floor != 'ambos':
             aulas_qs = aulas_qs.filter(sala__andar=floor)
@@ -933,22 +821,19 @@ class PolareViewSet(viewsets.ViewSet):
             aulas_qs = aulas_qs.filter(inicio__time__gte='10:30:00')
 
         aulas_report = []
-        # Group by date
-        dates = aulas_qs.dates('inicio', 'day')
-        for d in dates:
-            day_aulas = aulas_qs.filter(inicio__date=d).order_by('inicio')
-            entries = []
-            for a in day_aulas:
-                # Format: Professor Sobrenome - Disciplina
-                # Example: Mario Martins - Eletrônica Aplicada
-                entries.append(f"{a.professor} - {a.disciplina}")
-            
-            if entries:
-                date_str = d.strftime('%d/%m/%Y')
-                aulas_report.append(f"{date_str} | {', '.join(entries)}")
+        # Group by date: one query ordered by start time, grouped in memory
+        aulas_dia = aulas_qs.annotate(
+            dia=TruncDate('inicio')
+        ).order_by('inicio').values_list('dia', 'professor', 'disciplina')
+        for d, day_aulas in groupby(aulas_dia, key=itemgetter(0)):
+            # Format: Professor Sobrenome - Disciplina
+            # Example: Mario Martins - Eletrônica Aplicada
+            entries = [f"{professor} - {disciplina}" for _, professor, disciplina in day_aulas]
+            date_str = d.strftime('%d/%m/%Y')
+            aulas_report.append(f"{date_str} | {', '.join(entries)}")
 
         # Acessos Report
-        acessos_qs = ControleAcesso.objects.filter(hora_entrada__date__gte=start_date, hora_entrada__date__lte=end_date, hora_saida__isnull=False)
+        acessos_qs = ControleAcesso.objects.filter(**filtro_acessos, hora_saida__isnull=False)
         
         if floor != 'ambos':
             acessos_qs = acessos_qs.filter(sala__andar=floor)
@@ -959,28 +844,22 @@ class PolareViewSet(viewsets.ViewSet):
             acessos_qs = acessos_qs.filter(hora_entrada__time__gte='10:30:00')
 
         acessos_report = []
-        dates_acessos = acessos_qs.dates('hora_entrada', 'day')
-        for d in dates_acessos:
-            day_acessos = acessos_qs.filter(hora_entrada__date=d)
-            if not day_acessos.exists():
-                continue
-                
-            num_alunos = day_acessos.values('pessoa').distinct().count()
-            
-            # Duration in seconds
-            durations = []
-            for acc in day_acessos:
-                if acc.hora_saida and acc.hora_entrada:
-                    delta = acc.hora_saida - acc.hora_entrada
-                    durations.append(delta.total_seconds())
-            
-            if durations:
-                avg_seconds = sum(durations) / len(durations)
-                hours = int(avg_seconds // 3600)
-                minutes = int((avg_seconds % 3600) // 60)
-                
-                date_str = d.strftime('%d/%m/%Y')
-                acessos_report.append(f"{date_str} | {num_alunos} alunos, duração média de {hours} horas e {minutes} minutos")
+        acessos_dia = acessos_qs.annotate(
+            dia=TruncDate('hora_entrada')
+        ).values('dia').annotate(
+            # Registros sem pessoa contam como um aluno distinto a mais
+            num_alunos=Count('pessoa', distinct=True) + Max(
+                Case(When(pessoa__isnull=True, then=Value(1)), default=Value(0))
+            ),
+            duracao_media=Avg(F('hora_saida') - F('hora_entrada')),
+        ).order_by('dia')
+        for acessos in acessos_dia:
+            avg_seconds = acessos['duracao_media'].total_seconds()
+            hours = int(avg_seconds // 3600)
+            minutes = int((avg_seconds % 3600) // 60)
+
+            date_str = acessos['dia'].strftime('%d/%m/%Y')
+            acessos_report.append(f"{date_str} | {acessos['num_alunos']} alunos, duração média de {hours} horas e {minutes} minutos")
 
         return Response({
             'aulas': aulas_report,
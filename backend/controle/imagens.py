@@ -0,0 +1,33 @@
+from PIL import Image, ImageOps
+import io
+
+FOTO_QUALIDADE = 80
+
+# Maior lado permitido para cada versão da foto do equipamento
+FOTO_TAMANHO_MAX = (2048, 2048)
+FOTO_TAMANHO_LISTA = (200, 200)
+FOTO_TAMANHO_DETALHE = (1024, 1024)
+
+
+def abrir_imagem(arquivo):
+    """
+    Abre a imagem já rotacionada conforme a orientação EXIF, num modo que o
+    WebP aceita.
+    """
+    imagem = ImageOps.exif_transpose(Image.open(arquivo))
+
+    if imagem.mode not in ('RGB', 'RGBA'):
+        transparente = 'A' in imagem.getbands() or 'transparency' in imagem.info
+        imagem = imagem.convert('RGBA' if transparente else 'RGB')
+
+    return imagem
+
+
+def webp_reduzida(imagem, tamanho):
+    """ Bytes de uma cópia WebP de `imagem` que cabe em `tamanho` """
+    copia = imagem.copy()
+    copia.thumbnail(tamanho, Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    copia.save(buffer, format='WebP', quality=FOTO_QUALIDADE)
+    return buffer.getvalue()
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+from django.db.models import Count
+from controle.models import ControleAcesso
+
+
+class Command(BaseCommand):
+    help = (
+        "Fecha registros de acesso em aberto duplicados (mesma pessoa), "
+        "mantendo só a entrada mais recente"
+    )
+
+    def handle(self, *args, **options):
+        abertos = ControleAcesso.objects.filter(hora_saida__isnull=True, pessoa__isnull=False)
+
+        try:
+            duplicados = list(
+                abertos.values('pessoa').annotate(n=Count('id')).filter(n__gt=1)
+                .values_list('pessoa', flat=True)
+            )
+        except DatabaseError:
+            # Banco novo, antes do primeiro migrate
+            self.stdout.write("Tabela de acessos ainda não existe; nada a fazer.")
+            return
+
+        fechados = 0
+        for pessoa in duplicados:
+            ultimo, *anteriores = abertos.filter(pessoa=pessoa).order_by('-hora_entrada', '-pk')
+            # A pessoa saiu das salas anteriores ao entrar na última
+            fechados += abertos.filter(pk__in=[a.pk for a in anteriores]).update(
+                hora_saida=ultimo.hora_entrada
+            )
+
+        self.stdout.write(self.style.SUCCESS(f"{fechados} registros duplicados fechados."))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django_q.tasks import async_task
+from controle.models import Equipamento
+
+
+class Command(BaseCommand):
+    help = "Agenda a otimização das fotos de equipamentos que ainda não têm miniaturas"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--todas',
+            action='store_true',
+            help="Reprocessa todas as fotos, mesmo as que já têm miniaturas",
+        )
+
+    def handle(self, *args, **options):
+        equipamentos = Equipamento.objects.exclude(foto='').exclude(foto__isnull=True)
+        if not options['todas']:
+            equipamentos = equipamentos.filter(Q(foto_lista__isnull=True) | Q(foto_lista=''))
+
+        fotos = list(equipamentos.values_list('pk', 'foto'))
+        for pk, nome in fotos:
+            async_task('controle.tasks.otimizar_foto_equipamento', pk, nome)
+
+        self.stdout.write(self.style.SUCCESS(f"{len(fotos)} fotos agendadas para otimização."))
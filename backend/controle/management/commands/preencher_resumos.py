@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError, transaction
+from controle.models import PessoaResumo
+from root.models import Pessoa
+
+# Pessoas recalculadas por UPDATE
+RESUMOS_LOTE = 1000
+
+
+class Command(BaseCommand):
+    help = "Preenche o PessoaResumo das pessoas que ainda não o têm, a partir do histórico"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--todos',
+            action='store_true',
+            help="Recalcula o resumo de todas as pessoas",
+        )
+
+    def handle(self, *args, **options):
+        pessoas = Pessoa.objects.order_by('pk')
+        if not options['todos']:
+            pessoas = pessoas.filter(resumo__isnull=True)
+
+        try:
+            ids = list(pessoas.values_list('pk', flat=True))
+        except DatabaseError:
+            # Banco novo, antes do primeiro migrate
+            self.stdout.write("Tabela de resumos ainda não existe; nada a fazer.")
+            return
+
+        for inicio in range(0, len(ids), RESUMOS_LOTE):
+            with transaction.atomic():
+                PessoaResumo.objects.atualizar(ids[inicio:inicio + RESUMOS_LOTE])
+            if options['verbosity'] > 1:
+                self.stdout.write(f"{min(inicio + RESUMOS_LOTE, len(ids))}/{len(ids)}")
+
+        self.stdout.write(self.style.SUCCESS(f"{len(ids)} resumos preenchidos."))
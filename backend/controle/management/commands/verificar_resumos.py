@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
+from controle.models import PessoaResumo
+from root.models import Pessoa
+
+CAMPOS_RESUMO = ['ultimo_acesso', 'ultima_sala', 'emprestimo_ativo', 'emprestimo_encerrado']
+
+
+class Command(BaseCommand):
+    help = "Compara o PessoaResumo de cada pessoa com o recálculo a partir do histórico"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--corrigir',
+            action='store_true',
+            help="Recalcula os resumos divergentes",
+        )
+
+    def handle(self, *args, **options):
+        calculado = PessoaResumo.objects.calculado(ref='pk')
+        gravado = {
+            'ultimo_acesso': F('resumo__ultimo_acesso'),
+            'ultima_sala': F('resumo__ultima_sala'),
+            # Sem linha de resumo, a busca mostra os empréstimos como False
+            'emprestimo_ativo': Coalesce('resumo__emprestimo_ativo', Value(False)),
+            'emprestimo_encerrado': Coalesce('resumo__emprestimo_encerrado', Value(False)),
+        }
+        linhas = Pessoa.objects.annotate(
+            **{f'calculado_{campo}': valor for campo, valor in calculado.items()},
+            **{f'gravado_{campo}': valor for campo, valor in gravado.items()},
+        ).order_by('pk').values('pk', 'matricula', *(
+            f'{origem}_{campo}' for campo in CAMPOS_RESUMO for origem in ('calculado', 'gravado')
+        ))
+
+        divergentes = []
+        for linha in linhas.iterator(chunk_size=2000):
+            campos = [
+                campo for campo in CAMPOS_RESUMO
+                if linha[f'calculado_{campo}'] != linha[f'gravado_{campo}']
+            ]
+            if campos:
+                divergentes.append(linha['pk'])
+                self.stdout.write(f"{linha['matricula']}: {', '.join(campos)}")
+
+        if divergentes and options['corrigir']:
+            PessoaResumo.objects.atualizar(divergentes)
+            self.stdout.write(self.style.SUCCESS(f"{len(divergentes)} resumos corrigidos."))
+        elif divergentes:
+            self.stdout.write(self.style.WARNING(f"{len(divergentes)} resumos divergentes."))
+        else:
+            self.stdout.write(self.style.SUCCESS("Todos os resumos conferem."))
@@ -3,4 +3,5 @@ from .componentes import Componente
 from .compras import Compras, Orcamento
 from .emprestimos import Emprestimo, ItemEmprestimo
 from .equipamentos import Equipamento, Manutencao
-from .funcionarios import Ausencia, HorarioTrabalho
\ No newline at end of file
+from .funcionarios import Ausencia, HorarioTrabalho
+from .resumos import PessoaResumo
\ No newline at end of file
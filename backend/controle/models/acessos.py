@@ -1,6 +1,8 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q
 from django.utils import timezone
 from root.models import Pessoa, Sala
+from .resumos import PessoaResumo
 
 
 class ControleAcesso(models.Model):
@@ -10,12 +12,46 @@ class ControleAcesso(models.Model):
     hora_entrada = models.DateTimeField(default=timezone.now)
     hora_saida = models.DateTimeField(blank=True, null=True)
 
+    def save(self, *args, **kwargs):
+        # O registro e o resumo são gravados juntos, ou nenhum dos dois
+        with transaction.atomic():
+            # Se o registro mudar de pessoa, o resumo da anterior também muda
+            pessoas = [self.pessoa_id]
+            if self.pk is not None:
+                pessoas += ControleAcesso.objects.filter(pk=self.pk).values_list('pessoa_id', flat=True)
+            super().save(*args, **kwargs)
+            PessoaResumo.objects.atualizar(pessoas, emprestimos=False)
+
+    def delete(self, *args, **kwargs):
+        pessoa_id = self.pessoa_id
+        with transaction.atomic():
+            resultado = super().delete(*args, **kwargs)
+            PessoaResumo.objects.atualizar([pessoa_id], emprestimos=False)
+        return resultado
+
     def __str__(self):
         return f"{self.pessoa} - {self.sala}"
 
     class Meta:
         verbose_name = 'Registro'
         verbose_name_plural = 'Registros'
+        # Só os registros em aberto são varridos pela saída automática
+        indexes = [
+            models.Index(
+                fields=['hora_entrada'],
+                name='acesso_aberto_entrada_idx',
+                condition=Q(hora_saida__isnull=True),
+            ),
+        ]
+        # Uma pessoa só pode ter um registro em aberto; o índice também
+        # atende às buscas do registro aberto de uma pessoa
+        constraints = [
+            models.UniqueConstraint(
+                fields=['pessoa'],
+                name='acesso_aberto_unico_pessoa',
+                condition=Q(hora_saida__isnull=True),
+            ),
+        ]
 
 class ControleBolsistas(models.Model):
     pessoa = models.ForeignKey(Pessoa, on_delete=models.SET_NULL, null=True,
@@ -1,4 +1,5 @@
 from django.db import models
+from root.storage import ArquivoConteudoField
 
 class Componente(models.Model):
 
@@ -35,7 +36,7 @@ class Componente(models.Model):
     nome = models.CharField(max_length=35, default="")
     descricao = models.CharField(max_length=100, default="")
     quantidade = models.PositiveSmallIntegerField()
-    datasheet = models.FileField(blank=True, null=True)
+    datasheet = ArquivoConteudoField(blank=True, null=True)
     categoria = models.CharField(
         max_length=15,
         choices=Categoria.choices,
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django.db import models
 from django.utils import timezone
+from root.storage import ArquivoConteudoField
 
 
 class Compras(models.Model):
@@ -66,7 +67,7 @@ class Orcamento(models.Model):
     data = models.DateField()
     preco = models.DecimalField(max_digits=6, decimal_places=2)
     website = models.URLField(max_length=200)
-    anexo = models.FileField()
+    anexo = ArquivoConteudoField()
 
     class Meta:
         verbose_name = 'Orçamento'
@@ -1,9 +1,11 @@
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import Exists, OuterRef
 from django.utils import timezone
 from root.models import Pessoa
 from .equipamentos import Equipamento
+from .resumos import PessoaResumo
 
 
 class Emprestimo(models.Model):
@@ -19,6 +21,23 @@ class Emprestimo(models.Model):
     encerrado = models.BooleanField(default=False)
     devolucao = models.DateTimeField(blank=True, null=True)
 
+    def save(self, *args, **kwargs):
+        # O empréstimo e o resumo são gravados juntos, ou nenhum dos dois
+        with transaction.atomic():
+            # Se o empréstimo mudar de responsável, o resumo do anterior também muda
+            pessoas = [self.responsavel_id]
+            if self.pk is not None:
+                pessoas += Emprestimo.objects.filter(pk=self.pk).values_list('responsavel_id', flat=True)
+            super().save(*args, **kwargs)
+            PessoaResumo.objects.atualizar(pessoas, acessos=False)
+
+    def delete(self, *args, **kwargs):
+        responsavel_id = self.responsavel_id
+        with transaction.atomic():
+            resultado = super().delete(*args, **kwargs)
+            PessoaResumo.objects.atualizar([responsavel_id], acessos=False)
+        return resultado
+
     def __str__(self):
         return self.identificador
 
@@ -26,6 +45,108 @@ class Emprestimo(models.Model):
         verbose_name = 'Empréstimo'
         verbose_name_plural = "Empréstimos"
 
+
+class ItemEmprestimoManager(models.Manager):
+
+    def criar_itens(self, emprestimo, items):
+        """
+        Cria os itens de `emprestimo` a partir de patrimônios ou nomes: os
+        que correspondem a um Equipamento o referenciam, os demais ficam pelo
+        nome. Uma consulta resolve todos os patrimônios e um único INSERT
+        grava os itens; itens em branco são ignorados.
+        """
+        nomes = [nome for nome in (str(item).strip() for item in items) if nome]
+        equipamentos = Equipamento.objects.in_bulk(set(nomes), field_name='patrimonio')
+
+        tamanho = self.model._meta.get_field('nome').max_length
+        longos = [nome for nome in nomes if nome not in equipamentos and len(nome) > tamanho]
+        if longos:
+            raise ValidationError(
+                f'O nome do item deve ter no máximo {tamanho} caracteres: {longos[0]}'
+            )
+
+        return self.bulk_create([
+            self.model(emprestimo=emprestimo, equipamento=equipamentos[nome])
+            if nome in equipamentos else
+            self.model(emprestimo=emprestimo, nome=nome)
+            for nome in nomes
+        ])
+
+    def pendentes_por_nome(self, emprestimo, nomes):
+        """
+        Um item pendente de `emprestimo` para cada nome ou patrimônio em
+        `nomes`, procurando primeiro pelo nome. Cada item é usado uma só vez,
+        na ordem em que foi emprestado.
+
+        Devolve (itens, nomes sem item pendente).
+        """
+        livres = list(
+            self.filter(emprestimo=emprestimo, devolvido=False)
+            .select_related('equipamento').order_by('pk')
+        )
+
+        itens, faltando = [], []
+        for nome in (str(nome).strip() for nome in nomes):
+            item = next((i for i in livres if i.nome == nome), None) or next(
+                (i for i in livres if i.equipamento and i.equipamento.patrimonio == nome),
+                None,
+            )
+            if item is None:
+                faltando.append(nome)
+            else:
+                livres.remove(item)
+                itens.append(item)
+
+        return itens, faltando
+
+    def devolver(self, emprestimo, recebente, itens=None):
+        """
+        Registra a devolução dos `itens` de `emprestimo` (todos os pendentes,
+        se omitidos) com um único UPDATE ... RETURNING, e encerra o empréstimo
+        se não sobrar item pendente. `emprestimo` deve ter sido travado com
+        select_for_update na transação atual, para que devoluções simultâneas
+        não deixem de encerrá-lo.
+
+        Devolve os ids dos itens devolvidos.
+        """
+        agora = timezone.now()
+        sql = (
+            f"UPDATE {self.model._meta.db_table} "
+            "SET devolvido = %s, devolucao = %s, recebente_id = %s "
+            "WHERE emprestimo_id = %s AND devolvido = %s"
+        )
+        params = [
+            True, connection.ops.adapt_datetimefield_value(agora), recebente.pk,
+            emprestimo.pk, False,
+        ]
+        if itens is not None:
+            if not itens:
+                return []
+            sql += f" AND id IN ({', '.join(['%s'] * len(itens))})"
+            params += [item.pk for item in itens]
+
+        # Itens, encerramento e resumo são gravados juntos, ou nada
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql + " RETURNING id", params)
+                devolvidos = [linha[0] for linha in cursor.fetchall()]
+
+            pendentes = self.filter(emprestimo=OuterRef('pk'), devolvido=False)
+            encerrado = Emprestimo.objects.filter(
+                ~Exists(pendentes), pk=emprestimo.pk, encerrado=False
+            ).update(encerrado=True, devolucao=agora)
+            if encerrado:
+                PessoaResumo.objects.atualizar([emprestimo.responsavel_id], acessos=False)
+
+        for item in itens or []:
+            if item.pk in devolvidos:
+                item.devolvido, item.devolucao, item.recebente = True, agora, recebente
+        if encerrado:
+            emprestimo.encerrado, emprestimo.devolucao = True, agora
+
+        return devolvidos
+
+
 class ItemEmprestimo(models.Model):
     emprestimo = models.ForeignKey(
         Emprestimo, on_delete=models.SET_NULL, null=True, related_name='emprestimo'
@@ -44,6 +165,8 @@ class ItemEmprestimo(models.Model):
     devolvido = models.BooleanField(default=False)
     devolucao = models.DateTimeField(blank=True, null=True)
 
+    objects = ItemEmprestimoManager()
+
     def clean(self):
         if not self.equipamento and not self.nome:
             raise ValidationError('Ao menos "equipamento" ou "nome" deve constar.')
@@ -1,11 +1,9 @@
 from django.contrib.auth.models import User
-from django.core.files.base import ContentFile
-from django.db import models
+from django.db import models, transaction
 from django.utils import timezone
-from PIL import Image
+from django_q.tasks import async_task
 from root.models import Sala
-import io
-import os
+from root.storage import ArquivoConteudoField
 
 
 class Equipamento(models.Model):
@@ -21,42 +19,45 @@ class Equipamento(models.Model):
     sala = models.ForeignKey(Sala, on_delete=models.SET_NULL, null=True, blank=True)
     defeito = models.BooleanField(default=False)
     foto = models.ImageField(blank=True, null=True)
-    manual = models.FileField(blank=True, null=True)
+    foto_lista = models.ImageField(blank=True, null=True, editable=False)
+    foto_detalhe = models.ImageField(blank=True, null=True, editable=False)
+    manual = ArquivoConteudoField(blank=True, null=True)
 
     def __str__(self):
         return f"{self.nome} ({self.patrimonio})"
 
     def save(self, *args, **kwargs):
-        """ Optimize image by converting to WebP, 80% quality """
-
-        if self.foto:
-            try:
-                orig_path = self.foto.path
-                has_orig = True
-            except ValueError:
-                has_orig = False
-
-            foto_webp = Image.open(self.foto)
-
-            foto_io = io.BytesIO()
-
-            foto_webp.save(foto_io, format='WebP', quality=80)
-
-            foto_file = ContentFile(
-                foto_io.getvalue(),
-                name=f"{os.path.splitext(self.foto.name)[0]}.webp"
+        """
+        Agenda a otimização da foto (WebP e miniaturas) quando um novo
+        arquivo é enviado; edições que não mexem na foto não a reprocessam.
+        """
+        foto_nova = bool(self.foto) and not self.foto._committed
+
+        # Miniaturas da foto anterior (ou de uma foto removida) ficam
+        # obsoletas; os arquivos só são apagados depois que o registro sem
+        # elas for gravado
+        obsoletas = []
+        if foto_nova or not self.foto:
+            obsoletas = [m.name for m in (self.foto_lista, self.foto_detalhe) if m]
+            self.foto_lista = self.foto_detalhe = None
+
+        super().save(*args, **kwargs)
+
+        if obsoletas:
+            storage = self._meta.get_field('foto_lista').storage
+
+            def apagar_miniaturas():
+                for nome in obsoletas:
+                    storage.delete(nome)
+
+            transaction.on_commit(apagar_miniaturas)
+
+        if foto_nova:
+            pk, nome = self.pk, self.foto.name
+            transaction.on_commit(
+                lambda: async_task('controle.tasks.otimizar_foto_equipamento', pk, nome)
             )
 
-            self.foto.save(foto_file.name, foto_file, save=False)
-
-            super().save(*args, **kwargs)
-
-            # Remove the original, unoptimized image
-            if has_orig and os.path.exists(orig_path):
-                os.remove(orig_path)
-        else:
-            super().save(*args, **kwargs)
-
     class Meta:
         verbose_name = 'Equipamento'
         verbose_name_plural = 'Equipamentos'
@@ -0,0 +1,71 @@
+from django.apps import apps
+from django.db import models
+from django.db.models import Exists, OuterRef, Subquery
+from root.models import Pessoa, Sala
+
+
+class PessoaResumoManager(models.Manager):
+
+    def calculado(self, ref='pessoa', acessos=True, emprestimos=True):
+        """
+        Expressões que recalculam cada campo do resumo a partir do histórico,
+        para a pessoa em OuterRef(`ref`).
+        """
+        ControleAcesso = apps.get_model('controle', 'ControleAcesso')
+        Emprestimo = apps.get_model('controle', 'Emprestimo')
+
+        valores = {}
+        if acessos:
+            ultimo = ControleAcesso.objects.filter(
+                pessoa=OuterRef(ref)
+            ).order_by('-hora_entrada', '-pk')
+            valores['ultimo_acesso'] = Subquery(ultimo.values('hora_entrada')[:1])
+            valores['ultima_sala'] = Subquery(ultimo.values('sala')[:1])
+        if emprestimos:
+            valores['emprestimo_ativo'] = Exists(
+                Emprestimo.objects.filter(responsavel=OuterRef(ref), encerrado=False)
+            )
+            valores['emprestimo_encerrado'] = Exists(
+                Emprestimo.objects.filter(responsavel=OuterRef(ref), encerrado=True)
+            )
+        return valores
+
+    def atualizar(self, pessoas, acessos=True, emprestimos=True):
+        """
+        Recalcula o resumo das pessoas com ids em `pessoas`, criando os que
+        faltam: uma inserção e um UPDATE, qualquer que seja o número de pessoas.
+        """
+        ids = {pk for pk in pessoas if pk is not None}
+        if not ids or not (acessos or emprestimos):
+            return
+
+        self.bulk_create([self.model(pessoa_id=pk) for pk in ids], ignore_conflicts=True)
+        self.filter(pessoa__in=ids).update(
+            **self.calculado(acessos=acessos, emprestimos=emprestimos)
+        )
+
+
+class PessoaResumo(models.Model):
+    """
+    Último acesso e situação de empréstimos de cada pessoa, mantidos a cada
+    escrita em ControleAcesso e Emprestimo para que a busca de pessoas leia
+    uma única linha. `manage.py verificar_resumos` compara com o histórico.
+    """
+    pessoa = models.OneToOneField(
+        Pessoa, on_delete=models.CASCADE, primary_key=True, related_name='resumo'
+    )
+    ultimo_acesso = models.DateTimeField(blank=True, null=True)
+    ultima_sala = models.ForeignKey(
+        Sala, on_delete=models.SET_NULL, null=True, blank=True, related_name='+'
+    )
+    emprestimo_ativo = models.BooleanField(default=False)
+    emprestimo_encerrado = models.BooleanField(default=False)
+
+    objects = PessoaResumoManager()
+
+    def __str__(self):
+        return str(self.pessoa)
+
+    class Meta:
+        verbose_name = 'Resumo de Pessoa'
+        verbose_name_plural = 'Resumos de Pessoas'
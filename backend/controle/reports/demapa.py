@@ -0,0 +1,144 @@
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from io import BytesIO
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import cm
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+import hashlib
+import json
+
+# Incrementar ao mudar o layout, para não servir PDFs antigos do cache
+DEMAPA_VERSAO = 2
+
+# Pasta do storage com os PDFs agregados gerados em segundo plano
+DEMAPA_PASTA = "demapa"
+
+
+def chave_demapa(objs):
+    """
+    Hash dos registros de Compras (conteúdo e ordem) usados no documento.
+    """
+    conteudo = json.dumps(
+        [DEMAPA_VERSAO, list(objs.values())], default=str, sort_keys=True
+    )
+    return hashlib.sha256(conteudo.encode()).hexdigest()
+
+
+def caminho_demapa(chave):
+    return f"{DEMAPA_PASTA}/{chave}.pdf"
+
+
+# Estilos montados uma única vez no import e nunca alterados depois, para
+# não reconstruir a folha de estilos (nem mutar o 'Normal' compartilhado)
+# a cada documento
+ESTILO_CONTEUDO = ParagraphStyle(
+    'DemapaConteudo',
+    parent=getSampleStyleSheet()['Normal'],
+    fontSize=9,
+    leading=11
+)
+
+LARGURAS_COLUNAS = (2.5*cm, 5.5*cm, 2.5*cm, 2.5*cm, 3.5*cm, 2.5*cm)
+
+COMANDOS_QUADRO = (
+    ('GRID', (0,0), (-1,-1), 0.5, colors.black),
+    ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+    ('FONTNAME', (0,0), (-1,-1), 'Helvetica'),
+    ('FONTSIZE', (0,0), (-1,-1), 9),
+
+    ('BACKGROUND', (0,0), (0,0), colors.whitesmoke),
+    ('BACKGROUND', (2,0), (2,0), colors.whitesmoke),
+    ('BACKGROUND', (4,0), (4,0), colors.whitesmoke),
+
+    ('SPAN', (1,1), (5,1)), # Descrição content
+    ('SPAN', (1,2), (5,2)), # Justificativa content
+    ('SPAN', (3,3), (5,3)), # Fonte header
+    ('SPAN', (0,4), (0,5)), # Budget 1 name
+    ('SPAN', (1,5), (5,5)), # Budget 1 URL
+    ('SPAN', (3,4), (5,4)), # Budget 1 source selection
+    ('SPAN', (0,6), (0,7)), # Budget 2 name
+    ('SPAN', (1,7), (5,7)), # Budget 2 URL
+    ('SPAN', (3,6), (5,6)), # Budget 2 source selection
+    ('SPAN', (0,8), (0,9)), # Budget 3 name
+    ('SPAN', (1,9), (5,9)), # Budget 3 URL
+    ('SPAN', (3,8), (5,8)), # Budget 3 source selection
+
+    ('ALIGN', (0,0), (-1,-1), 'LEFT'),
+    ('ALIGN', (2,0), (5,0), 'CENTER'),
+    ('ALIGN', (0,0), (0,-1), 'CENTER'), # Labels col 0
+)
+
+ESTILO_QUADRO = TableStyle(COMANDOS_QUADRO)
+
+# No documento agregado, cada quadro fica inteiro numa página
+ESTILO_QUADRO_AGREGADO = TableStyle(
+    COMANDOS_QUADRO + (('NOSPLIT', (0,0), (-1,-1)),)
+)
+
+
+def _preco_maximo(obj):
+    """ Preço máximo salvo ou, na falta dele, a média dos orçamentos + 20% """
+    prices = [p for p in [obj.preco_orcamento_1, obj.preco_orcamento_2, obj.preco_orcamento_3] if p is not None]
+    preco_maximo = obj.preco_maximo
+    if (preco_maximo is None or preco_maximo == 0) and prices:
+        avg = sum(prices) / 3
+        preco_maximo = round(float(avg) * 1.2, 2)
+    return preco_maximo
+
+
+def _linhas_orcamento(empresa, data_cons, preco, url, fonte):
+    source_str = " ".join([
+        f"{'(x)' if fonte == 'website' else '( )'} website",
+        f"{'(x)' if fonte == 'telefone' else '( )'} telefone",
+        f"{'(x)' if fonte == 'email' else '( )'} email"
+    ])
+    return [
+        [empresa or "", data_cons.strftime('%d/%m/%Y') if data_cons else "", f"R$ {preco or '0,00'}", source_str, "", ""],
+        ["", Paragraph(f"<b>Fonte:</b> {url or ''}", ESTILO_CONTEUDO), "", "", "", ""],
+    ]
+
+
+def _quadro_demapa(obj, estilo):
+    data = [
+        ["Nome do item", Paragraph(obj.titulo, ESTILO_CONTEUDO), "Quantidade", str(obj.quantidade), "Preço Máximo\n(R$)", f"R$ {_preco_maximo(obj) or '0,00'}"],
+        ["Descrição", Paragraph((obj.descricao or '').replace('\n', '<br/>'), ESTILO_CONTEUDO), "", "", "", ""],
+        ["Justificativa", Paragraph((obj.justificativa or '').replace('\n', '<br/>'), ESTILO_CONTEUDO), "", "", "", ""],
+        ["Empresa\nConsultada", "Data da Consulta", "Preço (R$)", "Fonte", "", ""],
+    ]
+    data += _linhas_orcamento(obj.empresa_orcamento_1, obj.data_orcamento_1, obj.preco_orcamento_1, obj.url_orcamento_1, obj.fonte_orcamento_1)
+    data += _linhas_orcamento(obj.empresa_orcamento_2, obj.data_orcamento_2, obj.preco_orcamento_2, obj.url_orcamento_2, obj.fonte_orcamento_2)
+    data += _linhas_orcamento(obj.empresa_orcamento_3, obj.data_orcamento_3, obj.preco_orcamento_3, obj.url_orcamento_3, obj.fonte_orcamento_3)
+
+    table = Table(data, colWidths=LARGURAS_COLUNAS, repeatRows=0)
+    table.setStyle(estilo)
+    return table
+
+
+def render_demapa(objs, arquivo, agregado=False):
+    """
+    Escreve em `arquivo` o DEMAPA com um quadro por item de `objs`.
+    Serve tanto para um único item quanto para o documento agregado, em
+    que os quadros não são quebrados entre páginas (mesmo com um só item).
+    """
+    doc = SimpleDocTemplate(arquivo, pagesize=A4, rightMargin=20, leftMargin=20, topMargin=20, bottomMargin=20)
+    estilo = ESTILO_QUADRO_AGREGADO if agregado else ESTILO_QUADRO
+
+    elements = []
+    for i, obj in enumerate(objs):
+        if i:
+            elements.append(Spacer(1, 1*cm)) # Add margin between items
+        elements.append(_quadro_demapa(obj, estilo))
+
+    doc.build(elements)
+
+
+def salvar_demapa_agregado(objs, chave):
+    """ Gera o DEMAPA agregado e o guarda no storage, se ainda não existir """
+    caminho = caminho_demapa(chave)
+    if not default_storage.exists(caminho):
+        buffer = BytesIO()
+        render_demapa(objs, buffer, agregado=True)
+        default_storage.save(caminho, ContentFile(buffer.getvalue()))
+    return caminho
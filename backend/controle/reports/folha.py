@@ -0,0 +1,105 @@
+from datetime import datetime
+from reportlab.graphics.barcode.code39 import Standard39
+from reportlab.lib.pagesizes import A4
+from reportlab.pdfgen import canvas
+
+# Limite por requisição, para uma única folha não ocupar o worker
+FOLHA_MAX_PAGINAS = 50
+
+FOLHA_COLUNAS = 3
+FOLHA_LINHAS = 9
+FOLHA_MARGEM = 28
+
+# Caixa ocupada pelo código de barras (barras + número) em cada célula
+CODIGO_LARGURA, CODIGO_ALTURA = 113, 62
+CODIGO_FONTE = 9
+
+TEXTO_TAMANHO = 12
+TEXTO_PIPE = '|'
+TEXTO_ASSINATURA = '__________'
+TEXTO_RETDEV = 'Retirada / Devolução'
+TEXTO_RODAPE = "NUPEDEE - Autenticação de Registros de Empréstimo"
+
+
+def _desenhar_codigo(c, valor, x, y):
+    """
+    Desenha o Code39 de `valor` como vetor, preenchendo a largura da caixa
+    que começa em (x, y), com o número legível logo abaixo das barras.
+    """
+    # A largura do código é proporcional a barWidth
+    largura_unitaria = Standard39(valor, barWidth=1, checksum=0, quiet=0).width
+
+    codigo = Standard39(
+        valor,
+        barWidth=CODIGO_LARGURA / largura_unitaria,
+        barHeight=CODIGO_ALTURA - CODIGO_FONTE - 3,
+        checksum=0,
+        quiet=0,
+        humanReadable=True,
+        fontSize=CODIGO_FONTE,
+    )
+    codigo.drawOn(c, x, y + CODIGO_FONTE + 3)
+
+
+def render_folha_emprestimo(inicio, paginas, arquivo):
+    """
+    Escreve em `arquivo` `paginas` folhas de etiquetas de empréstimo,
+    numeradas a partir de `inicio`.
+    """
+    c = canvas.Canvas(arquivo, pagesize=A4)
+    width, height = A4
+
+    cell_width = (width - 2 * FOLHA_MARGEM) / FOLHA_COLUNAS
+    cell_height = (height - 2 * FOLHA_MARGEM) / FOLHA_LINHAS
+
+    text_pipe_w = c.stringWidth(TEXTO_PIPE, "Helvetica", TEXTO_TAMANHO)
+    text_sign_w = c.stringWidth(TEXTO_ASSINATURA, "Helvetica", TEXTO_TAMANHO)
+    text_retdev_w = c.stringWidth(TEXTO_RETDEV, "Helvetica", TEXTO_TAMANHO)
+    text_date = datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+
+    codigo = inicio
+
+    for page in range(1, paginas + 1):
+        c.setFont("Helvetica", TEXTO_TAMANHO)
+
+        for i in range(FOLHA_COLUNAS + 1):
+            x = FOLHA_MARGEM + i * cell_width
+            c.line(x, FOLHA_MARGEM, x, height - FOLHA_MARGEM)
+
+        for j in range(FOLHA_LINHAS + 1):
+            y = FOLHA_MARGEM + j * cell_height
+            c.line(FOLHA_MARGEM, y, width - FOLHA_MARGEM, y)
+
+        for row in range(FOLHA_LINHAS):
+            for col in range(FOLHA_COLUNAS):
+                x = FOLHA_MARGEM + col * cell_width
+                y = FOLHA_MARGEM + (FOLHA_LINHAS - row - 1) * cell_height
+
+                cell_center_x = x + cell_width / 2
+                cell_center_y = y + cell_height / 2
+
+                centered_pipe_x = cell_center_x - text_pipe_w / 2
+                centered_sign_x = cell_center_x - text_sign_w / 2
+                centered_retdev_x = cell_center_x - text_retdev_w / 2
+                centered_y = cell_center_y - TEXTO_TAMANHO / 2
+
+                _desenhar_codigo(
+                    c,
+                    str(codigo),
+                    cell_center_x - CODIGO_LARGURA / 2,
+                    cell_center_y - CODIGO_ALTURA / 2 + 10,
+                )
+                codigo += 1
+
+                c.drawString(centered_sign_x - 35, centered_y - 20, TEXTO_ASSINATURA)
+                c.drawString(centered_pipe_x, centered_y - 25, TEXTO_PIPE)
+                c.drawString(centered_sign_x + 35, centered_y - 20, TEXTO_ASSINATURA)
+                c.drawString(centered_retdev_x + 5, centered_y - 35, TEXTO_RETDEV)
+
+        c.drawString(50, 820, text_date)
+        c.drawString(50, 10, TEXTO_RODAPE)
+        c.drawString(500, 10, f"{page}/{paginas}")
+
+        c.showPage()
+
+    c.save()
@@ -1,23 +1,120 @@
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import F, Q
 from django.utils import timezone
 from datetime import timedelta
-from controle.models import ControleAcesso
+from controle.imagens import (
+    FOTO_TAMANHO_DETALHE,
+    FOTO_TAMANHO_LISTA,
+    FOTO_TAMANHO_MAX,
+    abrir_imagem,
+    webp_reduzida,
+)
+from controle.models import Compras, ControleAcesso, Equipamento
+from controle.reports.demapa import DEMAPA_PASTA, salvar_demapa_agregado
+from root.models import Sala
+import os
+
+# Limite dos registros sem sala, igual ao padrão de Sala.horas_saida_automatica
+SAIDA_AUTOMATICA_HORAS = 4
 
 
 def registrar_saida_automatica():
     """
-    Registra a saída automática de pessoas que entraram há mais de 4 horas
-    e não tiveram sua saída registrada.
+    Registra a saída automática de pessoas que entraram há mais horas que o
+    limite da sala (Sala.horas_saida_automatica) e não tiveram sua saída
+    registrada. A saída fica em hora_entrada + limite.
     """
-    limite = timezone.now() - timedelta(hours=4)
-    registros_pendentes = ControleAcesso.objects.filter(
-        hora_saida__isnull=True,
-        hora_entrada__lt=limite
-    )
+    agora = timezone.now()
 
-    count = registros_pendentes.count()
-    for registro in registros_pendentes:
-        # Define a hora de saída como 4 horas após o horário de entrada
-        registro.hora_saida = registro.hora_entrada + timedelta(hours=4)
-        registro.save()
+    # Um UPDATE por limite distinto (na prática, um ou dois)
+    filtros = {
+        horas: Q(sala__horas_saida_automatica=horas)
+        for horas in Sala.objects.order_by().values_list('horas_saida_automatica', flat=True).distinct()
+    }
+    filtros[SAIDA_AUTOMATICA_HORAS] = filtros.get(SAIDA_AUTOMATICA_HORAS, Q()) | Q(sala__isnull=True)
+
+    count = 0
+    for horas, filtro in filtros.items():
+        limite = timedelta(hours=horas)
+        count += ControleAcesso.objects.filter(
+            filtro, hora_saida__isnull=True, hora_entrada__lt=agora - limite
+        ).update(hora_saida=F('hora_entrada') + limite)
 
     return f"Registradas {count} saídas automáticas."
+
+
+def gerar_demapa_agregado(ids, chave):
+    """
+    Gera em segundo plano o DEMAPA agregado dos itens de Compras `ids`,
+    guardando-o no storage sob `chave`.
+    """
+    objs = Compras.objects.filter(id__in=ids).order_by('titulo', 'pk')
+    return salvar_demapa_agregado(objs, chave)
+
+
+def limpar_demapas_antigos():
+    """
+    Apaga os DEMAPAs agregados gerados há mais de DEMAPA_RETENCAO_HORAS.
+    Um pedido depois disso simplesmente gera o documento de novo.
+    """
+    if not default_storage.exists(DEMAPA_PASTA):
+        return "Nenhum DEMAPA para apagar."
+
+    limite = timezone.now() - timedelta(hours=settings.DEMAPA_RETENCAO_HORAS)
+    _, arquivos = default_storage.listdir(DEMAPA_PASTA)
+
+    count = 0
+    for arquivo in arquivos:
+        caminho = f"{DEMAPA_PASTA}/{arquivo}"
+        if default_storage.get_modified_time(caminho) < limite:
+            default_storage.delete(caminho)
+            count += 1
+
+    return f"Apagados {count} DEMAPAs antigos."
+
+
+def otimizar_foto_equipamento(pk, nome):
+    """
+    Converte a foto `nome` do Equipamento `pk` para WebP (80% de qualidade,
+    com tamanho limitado) e gera as miniaturas de lista e de detalhe.
+    """
+    equipamento = Equipamento.objects.filter(pk=pk, foto=nome).first()
+    if equipamento is None:
+        return f"Foto {nome} não está mais em uso; nada a fazer."
+
+    with equipamento.foto.open('rb') as arquivo:
+        imagem = abrir_imagem(arquivo)
+        imagem.load()
+
+    miniaturas_antigas = [
+        m.name for m in (equipamento.foto_lista, equipamento.foto_detalhe) if m
+    ]
+
+    base = os.path.splitext(os.path.basename(nome))[0]
+    versoes = {
+        'foto': (f"{base}.webp", FOTO_TAMANHO_MAX),
+        'foto_lista': (f"{base}_lista.webp", FOTO_TAMANHO_LISTA),
+        'foto_detalhe': (f"{base}_detalhe.webp", FOTO_TAMANHO_DETALHE),
+    }
+    for campo, (nome_arquivo, tamanho) in versoes.items():
+        getattr(equipamento, campo).save(
+            nome_arquivo, ContentFile(webp_reduzida(imagem, tamanho)), save=False
+        )
+
+    # Só grava se a foto não foi trocada enquanto a tarefa rodava
+    atualizados = Equipamento.objects.filter(pk=pk, foto=nome).update(
+        **{campo: getattr(equipamento, campo).name for campo in versoes}
+    )
+    storage = equipamento.foto.storage
+    if not atualizados:
+        for campo in versoes:
+            storage.delete(getattr(equipamento, campo).name)
+        return f"Foto {nome} foi substituída durante a otimização."
+
+    # Remove o original, não otimizado, e miniaturas de um processamento anterior
+    for antigo in [nome, *miniaturas_antigas]:
+        storage.delete(antigo)
+
+    return f"Foto de {equipamento} otimizada."
@@ -1,3 +1,1137 @@
-from django.test import TestCase
+from aulas.models import Aula
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.test import Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import make_aware, now
+from django_q.models import Failure
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+from controle.api.exportacao import CAMPOS_ACESSOS, CAMPOS_EMPRESTIMOS
+from controle.models import (
+    Compras, ControleAcesso, Emprestimo, Equipamento, ItemEmprestimo, PessoaResumo,
+)
+from controle import tasks
+from controle.reports import demapa
+from root import utils
+from root.models import Pessoa, Sala
+import csv
+import json
+import logging
+import os
+import random
+import re
+import tempfile
+import time
 
-# Create your tests here.
+CACHE_LOCAL = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class ControleTestCase(TestCase):
+    """ Usuário autenticado e uma pessoa, comuns aos testes da API """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.usuario = User.objects.create_user(
+            'funcionario', password='senha', first_name='Ana', last_name='Lima'
+        )
+        cls.pessoa = Pessoa.objects.create(nome='Aluno', matricula='2020001')
+
+    def setUp(self):
+        self.client.force_login(self.usuario)
+
+    def criar_emprestimo(self, identificador, itens=(), equipamentos=()):
+        emprestimo = Emprestimo.objects.create(
+            identificador=identificador, responsavel=self.pessoa, funcionario=self.usuario,
+        )
+        ItemEmprestimo.objects.bulk_create(
+            [ItemEmprestimo(emprestimo=emprestimo, nome=nome) for nome in itens]
+            + [ItemEmprestimo(emprestimo=emprestimo, equipamento=e) for e in equipamentos]
+        )
+        return emprestimo
+
+
+class ListaEmprestimosTests(ControleTestCase):
+
+    def criar_emprestimos(self, quantidade):
+        inicio = Emprestimo.objects.count()
+        for i in range(inicio, inicio + quantidade):
+            equipamento = Equipamento.objects.create(nome=f'Multímetro {i}', patrimonio=f'P{i}')
+            self.criar_emprestimo(f'E{i}', itens=['Cabo', 'Fonte'], equipamentos=[equipamento])
+
+    def listar(self):
+        return self.client.get('/api/controle/emprestimos/', {'all': 'true'})
+
+    def test_consultas_nao_dependem_do_numero_de_emprestimos(self):
+        self.criar_emprestimos(10)
+        with CaptureQueriesContext(connection) as consultas:
+            self.assertEqual(len(self.listar().json()), 10)
+
+        self.criar_emprestimos(20)
+        with self.assertNumQueries(len(consultas)):
+            resposta = self.listar()
+        self.assertEqual(len(resposta.json()), 30)
+        self.assertEqual(resposta.json()[0]['items_nomes'].count(';'), 2)
+
+
+
+class PaginacaoCamposTests(ControleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(5):
+            Compras.objects.create(
+                titulo=f'Compra {i}', descricao='Cabos', quantidade=1, justificativa='Aulas',
+                origem='almox', tipo='consumo',
+            )
+
+    def listar(self, **params):
+        resposta = self.client.get('/api/controle/compras/', params)
+        self.assertEqual(resposta.status_code, 200)
+        return resposta.json()
+
+    def test_sem_parametros_a_lista_continua_completa(self):
+        dados = self.listar()
+        self.assertIsInstance(dados, list)
+        self.assertEqual(len(dados), 5)
+        self.assertEqual(dados[0]['funcionario_nome'], '')
+        self.assertIn('descricao', dados[0])
+
+    def test_page_size_e_cursor_paginam(self):
+        pagina = self.listar(page_size=2)
+        self.assertEqual(set(pagina), {'next', 'previous', 'results'})
+        titulos = [compra['titulo'] for compra in pagina['results']]
+
+        while pagina['next']:
+            pagina = self.client.get(pagina['next']).json()
+            titulos += [compra['titulo'] for compra in pagina['results']]
+        self.assertEqual(titulos, [f'Compra {i}' for i in reversed(range(5))])
+
+    def test_listas_com_list_proprio_tambem_paginam(self):
+        for i in range(3):
+            self.criar_emprestimo(f'E{i}')
+        self.assertEqual(len(self.client.get('/api/controle/emprestimos/').json()), 3)
+
+        pagina = self.client.get('/api/controle/emprestimos/', {'page_size': 2}).json()
+        self.assertEqual(
+            [emprestimo['identificador'] for emprestimo in pagina['results']], ['E2', 'E1']
+        )
+        self.assertIsNotNone(pagina['next'])
+
+    def test_fields_limita_a_resposta(self):
+        dados = self.listar(fields='id,titulo')
+        self.assertEqual([set(compra) for compra in dados], [{'id', 'titulo'}] * 5)
+
+        pagina = self.listar(fields='titulo', page_size=2)
+        self.assertEqual(pagina['results'], [{'titulo': 'Compra 4'}, {'titulo': 'Compra 3'}])
+
+    def test_fields_recusa_campo_desconhecido(self):
+        resposta = self.client.get('/api/controle/compras/', {'fields': 'titulo,senha'})
+        self.assertEqual(resposta.status_code, 400)
+        self.assertEqual(resposta.json(), {'detail': 'Campos desconhecidos: senha.'})
+
+    def test_fields_nao_vale_para_escrita(self):
+        compra = Compras.objects.first()
+        resposta = self.client.patch(
+            f'/api/controle/compras/{compra.pk}/?fields=titulo', {'estado': 'aprovado'},
+            content_type='application/json',
+        )
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta.json()['estado'], 'aprovado')
+
+
+class ScanAcessoTests(ControleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.sala = Sala.objects.create(numero='101', nome='Laboratório')
+
+    def setUp(self):
+        super().setUp()
+        # O mapa número -> id das salas é guardado no processo
+        for nome, valor in (
+            ('_salas_por_numero', {}), ('_salas_desconhecidas', set()),
+            ('_salas_carregadas_em', None),
+        ):
+            patcher = mock.patch.object(utils, nome, valor)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def scan(self, matricula='2020001', sala='101'):
+        return self.client.post(
+            '/api/controle/registros/scan/', {'matricula': matricula, 'sala': sala},
+            content_type='application/json',
+        )
+
+    def test_entrada(self):
+        resposta = self.scan()
+        self.assertEqual(resposta.status_code, 201)
+        self.assertEqual(resposta.json()['acao'], 'entrada')
+        registro = ControleAcesso.objects.get()
+        self.assertEqual((registro.pessoa, registro.sala), (self.pessoa, self.sala))
+        self.assertIsNone(registro.hora_saida)
+        self.assertEqual(self.pessoa.resumo.ultima_sala, self.sala)
+
+    def test_saida(self):
+        self.scan()
+        resposta = self.scan(sala=None)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta.json()['acao'], 'saida')
+        self.assertIsNotNone(ControleAcesso.objects.get().hora_saida)
+
+    def test_matricula_desconhecida(self):
+        resposta = self.scan(matricula='9999999')
+        self.assertEqual(resposta.status_code, 404)
+        self.assertFalse(ControleAcesso.objects.exists())
+
+    def test_matricula_ausente(self):
+        self.assertEqual(self.scan(matricula='').status_code, 400)
+
+    def test_sala_desconhecida(self):
+        resposta = self.scan(sala='999')
+        self.assertEqual(resposta.status_code, 400)
+        self.assertFalse(ControleAcesso.objects.exists())
+
+    def test_sala_desconhecida_fica_em_cache(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(utils.sala_id_por_numero('999'))
+            self.assertIsNone(utils.sala_id_por_numero('999'))
+            self.assertEqual(utils.sala_id_por_numero('101'), self.sala.pk)
+
+        # Criada depois, só é vista quando o mapa expira
+        nova = Sala.objects.create(numero='999')
+        self.assertIsNone(utils.sala_id_por_numero('999'))
+        utils._salas_carregadas_em -= utils.SALAS_CACHE_TTL + 1
+        self.assertEqual(utils.sala_id_por_numero('999'), nova.pk)
+
+    def test_saida_por_matricula(self):
+        self.scan()
+        resposta = self.client.patch(
+            '/api/controle/registros/bymatricula/', {'matricula': '2020001'},
+            content_type='application/json',
+        )
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(
+            (resposta.json()['pessoa_nome'], resposta.json()['sala_numero']), ('Aluno', '101')
+        )
+        self.assertIsNotNone(ControleAcesso.objects.get().hora_saida)
+
+        for matricula, detalhe in (
+            ('2020001', 'Acesso não encontrado.'), ('9999999', 'Aluno não encontrado.'),
+        ):
+            resposta = self.client.patch(
+                '/api/controle/registros/bymatricula/', {'matricula': matricula},
+                content_type='application/json',
+            )
+            self.assertEqual((resposta.status_code, resposta.json()['detail']), (404, detalhe))
+
+    def test_segundo_registro_aberto_recusado(self):
+        self.scan()
+        # Outra leitura simultânea da mesma matrícula não viu o registro aberto
+        with mock.patch('controle.api.views.registrar_saida', return_value=None):
+            resposta = self.scan()
+        self.assertEqual(resposta.status_code, 400)
+        self.assertEqual(ControleAcesso.objects.filter(hora_saida__isnull=True).count(), 1)
+
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ControleAcesso.objects.create(pessoa=self.pessoa, sala=self.sala)
+
+
+@skipUnless(os.environ.get('BENCHMARK'), "Defina BENCHMARK=1 para medir")
+class ScanCargaTests(TransactionTestCase):
+    """
+    Latência do scan numa troca de turma: 300 alunos saem das salas e outros
+    300 entram, em leituras simultâneas de vários balcões (no PostgreSQL).
+    """
+    ALUNOS = 300
+
+    def setUp(self):
+        patcher = mock.patch.object(utils, '_salas_carregadas_em', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.usuario = User.objects.create_user('funcionario')
+        self.salas = [Sala.objects.create(numero=str(numero)) for numero in (101, 102, 201, 202)]
+        pessoas = Pessoa.objects.bulk_create(
+            Pessoa(nome=f'Aluno {i}', matricula=str(2020000 + i)) for i in range(2 * self.ALUNOS)
+        )
+        ControleAcesso.objects.bulk_create(
+            ControleAcesso(pessoa=pessoa, sala=self.salas[i % 2])
+            for i, pessoa in enumerate(pessoas[:self.ALUNOS])
+        )
+        self.leituras = [
+            (pessoa.matricula, self.salas[2 + i % 2].numero if i >= self.ALUNOS else None)
+            for i, pessoa in enumerate(pessoas)
+        ]
+        random.Random(0).shuffle(self.leituras)
+
+    def balcao(self, leituras):
+        """ Um balcão lendo `leituras` em sequência; devolve (status, segundos) """
+        try:
+            client = Client()
+            client.force_login(self.usuario)
+            resultados = []
+            for matricula, sala in leituras:
+                inicio = time.perf_counter()
+                resposta = client.post(
+                    '/api/controle/registros/scan/', {'matricula': matricula, 'sala': sala},
+                    content_type='application/json',
+                )
+                resultados.append((resposta.status_code, time.perf_counter() - inicio))
+            return resultados
+        finally:
+            connection.close()
+
+    def test_troca_de_turma(self):
+        # O SQLite serializa as escritas; lá só um balcão por vez
+        balcoes = 8 if connection.vendor == 'postgresql' else 1
+        lotes = [self.leituras[i::balcoes] for i in range(balcoes)]
+
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(balcoes) as executor:
+            resultados = [r for lote in executor.map(self.balcao, lotes) for r in lote]
+        total = time.perf_counter() - inicio
+
+        self.assertEqual(
+            sorted({status for status, _ in resultados}), [200, 201]
+        )
+        self.assertEqual(
+            set(ControleAcesso.objects.filter(hora_saida__isnull=True).values_list('sala', flat=True)),
+            {sala.pk for sala in self.salas[2:]},
+        )
+
+        tempos = sorted(segundos * 1000 for _, segundos in resultados)
+        p50, p95 = tempos[len(tempos) // 2], tempos[int(len(tempos) * 0.95)]
+        print(f"\n{len(tempos)} leituras em {balcoes} balcões: {total:.2f} s, "
+              f"p50 {p50:.1f} ms, p95 {p95:.1f} ms, máximo {tempos[-1]:.1f} ms")
+
+
+class AcessosDuplicadosTests(TransactionTestCase):
+    """ Bancos anteriores à constraint acesso_aberto_unico_pessoa """
+
+    def setUp(self):
+        self.constraint = next(
+            c for c in ControleAcesso._meta.constraints if c.name == 'acesso_aberto_unico_pessoa'
+        )
+        with connection.schema_editor() as editor:
+            editor.remove_constraint(ControleAcesso, self.constraint)
+        self.removida = True
+        self.addCleanup(self.recriar)
+
+    def recriar(self):
+        if self.removida:
+            with connection.schema_editor() as editor:
+                editor.add_constraint(ControleAcesso, self.constraint)
+            self.removida = False
+
+    def test_fecha_os_abertos_extras(self):
+        pessoa, outra = (
+            Pessoa.objects.create(nome=nome, matricula=matricula)
+            for nome, matricula in (('Aluno', '2020001'), ('Outro aluno', '2020002'))
+        )
+        inicio = make_aware(datetime(2030, 3, 4, 8))
+        antigos = [
+            ControleAcesso.objects.create(pessoa=pessoa, hora_entrada=inicio + timedelta(hours=h))
+            for h in (0, 1)
+        ]
+        ultimo = ControleAcesso.objects.create(pessoa=pessoa, hora_entrada=inicio + timedelta(hours=2))
+        fechado = ControleAcesso.objects.create(
+            pessoa=pessoa, hora_entrada=inicio - timedelta(days=1), hora_saida=inicio,
+        )
+        unico = ControleAcesso.objects.create(pessoa=outra, hora_entrada=inicio)
+        sem_pessoa = [ControleAcesso.objects.create(pessoa=None, hora_entrada=inicio) for _ in range(2)]
+
+        saida = StringIO()
+        call_command('fechar_acessos_duplicados', stdout=saida)
+        self.assertIn("2 registros duplicados fechados.", saida.getvalue())
+
+        for registro in antigos:
+            registro.refresh_from_db()
+            self.assertEqual(registro.hora_saida, ultimo.hora_entrada)
+        for registro in (ultimo, unico, *sem_pessoa):
+            registro.refresh_from_db()
+            self.assertIsNone(registro.hora_saida)
+        fechado.refresh_from_db()
+        self.assertEqual(fechado.hora_saida, inicio)
+
+        # Agora a constraint pode ser criada
+        self.recriar()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            ControleAcesso.objects.create(pessoa=pessoa)
+
+    def test_sem_duplicados_nao_muda_nada(self):
+        pessoa = Pessoa.objects.create(nome='Aluno', matricula='2020001')
+        registro = ControleAcesso.objects.create(pessoa=pessoa)
+
+        saida = StringIO()
+        call_command('fechar_acessos_duplicados', stdout=saida)
+        self.assertIn("0 registros duplicados fechados.", saida.getvalue())
+        registro.refresh_from_db()
+        self.assertIsNone(registro.hora_saida)
+
+
+class ResumoPessoaTests(ControleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.outra = Pessoa.objects.create(nome='Outro aluno', matricula='2020002')
+        cls.sala = Sala.objects.create(numero='101', nome='Laboratório')
+
+    def resumo(self, pessoa):
+        return PessoaResumo.objects.get(pessoa=pessoa)
+
+    def test_registro_trocado_de_pessoa_atualiza_as_duas(self):
+        registro = ControleAcesso.objects.create(pessoa=self.pessoa, sala=self.sala)
+        self.assertEqual(self.resumo(self.pessoa).ultima_sala, self.sala)
+
+        registro.pessoa = self.outra
+        registro.save()
+        self.assertIsNone(self.resumo(self.pessoa).ultimo_acesso)
+        self.assertIsNone(self.resumo(self.pessoa).ultima_sala)
+        self.assertEqual(self.resumo(self.outra).ultimo_acesso, registro.hora_entrada)
+
+    def test_emprestimo_trocado_de_responsavel_atualiza_os_dois(self):
+        emprestimo = self.criar_emprestimo('E1')
+        self.assertTrue(self.resumo(self.pessoa).emprestimo_ativo)
+
+        emprestimo.responsavel = self.outra
+        emprestimo.save()
+        self.assertFalse(self.resumo(self.pessoa).emprestimo_ativo)
+        self.assertTrue(self.resumo(self.outra).emprestimo_ativo)
+
+    def falha_no_resumo(self):
+        return mock.patch.object(
+            PessoaResumo.objects, 'atualizar', side_effect=DatabaseError('resumo')
+        )
+
+    def test_falha_no_resumo_desfaz_o_acesso(self):
+        registro = ControleAcesso.objects.create(pessoa=self.pessoa, sala=self.sala)
+        pk = registro.pk
+        with self.falha_no_resumo(), self.assertRaises(DatabaseError):
+            ControleAcesso.objects.create(pessoa=self.outra, sala=self.sala)
+        with self.falha_no_resumo(), self.assertRaises(DatabaseError):
+            registro.delete()
+        self.assertEqual(list(ControleAcesso.objects.values_list('pk', flat=True)), [pk])
+
+    def test_falha_no_resumo_desfaz_o_emprestimo(self):
+        emprestimo = self.criar_emprestimo('E1', itens=['Cabo'])
+        with self.falha_no_resumo(), self.assertRaises(DatabaseError):
+            Emprestimo.objects.create(identificador='E2', responsavel=self.outra)
+        with self.falha_no_resumo(), self.assertRaises(DatabaseError):
+            Emprestimo.objects.get().delete()
+        self.assertEqual(list(Emprestimo.objects.values_list('identificador', flat=True)), ['E1'])
+
+        # A devolução que encerraria o empréstimo também volta atrás
+        with self.falha_no_resumo(), self.assertRaises(DatabaseError):
+            ItemEmprestimo.objects.devolver(emprestimo, self.usuario)
+        self.assertFalse(ItemEmprestimo.objects.get().devolvido)
+        emprestimo.refresh_from_db()
+        self.assertFalse(emprestimo.encerrado)
+        self.assertTrue(self.resumo(self.pessoa).emprestimo_ativo)
+
+    def comando(self, nome, *args):
+        saida = StringIO()
+        call_command(nome, *args, stdout=saida)
+        return saida.getvalue()
+
+    def test_preenche_so_quem_nao_tem_resumo(self):
+        registro = ControleAcesso.objects.create(pessoa=self.pessoa, sala=self.sala)
+        self.criar_emprestimo('E1')
+        # Escritas que não passam pelo save(), como num banco anterior aos resumos
+        PessoaResumo.objects.all().delete()
+        PessoaResumo.objects.create(pessoa=self.outra, emprestimo_encerrado=True)
+
+        self.assertIn('1 resumos preenchidos', self.comando('preencher_resumos'))
+        resumo = self.resumo(self.pessoa)
+        self.assertEqual(resumo.ultimo_acesso, registro.hora_entrada)
+        self.assertEqual(resumo.ultima_sala, self.sala)
+        self.assertTrue(resumo.emprestimo_ativo)
+        self.assertTrue(self.resumo(self.outra).emprestimo_encerrado)
+
+        self.assertIn('2 resumos preenchidos', self.comando('preencher_resumos', '--todos'))
+        self.assertFalse(self.resumo(self.outra).emprestimo_encerrado)
+
+    def test_verifica_e_corrige_divergencias(self):
+        ControleAcesso.objects.create(pessoa=self.pessoa, sala=self.sala)
+        self.assertIn('Todos os resumos conferem', self.comando('verificar_resumos'))
+
+        Emprestimo.objects.bulk_create([Emprestimo(identificador='E1', responsavel=self.outra)])
+        saida = self.comando('verificar_resumos')
+        self.assertIn('2020002: emprestimo_ativo', saida)
+        self.assertIn('1 resumos divergentes', saida)
+        self.assertFalse(PessoaResumo.objects.filter(emprestimo_ativo=True).exists())
+
+        self.assertIn('1 resumos corrigidos', self.comando('verificar_resumos', '--corrigir'))
+        self.assertTrue(self.resumo(self.outra).emprestimo_ativo)
+        self.assertIn('Todos os resumos conferem', self.comando('verificar_resumos'))
+
+
+
+class SaidaAutomaticaTests(ControleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.salas = {
+            horas: Sala.objects.create(numero=f'{horas}00', horas_saida_automatica=horas)
+            for horas in (2, 4, 8)
+        }
+
+    def setUp(self):
+        super().setUp()
+        self.agora = now()
+
+    def entrar(self, sala, horas_atras, saida=None):
+        pessoa = Pessoa.objects.create(
+            nome=f'Aluno {Pessoa.objects.count()}', matricula=str(Pessoa.objects.count())
+        )
+        entrada = self.agora - timedelta(hours=horas_atras)
+        return ControleAcesso.objects.create(
+            pessoa=pessoa, sala=sala, hora_entrada=entrada, hora_saida=saida
+        )
+
+    def saida(self, registro):
+        registro.refresh_from_db()
+        return registro.hora_saida
+
+    def test_limite_de_cada_sala(self):
+        fora = {horas: self.entrar(sala, horas + 1) for horas, sala in self.salas.items()}
+        dentro = {horas: self.entrar(sala, horas - 0.5) for horas, sala in self.salas.items()}
+
+        self.assertEqual(tasks.registrar_saida_automatica(), "Registradas 3 saídas automáticas.")
+        for horas, registro in fora.items():
+            self.assertEqual(
+                self.saida(registro), registro.hora_entrada + timedelta(hours=horas)
+            )
+        for registro in dentro.values():
+            self.assertIsNone(self.saida(registro))
+
+    def test_registros_sem_sala_usam_quatro_horas(self):
+        antigo, recente = self.entrar(None, 5), self.entrar(None, 3)
+
+        tasks.registrar_saida_automatica()
+        self.assertEqual(self.saida(antigo), antigo.hora_entrada + timedelta(hours=4))
+        self.assertIsNone(self.saida(recente))
+
+    def test_saidas_registradas_nao_mudam(self):
+        saida = self.agora - timedelta(hours=9)
+        registro = self.entrar(self.salas[2], 10, saida=saida)
+
+        self.assertEqual(tasks.registrar_saida_automatica(), "Registradas 0 saídas automáticas.")
+        self.assertEqual(self.saida(registro), saida)
+
+
+class ExportacaoTests(ControleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.outra = Pessoa.objects.create(nome='Silva, Bia', matricula='2020002')
+        cls.recebente = User.objects.create_user('bolsista')
+        salas = {numero: Sala.objects.create(numero=numero) for numero in ('101', '201')}
+
+        def hora(dia, horas):
+            return make_aware(datetime(2030, 3, dia, horas))
+
+        for pessoa, sala, entrada, saida in (
+            (cls.pessoa, '101', hora(4, 8), hora(4, 10)),
+            (cls.outra, '201', hora(4, 9), hora(4, 11)),
+            (None, '101', hora(5, 8), hora(5, 9)),
+            (cls.pessoa, '201', hora(6, 14), None),
+        ):
+            ControleAcesso.objects.create(
+                pessoa=pessoa, sala=salas[sala], hora_entrada=entrada, hora_saida=saida
+            )
+
+    def exportar(self, url, **params):
+        resposta = self.client.get(url, params)
+        self.assertEqual(resposta.status_code, 200)
+        return b''.join(resposta.streaming_content).decode(), resposta
+
+    def test_acessos_em_csv(self):
+        conteudo, resposta = self.exportar('/api/controle/registros/exportar/')
+        self.assertEqual(resposta['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(
+            resposta['Content-Disposition'], 'attachment; filename="registros.csv"'
+        )
+        linhas = list(csv.reader(StringIO(conteudo)))
+        self.assertEqual(linhas[0], CAMPOS_ACESSOS)
+        self.assertEqual(len(linhas), 5)
+        self.assertEqual(
+            linhas[2][1:],
+            ['Silva, Bia', '2020002', '201', '2030-03-04T09:00:00-03:00',
+             '2030-03-04T11:00:00-03:00'],
+        )
+        self.assertEqual(linhas[3][1:4], ['', '', '101'])
+        self.assertEqual(linhas[4][-1], '')
+
+    def test_acessos_em_ndjson_com_filtros(self):
+        conteudo, resposta = self.exportar(
+            '/api/controle/registros/exportar/',
+            formato='ndjson', inicio='2030-03-04', fim='2030-03-05', sala='101',
+        )
+        self.assertEqual(resposta['Content-Type'], 'application/x-ndjson')
+        linhas = [json.loads(linha) for linha in conteudo.splitlines()]
+        self.assertEqual(
+            [(linha['pessoa_nome'], linha['hora_entrada']) for linha in linhas],
+            [('Aluno', '2030-03-04T08:00:00-03:00'), (None, '2030-03-05T08:00:00-03:00')],
+        )
+        self.assertEqual(set(linhas[0]), set(CAMPOS_ACESSOS))
+
+    def test_parametros_invalidos(self):
+        for url in ('/api/controle/registros/exportar/', '/api/controle/emprestimos/exportar/'):
+            self.assertEqual(self.client.get(url, {'formato': 'xlsx'}).status_code, 400)
+            self.assertEqual(self.client.get(url, {'inicio': '04/03/2030'}).status_code, 400)
+
+    def test_emprestimos_iguais_a_lista(self):
+        equipamento = Equipamento.objects.create(nome='Osciloscópio', patrimonio='P1')
+        for i in range(5):
+            emprestimo = self.criar_emprestimo(
+                f'E{i}', itens=['Cabo'], equipamentos=[equipamento] if i % 2 else []
+            )
+        emprestimo.emprestimo.update(recebente=self.recebente, devolvido=True)
+        Emprestimo.objects.create(identificador='E5', funcionario=self.recebente)
+
+        # Lotes pequenos para que os itens sejam buscados em mais de uma consulta
+        with mock.patch('controle.api.exportacao.EXPORTACAO_CHUNK_SIZE', 2):
+            conteudo, resposta = self.exportar(
+                '/api/controle/emprestimos/exportar/', formato='ndjson'
+            )
+        self.assertEqual(
+            resposta['Content-Disposition'], 'attachment; filename="emprestimos.ndjson"'
+        )
+        exportados = [json.loads(linha) for linha in conteudo.splitlines()]
+        lista = self.client.get('/api/controle/emprestimos/', {'all': 'true'}).json()
+        self.assertEqual(len(exportados), 6)
+        self.assertEqual(
+            sorted(exportados, key=lambda e: e['identificador']),
+            sorted(lista, key=lambda e: e['identificador']),
+        )
+        self.assertEqual(exportados[1]['items_nomes'], 'Cabo; Osciloscópio')
+        self.assertEqual(exportados[4]['quem_recebeu'], 'bolsista')
+
+        conteudo, _ = self.exportar('/api/controle/emprestimos/exportar/')
+        linhas = list(csv.reader(StringIO(conteudo)))
+        self.assertEqual(linhas[0], CAMPOS_EMPRESTIMOS)
+        self.assertEqual(len(linhas), 7)
+
+
+class FotoEquipamentoTests(TestCase):
+
+    def setUp(self):
+        midia = tempfile.TemporaryDirectory()
+        self.addCleanup(midia.cleanup)
+        configuracao = override_settings(MEDIA_ROOT=midia.name)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.midia = midia.name
+
+        self.equipamento = Equipamento.objects.create(nome='Multímetro', patrimonio='P1')
+        for campo, nome in (
+            ('foto', 'antiga.webp'), ('foto_lista', 'antiga_lista.webp'),
+            ('foto_detalhe', 'antiga_detalhe.webp'),
+        ):
+            getattr(self.equipamento, campo).save(nome, ContentFile(b'x'), save=False)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.equipamento.save()
+
+    def arquivos(self):
+        return sorted(os.listdir(self.midia))
+
+    def test_foto_nova_apaga_miniaturas_e_agenda_otimizacao(self):
+        self.equipamento.foto = ContentFile(b'y', name='nova.jpg')
+        with mock.patch('controle.models.equipamentos.async_task') as async_task, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.equipamento.save()
+
+        self.assertEqual(self.arquivos(), ['antiga.webp', 'nova.jpg'])
+        self.equipamento.refresh_from_db()
+        self.assertFalse(self.equipamento.foto_lista)
+        self.assertFalse(self.equipamento.foto_detalhe)
+        async_task.assert_called_once_with(
+            'controle.tasks.otimizar_foto_equipamento', self.equipamento.pk, 'nova.jpg'
+        )
+
+    def test_miniaturas_ficam_se_a_gravacao_falhar(self):
+        Equipamento.objects.create(nome='Fonte', patrimonio='P2')
+        self.equipamento.patrimonio = 'P2'
+        self.equipamento.foto = ContentFile(b'y', name='nova.jpg')
+        with mock.patch('controle.models.equipamentos.async_task') as async_task, \
+                self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                self.equipamento.save()
+
+        self.assertIn('antiga_lista.webp', self.arquivos())
+        self.assertIn('antiga_detalhe.webp', self.arquivos())
+        self.equipamento.refresh_from_db()
+        self.assertEqual(self.equipamento.foto_lista.name, 'antiga_lista.webp')
+        async_task.assert_not_called()
+
+    def test_edicao_sem_foto_nova_mantem_miniaturas(self):
+        self.equipamento.nome = 'Multímetro digital'
+        with mock.patch('controle.models.equipamentos.async_task') as async_task, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.equipamento.save()
+
+        self.assertEqual(
+            self.arquivos(), ['antiga.webp', 'antiga_detalhe.webp', 'antiga_lista.webp']
+        )
+        async_task.assert_not_called()
+
+class DevolucaoTests(ControleTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.equipamento = Equipamento.objects.create(nome='Multímetro', patrimonio='P1')
+        self.emprestimo = self.criar_emprestimo(
+            'E1', itens=['Cabo', 'Fonte'], equipamentos=[self.equipamento]
+        )
+
+    def patch(self, url, dados):
+        return self.client.patch(url, dados, content_type='application/json')
+
+    def devolver(self, nome):
+        return self.patch('/api/controle/items/return/', {'emprestimo': 'E1', 'nome': nome})
+
+    def devolver_lote(self, nomes):
+        return self.patch('/api/controle/items/return-batch/', {'emprestimo': 'E1', 'items': nomes})
+
+    def pendentes(self):
+        return sorted(str(item) for item in self.emprestimo.emprestimo.filter(devolvido=False))
+
+    def test_devolucao_de_um_item(self):
+        resposta = self.devolver('P1')
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(resposta.json()['equipamento_patrimonio'], 'P1')
+        self.assertEqual(resposta.json()['recebente_nome'], 'Ana Lima')
+        self.assertEqual(self.pendentes(), ['Cabo', 'Fonte'])
+
+        self.assertEqual(self.devolver('P1').status_code, 404)
+
+    def test_encerra_so_sem_itens_pendentes(self):
+        self.devolver('Cabo')
+        self.devolver('Fonte')
+        self.emprestimo.refresh_from_db()
+        self.assertFalse(self.emprestimo.encerrado)
+        self.assertIsNone(self.emprestimo.devolucao)
+
+        self.devolver('P1')
+        self.emprestimo.refresh_from_db()
+        self.assertTrue(self.emprestimo.encerrado)
+        self.assertIsNotNone(self.emprestimo.devolucao)
+        self.assertFalse(PessoaResumo.objects.get(pessoa=self.pessoa).emprestimo_ativo)
+
+    def test_devolucao_em_lote(self):
+        resposta = self.devolver_lote(['Cabo', 'P1', 'Cabo', 'Osciloscópio'])
+        self.assertEqual(resposta.status_code, 200)
+        dados = resposta.json()
+        self.assertEqual(
+            [item['nome'] or item['equipamento_nome'] for item in dados['devolvidos']],
+            ['Cabo', 'Multímetro'],
+        )
+        self.assertEqual(dados['nao_encontrados'], ['Cabo', 'Osciloscópio'])
+        self.assertFalse(dados['encerrado'])
+        self.assertEqual(self.pendentes(), ['Fonte'])
+
+        dados = self.devolver_lote(['Fonte']).json()
+        self.assertEqual(dados['nao_encontrados'], [])
+        self.assertTrue(dados['encerrado'])
+
+    def test_lote_sem_itens_pendentes(self):
+        self.assertEqual(self.devolver_lote(['Osciloscópio']).status_code, 404)
+        self.assertEqual(self.pendentes(), ['Cabo', 'Fonte', 'Multímetro'])
+
+    def test_devolucao_pelo_identificador(self):
+        resposta = self.patch('/api/controle/emprestimos/byidentifier/', {'identificador': 'E1'})
+        self.assertEqual(resposta.status_code, 200)
+        self.assertTrue(resposta.json()['encerrado'])
+        self.assertEqual(resposta.json()['quem_recebeu'], 'Ana Lima')
+        self.assertEqual(self.pendentes(), [])
+
+    def test_devolucao_pelo_identificador_de_emprestimo_encerrado(self):
+        self.patch('/api/controle/emprestimos/byidentifier/', {'identificador': 'E1'})
+        self.emprestimo.refresh_from_db()
+        devolucao = self.emprestimo.devolucao
+
+        resposta = self.patch('/api/controle/emprestimos/byidentifier/', {'identificador': 'E1'})
+        self.assertEqual(resposta.status_code, 200)
+        self.assertTrue(resposta.json()['encerrado'])
+        self.emprestimo.refresh_from_db()
+        self.assertEqual(self.emprestimo.devolucao, devolucao)
+
+
+
+class CriacaoEmprestimoTests(ControleTestCase):
+    """ Empréstimo e itens são gravados juntos, ou nenhum deles """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.equipamento = Equipamento.objects.create(nome='Multímetro', patrimonio='P1')
+
+    def criar(self, itens, identificador='E1'):
+        return self.client.post('/api/controle/emprestimos/', {
+            'identificador': identificador, 'matricula': '2020001',
+            'items': itens, 'obs': 'Lab 1',
+        }, content_type='application/json')
+
+    def adicionar(self, itens):
+        return self.client.post(
+            '/api/controle/items/add/', {'emprestimo': 'E1', 'items': itens},
+            content_type='application/json',
+        )
+
+    def itens(self):
+        return sorted(str(item) for item in ItemEmprestimo.objects.all())
+
+    def test_resposta_da_criacao(self):
+        resposta = self.criar(['P1', 'Cabo'])
+        self.assertEqual(resposta.status_code, 201)
+        dados = resposta.json()
+        self.assertIsNotNone(dados.pop('retirada'))
+        self.assertEqual(dados, {
+            'identificador': 'E1',
+            'items_nomes': 'Multímetro; Cabo',
+            'funcionario_nome': 'Ana Lima',
+            'responsavel_nome': 'Aluno',
+            'responsavel_matricula': '2020001',
+            'local': 'Lab 1',
+            'encerrado': False,
+            'devolucao': None,
+            'quem_recebeu': '',
+        })
+        item = ItemEmprestimo.objects.get(equipamento=self.equipamento)
+        self.assertEqual(item.emprestimo.identificador, 'E1')
+        self.assertIsNone(item.nome)
+
+    def test_patrimonio_desconhecido_fica_pelo_nome(self):
+        self.assertEqual(self.criar(['P2']).status_code, 201)
+        item = ItemEmprestimo.objects.get()
+        self.assertEqual(item.nome, 'P2')
+        self.assertIsNone(item.equipamento)
+
+    def test_item_invalido_desfaz_o_emprestimo(self):
+        resposta = self.criar(['P1', 'Cabo', 'X' * 101])
+        self.assertEqual(resposta.status_code, 400)
+        self.assertEqual(
+            resposta.json(),
+            {'detail': 'O nome do item deve ter no máximo 100 caracteres: ' + 'X' * 101},
+        )
+        self.assertFalse(Emprestimo.objects.exists())
+        self.assertFalse(ItemEmprestimo.objects.exists())
+        self.assertFalse(PessoaResumo.objects.filter(emprestimo_ativo=True).exists())
+
+    def test_falha_ao_gravar_itens_desfaz_o_emprestimo(self):
+        with mock.patch.object(
+            ItemEmprestimo.objects, 'bulk_create', side_effect=DatabaseError('falha'),
+        ), self.assertLogs('django.request', 'ERROR'), self.assertRaises(DatabaseError):
+            self.criar(['P1', 'Cabo'])
+        self.assertFalse(Emprestimo.objects.exists())
+        self.assertFalse(ItemEmprestimo.objects.exists())
+
+    def test_item_invalido_nao_adiciona_nenhum(self):
+        self.criar(['Cabo'])
+        resposta = self.adicionar(['P1', 'Fonte', 'X' * 101])
+        self.assertEqual(resposta.status_code, 400)
+        self.assertEqual(self.itens(), ['Cabo'])
+
+    def test_resposta_da_adicao(self):
+        self.criar(['Cabo'])
+        resposta = self.adicionar(['P1', ' ', 'Fonte'])
+        self.assertEqual(resposta.status_code, 201)
+        self.assertEqual(
+            [(item.get('equipamento_patrimonio'), item['nome']) for item in resposta.json()],
+            [('P1', None), (None, 'Fonte')],
+        )
+        self.assertEqual(self.itens(), ['Cabo', 'Fonte', 'Multímetro'])
+
+
+
+class RelatorioPolareTests(ControleTestCase):
+    """
+    Textos do relatório fixados com a implementação anterior (uma consulta
+    por dia), para um conjunto com registro sem pessoa e registro em aberto.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        primeiro = Sala.objects.create(numero='101', nome='Sala 1', andar=1)
+        segundo = Sala.objects.create(numero='201', nome='Sala 2', andar=2)
+        outra = Pessoa.objects.create(nome='Outro aluno', matricula='2020002')
+
+        def hora(dia, texto):
+            return make_aware(datetime.strptime(f'2030-03-{dia:02d} {texto}', '%Y-%m-%d %H:%M'))
+
+        for dia, inicio, fim, sala, professor, disciplina in (
+            (4, '08:30', '10:20', primeiro, 'Mario Martins', 'Eletrônica Aplicada'),
+            (4, '14:00', '15:50', segundo, 'Ana Lima', 'Sinais'),
+            (4, '17:00', '18:50', primeiro, 'Caio Souza', 'Redes'),
+            (6, '10:30', '12:20', segundo, 'Ana Lima', 'Sinais'),
+        ):
+            Aula.objects.create(
+                inicio=hora(dia, inicio), fim=hora(dia, fim), sala=sala,
+                professor=professor, disciplina=disciplina,
+            )
+
+        for dia, entrada, saida, pessoa, sala in (
+            (4, '09:00', '11:30', cls.pessoa, primeiro),
+            (4, '13:00', '14:10', cls.pessoa, segundo),
+            (4, '10:00', '10:45', None, primeiro),
+            (4, '17:10', None, outra, segundo),
+            (5, '18:00', '19:10', outra, segundo),
+            (5, '08:00', '08:20', None, primeiro),
+            (5, '09:00', '09:40', None, segundo),
+        ):
+            ControleAcesso.objects.create(
+                pessoa=pessoa, sala=sala, hora_entrada=hora(dia, entrada),
+                hora_saida=hora(dia, saida) if saida else None,
+            )
+
+    def relatorio(self, **params):
+        resposta = self.client.get('/api/controle/polare/reports/', {
+            'start_date': '2030-03-01', 'end_date': '2030-03-31', **params,
+        })
+        self.assertEqual(resposta.status_code, 200)
+        return resposta.json()
+
+    def test_ambos(self):
+        self.assertEqual(self.relatorio(), {
+            'aulas': [
+                '04/03/2030 | Mario Martins - Eletrônica Aplicada, Ana Lima - Sinais, Caio Souza - Redes',
+                '06/03/2030 | Ana Lima - Sinais',
+            ],
+            'acessos': [
+                '04/03/2030 | 2 alunos, duração média de 1 horas e 28 minutos',
+                '05/03/2030 | 2 alunos, duração média de 0 horas e 43 minutos',
+            ],
+        })
+
+    def test_abertura_no_primeiro_andar(self):
+        self.assertEqual(self.relatorio(period='abertura', floor='1'), {
+            'aulas': ['04/03/2030 | Mario Martins - Eletrônica Aplicada'],
+            'acessos': [
+                '04/03/2030 | 2 alunos, duração média de 1 horas e 37 minutos',
+                '05/03/2030 | 1 alunos, duração média de 0 horas e 20 minutos',
+            ],
+        })
+
+    def test_fechamento(self):
+        self.assertEqual(self.relatorio(period='fechamento'), {
+            'aulas': [
+                '04/03/2030 | Ana Lima - Sinais, Caio Souza - Redes',
+                '06/03/2030 | Ana Lima - Sinais',
+            ],
+            'acessos': [
+                '04/03/2030 | 1 alunos, duração média de 1 horas e 10 minutos',
+                '05/03/2030 | 1 alunos, duração média de 1 horas e 10 minutos',
+            ],
+        })
+
+    def test_datas_obrigatorias_e_validas(self):
+        self.assertEqual(self.client.get('/api/controle/polare/reports/').status_code, 400)
+        resposta = self.client.get(
+            '/api/controle/polare/reports/', {'start_date': '2030-03-01', 'end_date': '31/03'}
+        )
+        self.assertEqual(resposta.status_code, 400)
+
+
+
+@skipUnless(os.environ.get('BENCHMARK'), "Defina BENCHMARK=1 para medir")
+class RelatorioPolareBenchmarkTests(ControleTestCase):
+    """ Relatório de um ano com 20 aulas e 40 acessos por dia """
+
+    def test_um_ano(self):
+        salas = [Sala.objects.create(numero=str(100 + i), nome=f'Sala {i}', andar=1 + i % 2) for i in range(4)]
+        pessoas = Pessoa.objects.bulk_create(
+            [Pessoa(nome=f'Aluno {i}', matricula=f'B{i}') for i in range(500)]
+        )
+        inicio = make_aware(datetime(2029, 1, 1, 7))
+        aulas, acessos = [], []
+        for dia in range(365):
+            base = inicio + timedelta(days=dia)
+            for i in range(20):
+                hora = base + timedelta(minutes=40 * i)
+                aulas.append(Aula(inicio=hora, fim=hora + timedelta(minutes=50), sala=salas[i % 4],
+                                  professor=f'Professor {i}', disciplina=f'Disciplina {i}'))
+            for i in range(40):
+                hora = base + timedelta(minutes=15 * i)
+                acessos.append(ControleAcesso(
+                    pessoa=pessoas[(dia * 40 + i) % len(pessoas)], sala=salas[i % 4],
+                    hora_entrada=hora, hora_saida=hora + timedelta(minutes=30 + i),
+                ))
+        Aula.objects.bulk_create(aulas)
+        ControleAcesso.objects.bulk_create(acessos)
+
+        for params in ({}, {'period': 'abertura', 'floor': '1'}):
+            with CaptureQueriesContext(connection) as consultas:
+                inicio_medida = time.perf_counter()
+                resposta = self.client.get('/api/controle/polare/reports/', {
+                    'start_date': '2029-01-01', 'end_date': '2029-12-31', **params,
+                })
+                segundos = time.perf_counter() - inicio_medida
+            self.assertEqual(len(resposta.json()['acessos']), 365)
+            filtros = ', '.join(f'{chave}={valor}' for chave, valor in params.items()) or 'sem filtros'
+            print(f"\nRelatório Polare de um ano ({filtros}): "
+                  f"{segundos:.2f} s, {len(consultas)} consultas")
+
+
+def compra(i):
+    return Compras(
+        titulo=f'Item {i}', descricao='Descrição\n' * 5, justificativa='Justificativa',
+        quantidade=i + 1, origem='almox', tipo='consumo',
+        empresa_orcamento_1='Loja', preco_orcamento_1=10, url_orcamento_1='https://loja',
+    )
+
+
+def paginas(pdf):
+    return len(re.findall(rb'/Type /Page\b', pdf))
+
+
+class DemapaTests(SimpleTestCase):
+
+    def render(self, objs, **kwargs):
+        buffer = BytesIO()
+        demapa.render_demapa(objs, buffer, **kwargs)
+        return buffer.getvalue()
+
+    def estilos(self, objs, **kwargs):
+        with mock.patch.object(demapa, '_quadro_demapa', wraps=demapa._quadro_demapa) as quadro:
+            self.render(objs, **kwargs)
+        return {chamada.args[1] for chamada in quadro.call_args_list}
+
+    def test_item_unico_pode_ser_quebrado(self):
+        self.assertEqual(self.estilos([compra(0)]), {demapa.ESTILO_QUADRO})
+
+    def test_agregado_nao_quebra_quadros_mesmo_com_um_item(self):
+        for quantidade in (1, 3):
+            self.assertEqual(
+                self.estilos([compra(i) for i in range(quantidade)], agregado=True),
+                {demapa.ESTILO_QUADRO_AGREGADO},
+            )
+
+    def test_um_quadro_por_item(self):
+        self.assertEqual(paginas(self.render([compra(0)])), 1)
+        self.assertGreater(paginas(self.render([compra(i) for i in range(10)], agregado=True)), 1)
+
+
+class DemapaAgregadoTests(ControleTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(3):
+            compra(i).save()
+
+    def setUp(self):
+        super().setUp()
+        midia = tempfile.TemporaryDirectory()
+        self.addCleanup(midia.cleanup)
+        configuracao = override_settings(MEDIA_ROOT=midia.name, DEMAPA_RETENCAO_HORAS=24)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+        self.pasta = os.path.join(midia.name, demapa.DEMAPA_PASTA)
+
+    def pedir(self, **dados):
+        ids = list(Compras.objects.values_list('pk', flat=True))
+        return self.client.post(
+            '/api/controle/compras/demapa_agregado/', {'ids': ids, **dados},
+            content_type='application/json',
+        )
+
+    def test_pedido_sincrono_nao_grava_o_pdf(self):
+        resposta = self.pedir()
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(paginas(b''.join(resposta.streaming_content)), 2)
+        self.assertFalse(os.path.exists(self.pasta))
+
+    def estado(self, chave):
+        return self.client.get(f'/api/controle/compras/demapa_agregado/{chave}/').json()['estado']
+
+    def baixar(self, chave):
+        return self.client.get(f'/api/controle/compras/demapa_agregado/{chave}/download/')
+
+    def test_pedido_assincrono_processa_e_fica_pronto(self):
+        with mock.patch('controle.api.views.async_task') as async_task:
+            resposta = self.pedir(assincrono=True)
+        self.assertEqual(resposta.status_code, 202)
+        chave = resposta.json()['id']
+        self.assertEqual(resposta.json()['estado'], 'processando')
+
+        funcao, ids, chave_tarefa = async_task.call_args.args
+        self.assertEqual(funcao, 'controle.tasks.gerar_demapa_agregado')
+        self.assertEqual(chave_tarefa, chave)
+        self.assertEqual(async_task.call_args.kwargs, {'task_name': f'demapa_{chave}'})
+        self.assertEqual(self.estado(chave), 'processando')
+        self.assertEqual(self.baixar(chave).status_code, 404)
+
+        # O que o worker faria
+        tasks.gerar_demapa_agregado(ids, chave)
+        self.assertEqual(self.estado(chave), 'pronto')
+        resposta = self.baixar(chave)
+        self.assertEqual(resposta.status_code, 200)
+        self.assertEqual(paginas(b''.join(resposta.streaming_content)), 2)
+
+        # Um novo pedido dos mesmos itens não gera de novo
+        with mock.patch('controle.api.views.async_task') as async_task:
+            resposta = self.pedir(assincrono=True)
+        self.assertEqual((resposta.status_code, resposta.json()['estado']), (200, 'pronto'))
+        async_task.assert_not_called()
+
+    def test_falha_e_novo_pedido(self):
+        with mock.patch('controle.api.views.async_task'):
+            chave = self.pedir(assincrono=True).json()['id']
+
+        agora = now()
+        Failure.objects.create(
+            id='1' * 32, name=f'demapa_{chave}', func='controle.tasks.gerar_demapa_agregado',
+            started=agora, stopped=agora, success=False,
+        )
+        self.assertEqual(self.estado(chave), 'erro')
+        self.assertEqual(self.baixar(chave).status_code, 404)
+
+        # Pedir de novo descarta a falha e agenda outra vez
+        with mock.patch('controle.api.views.async_task') as async_task:
+            self.assertEqual(self.pedir(assincrono=True).status_code, 202)
+        async_task.assert_called_once()
+        self.assertEqual(self.estado(chave), 'processando')
+
+    def test_limpeza_apaga_so_os_antigos(self):
+        os.makedirs(self.pasta)
+        agora = time.time()
+        for nome, horas in (('antigo.pdf', 25), ('recente.pdf', 23)):
+            caminho = os.path.join(self.pasta, nome)
+            open(caminho, 'wb').close()
+            os.utime(caminho, (agora - horas * 3600, agora - horas * 3600))
+
+        self.assertEqual(tasks.limpar_demapas_antigos(), "Apagados 1 DEMAPAs antigos.")
+        self.assertEqual(os.listdir(self.pasta), ['recente.pdf'])
+
+    def test_limpeza_sem_pasta(self):
+        self.assertEqual(tasks.limpar_demapas_antigos(), "Nenhum DEMAPA para apagar.")
+
+
+@skipUnless(os.environ.get('BENCHMARK'), "Defina BENCHMARK=1 para medir")
+class DemapaBenchmarkTests(SimpleTestCase):
+    """ Páginas por segundo do DEMAPA agregado com 1, 50 e 500 itens """
+
+    def test_paginas_por_segundo(self):
+        for quantidade in (1, 50, 500):
+            objs = [compra(i) for i in range(quantidade)]
+            buffer = BytesIO()
+            inicio = time.perf_counter()
+            demapa.render_demapa(objs, buffer, agregado=True)
+            segundos = time.perf_counter() - inicio
+            total = paginas(buffer.getvalue())
+            print(f"\nDEMAPA com {quantidade} itens: {total} páginas em "
+                  f"{segundos:.2f} s ({total / segundos:.1f} páginas/s)")
@@ -5,7 +5,13 @@ set -e
 
 # Run migrations
 poetry run python manage.py makemigrations --noinput
+# Close duplicated open access records, which would block the unique constraint
+poetry run python manage.py fechar_acessos_duplicados
 poetry run python manage.py migrate --noinput
+# Trigram indexes for the person search (PostgreSQL only)
+poetry run python manage.py preparar_busca
+# Fill the activity summary of people that don't have one yet
+poetry run python manage.py preencher_resumos
 poetry run python manage.py collectstatic --noinput
 
 # Run the ASGI server
@@ -152,6 +152,19 @@ STORAGES = {
     },
 }
 
+# Compressão dos dumps do banco feitos por root.tasks.dbbackup_q2: 'gzip',
+# 'xz' ou 'zstd' (este último requer o pacote zstandard)
+DBBACKUP_COMPRESSAO = env('DBBACKUP_COMPRESSAO', default='gzip')
+DBBACKUP_NIVEL_COMPRESSAO = env.int('DBBACKUP_NIVEL_COMPRESSAO', default=6)
+
+# Dias em que versões antigas da mídia (substituídas ou removidas) e tars de
+# mídia não referenciados são mantidos pelo backup incremental
+DBBACKUP_MIDIA_RETENCAO_DIAS = env.int('DBBACKUP_MIDIA_RETENCAO_DIAS', default=30)
+
+# Horas que os DEMAPAs agregados gerados em segundo plano ficam guardados,
+# até serem apagados por controle.tasks.limpar_demapas_antigos
+DEMAPA_RETENCAO_HORAS = env.int('DEMAPA_RETENCAO_HORAS', default=24)
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -171,6 +184,13 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': env('CACHE_LOCATION', default='redis://valkey:6379/1'),
+    }
+}
+
 Q_CLUSTER = {
     'name': 'nupedee',
     'workers': 8,
@@ -17,7 +17,7 @@ Including another URLconf
 from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from . import views
 
 urlpatterns = [
@@ -28,6 +28,11 @@ urlpatterns = [
     path('api/auth/', include('authentication.api.urls')),
     path('api/controle/', include('controle.api.urls')),
     path('api/root/', include('root.api.urls')),
+    re_path(
+        r'^media/cas/(?P<caminho>[0-9a-f]{2}/[0-9a-f]{64}(\.\w{1,9})?)$',
+        views.conteudo,
+        name='conteudo',
+    ),
 ]
 
 if settings.DEBUG:
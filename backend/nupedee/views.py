@@ -1,6 +1,20 @@
 #!/usr/bin/env python3
 
+from django.http import FileResponse, Http404
 from django.shortcuts import render
+from root.storage import PASTA_CONTEUDO, conteudo_storage
+
+# Arquivos endereçados pelo hash nunca mudam de conteúdo
+CONTEUDO_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
 def index(request):
     return render(request, 'index.html')
+
+def conteudo(request, caminho):
+    nome = f"{PASTA_CONTEUDO}/{caminho}"
+    if not conteudo_storage.exists(nome):
+        raise Http404
+
+    resposta = FileResponse(conteudo_storage.open(nome, 'rb'))
+    resposta['Cache-Control'] = CONTEUDO_CACHE_CONTROL
+    return resposta
@@ -1,12 +1,58 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.template.response import TemplateResponse
+from django.urls import path
 
 # Register your models here.
 
+from .forms import ImportarPessoasForm
 from .models import (Pessoa, Predio, Sala)
 
 class PessoaAdmin(admin.ModelAdmin):
     list_display = ('nome', 'matricula', 'tipo')
     search_fields = ('nome', 'matricula')
+    change_list_template = 'admin/root/pessoa/change_list.html'
+
+    def get_urls(self):
+        return [
+            path(
+                'importar/',
+                self.admin_site.admin_view(self.importar),
+                name='root_pessoa_importar',
+            ),
+        ] + super().get_urls()
+
+    def importar(self, request):
+        """ Importação de pessoas de um CSV/XLSX (ver `manage.py importar_pessoas`) """
+        from .importacao import importar_pessoas
+
+        if not self.has_add_permission(request) or not self.has_change_permission(request):
+            raise PermissionDenied
+
+        lotes = []
+        form = ImportarPessoasForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            arquivo = form.cleaned_data['arquivo']
+            try:
+                lotes = list(importar_pessoas(
+                    arquivo.file, arquivo.name, simular=form.cleaned_data['simular']
+                ))
+            except (UnicodeDecodeError, ValueError) as e:
+                messages.error(request, str(e))
+            else:
+                if not form.cleaned_data['simular']:
+                    novos = sum(lote['novos'] for lote in lotes)
+                    alterados = sum(lote['alterados'] for lote in lotes)
+                    messages.success(request, f"{novos} pessoas inseridas e {alterados} alteradas.")
+
+        return TemplateResponse(request, 'admin/root/pessoa/importar.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Importar pessoas',
+            'form': form,
+            'lotes': lotes,
+            'simular': form.is_bound and form.cleaned_data.get('simular'),
+        })
 
     def tipo(self, obj):
         if obj.tipo == "AL":
@@ -25,7 +71,7 @@ class PredioAdmin(admin.ModelAdmin):
 
 
 class SalaAdmin(admin.ModelAdmin):
-    list_display = ('nome', 'predio', 'numero', 'andar')
+    list_display = ('nome', 'predio', 'numero', 'andar', 'horas_saida_automatica')
 
 
 admin.site.register(Pessoa, PessoaAdmin)
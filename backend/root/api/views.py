@@ -1,4 +1,5 @@
 from .serializers import PessoaSerializer, SalaSerializer
+from root.busca import BUSCA_LIMITE, filtro_nome, ids_pessoas
 from root.models import Pessoa, Sala
 from rest_framework import status
 from rest_framework.decorators import action
@@ -7,39 +8,53 @@ from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
 
-from django.db.models import Max, F, Exists, OuterRef, Subquery
-from controle.models import Emprestimo, ControleAcesso
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce
 ...
 class PessoaViewSet(ModelViewSet):
     permission_classes = (IsAuthenticated,)
     serializer_class = PessoaSerializer
 
-    def get_queryset(self):
-        last_room = ControleAcesso.objects.filter(pessoa=OuterRef('pk')).order_by('-hora_entrada').values('sala__numero')[:1]
-        queryset = Pessoa.objects.annotate(
-            last_access=Max('controleacesso__hora_entrada'),
-            last_room_numero=Subquery(last_room),
-            has_active_loan=Exists(
-                Emprestimo.objects.filter(responsavel=OuterRef('pk'), encerrado=False)
-            ),
-            has_past_loan=Exists(
-                Emprestimo.objects.filter(responsavel=OuterRef('pk'), encerrado=True)
-            )
+    def anotar(self, queryset):
+        # Lido do PessoaResumo, mantido a cada acesso e empréstimo
+        return queryset.annotate(
+            last_access=F('resumo__ultimo_acesso'),
+            last_room_numero=F('resumo__ultima_sala__numero'),
+            has_active_loan=Coalesce('resumo__emprestimo_ativo', Value(False)),
+            has_past_loan=Coalesce('resumo__emprestimo_encerrado', Value(False)),
         )
+
+    def get_queryset(self):
+        queryset = Pessoa.objects.all()
         matricula = self.request.query_params.get('matricula')
         if matricula is not None:
             queryset = queryset.filter(matricula=matricula)
 
         nome = self.request.query_params.get('nome')
         if nome is not None:
-            queryset = queryset.filter(nome__icontains=nome).order_by(
+            # Todos os nomes que contêm o termo são ordenados pelo resumo
+            # antes do corte, como antes; a relevância fica para /busca/
+            queryset = queryset.filter(filtro_nome(nome))
+            return self.anotar(queryset).order_by(
                 F('has_active_loan').desc(),
                 F('has_past_loan').desc(),
                 F('last_access').desc(nulls_last=True),
                 'nome'
-            )[:20]
+            )[:BUSCA_LIMITE]
 
-        return queryset
+        return self.anotar(queryset)
+
+    @action(detail=False, methods=['get'], url_path='busca')
+    def busca(self, request, *args, **kwargs):
+        """
+        Busca por nome (sem diferenciar acentos, tolerando erros de
+        digitação) ou início da matrícula em ?q=, das pessoas mais
+        relevantes para as menos.
+        """
+        ids = ids_pessoas(request.query_params.get('q', ''))
+        pessoas = self.anotar(Pessoa.objects.filter(pk__in=ids)).in_bulk()
+        serializer = self.get_serializer([pessoas[pk] for pk in ids if pk in pessoas], many=True)
+        return Response(serializer.data)
 
     @action(detail=False, methods=['patch'], url_path='mailphone')
     def patch_mailphone(self, request, *args, **kwargs):
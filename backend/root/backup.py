@@ -0,0 +1,282 @@
+from dbbackup import utils as dbbackup_utils
+from dbbackup.db.base import get_connector
+from dbbackup.storage import get_storage
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+import gzip
+import json
+import lzma
+import os
+import shutil
+import tarfile
+import time
+
+BLOCO = 1024 * 1024
+
+# Manifesto do backup incremental de mídia, guardado junto dos backups: para
+# cada arquivo do MEDIA_ROOT, tamanho, mtime e o tar com sua versão atual; as
+# versões substituídas ou removidas, até quando valeram; e os tars de mídia
+# que nenhuma versão referencia (como os backups completos anteriores ao
+# manifesto), desde quando estão assim
+MANIFESTO_MIDIA = 'media-manifest.json'
+
+# Pastas do MEDIA_ROOT com arquivos temporários, que podem ser gerados de novo
+# (os DEMAPAs agregados) e ficam fora do backup
+PASTAS_FORA_DO_BACKUP = ('demapa',)
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImproperlyConfigured(
+            "DBBACKUP_COMPRESSAO='zstd' requer o pacote zstandard."
+        ) from e
+    return zstandard
+
+
+# Formato: (extensão, abrir para escrita com nível, abrir para leitura)
+COMPRESSORES = {
+    'gzip': (
+        'gz',
+        lambda f, nivel: gzip.GzipFile(fileobj=f, mode='wb', compresslevel=nivel),
+        lambda f: gzip.GzipFile(fileobj=f, mode='rb'),
+    ),
+    'xz': (
+        'xz',
+        lambda f, nivel: lzma.LZMAFile(f, 'wb', preset=nivel),
+        lambda f: lzma.LZMAFile(f, 'rb'),
+    ),
+    'zstd': (
+        'zst',
+        lambda f, nivel: _zstandard().ZstdCompressor(level=nivel).stream_writer(f, closefd=False),
+        lambda f: _zstandard().ZstdDecompressor().stream_reader(f),
+    ),
+}
+
+
+def _compressor_por_nome(nome):
+    extensao = nome.rsplit('.', 1)[-1]
+    for compressor in COMPRESSORES.values():
+        if compressor[0] == extensao:
+            return compressor
+    raise ValueError(f"Formato de compressão desconhecido: {nome}")
+
+
+def _ler_por_blocos(arquivo):
+    """ Lê `arquivo` até o fim, devolvendo o número de bytes lidos """
+    total = 0
+    while bloco := arquivo.read(BLOCO):
+        total += len(bloco)
+    return total
+
+
+def backup_banco():
+    """
+    Faz o dump do banco, comprime em fluxo no formato DBBACKUP_COMPRESSAO e o
+    grava no storage de backups, mantendo os DBBACKUP_CLEANUP_KEEP mais novos.
+    """
+    formato = settings.DBBACKUP_COMPRESSAO
+    if formato not in COMPRESSORES:
+        raise ImproperlyConfigured(
+            f"DBBACKUP_COMPRESSAO deve ser um de {', '.join(COMPRESSORES)}."
+        )
+    extensao, abrir_escrita, _ = COMPRESSORES[formato]
+
+    inicio = time.monotonic()
+    storage = get_storage()
+    connector = get_connector()
+    nome = f"{connector.generate_filename()}.{extensao}"
+
+    dump = connector.create_dump()
+    bruto = dump.seek(0, os.SEEK_END)
+    dump.seek(0)
+
+    comprimido = dbbackup_utils.create_spooled_temporary_file()
+    with abrir_escrita(comprimido, settings.DBBACKUP_NIVEL_COMPRESSAO) as saida:
+        shutil.copyfileobj(dump, saida, BLOCO)
+    dump.close()
+    tamanho = comprimido.tell()
+
+    comprimido.seek(0)
+    storage.write_file(comprimido, nome)
+
+    # Mesmo metadado do comando dbbackup, usado pelo dbrestore
+    metadata = {
+        'engine': connector.connection.settings_dict['ENGINE'],
+        'connector': f"{connector.__module__}.{connector.__class__.__name__}",
+    }
+    storage.write_file(ContentFile(json.dumps(metadata).encode()), f"{nome}.metadata")
+    storage.clean_old_backups(content_type='db')
+
+    return {
+        'arquivo': nome,
+        'bruto': bruto,
+        'tamanho': tamanho,
+        'segundos': time.monotonic() - inicio,
+    }
+
+
+def verificar_backup_banco(nome, bruto):
+    """ Descomprime o dump `nome` do storage e confere seu tamanho """
+    leitor = _compressor_por_nome(nome)[2]
+    with get_storage().read_file(nome) as arquivo, leitor(arquivo) as entrada:
+        lidos = _ler_por_blocos(entrada)
+
+    if lidos != bruto:
+        raise RuntimeError(
+            f"Backup {nome} corrompido: {lidos} bytes lidos, {bruto} esperados."
+        )
+
+
+def _ler_manifesto(storage):
+    manifesto = {}
+    if storage.storage.exists(MANIFESTO_MIDIA):
+        with storage.read_file(MANIFESTO_MIDIA) as arquivo:
+            manifesto = json.load(arquivo)
+    manifesto.setdefault('arquivos', {})
+    manifesto.setdefault('historico', [])
+    manifesto.setdefault('avulsos', {})
+    return manifesto
+
+
+def _gravar_manifesto(storage, manifesto):
+    conteudo = json.dumps(manifesto, sort_keys=True).encode()
+    if storage.storage.exists(MANIFESTO_MIDIA):
+        storage.delete_file(MANIFESTO_MIDIA)
+    storage.write_file(ContentFile(conteudo), MANIFESTO_MIDIA)
+
+
+def _arquivos_midia():
+    """ (nome relativo, tamanho, mtime) de cada arquivo do MEDIA_ROOT """
+    raiz = settings.MEDIA_ROOT
+    for pasta, subpastas, arquivos in os.walk(raiz):
+        if pasta == raiz:
+            subpastas[:] = [p for p in subpastas if p not in PASTAS_FORA_DO_BACKUP]
+        for arquivo in arquivos:
+            caminho = os.path.join(pasta, arquivo)
+            estado = os.stat(caminho)
+            yield os.path.relpath(caminho, raiz), estado.st_size, estado.st_mtime_ns
+
+
+def backup_midia():
+    """
+    Backup incremental do MEDIA_ROOT: um tar só com os arquivos novos ou
+    alterados desde o último manifesto. As versões substituídas ou removidas
+    continuam no manifesto, e seus tars no storage, por
+    DBBACKUP_MIDIA_RETENCAO_DIAS; tars sem nenhuma versão referenciada (como
+    os backups completos antigos) são apagados após o mesmo prazo.
+    """
+    inicio = time.monotonic()
+    storage = get_storage()
+    manifesto = _ler_manifesto(storage)
+    anteriores = manifesto['arquivos']
+
+    agora = int(time.time())
+    limite = agora - settings.DBBACKUP_MIDIA_RETENCAO_DIAS * 24 * 60 * 60
+    historico = [versao for versao in manifesto['historico'] if versao['ate'] >= limite]
+
+    arquivos = {}
+    alterados = []
+    for nome, tamanho, mtime in _arquivos_midia():
+        anterior = anteriores.get(nome)
+        if anterior and anterior['tamanho'] == tamanho and anterior['mtime'] == mtime:
+            arquivos[nome] = anterior
+        else:
+            arquivos[nome] = {'tamanho': tamanho, 'mtime': mtime}
+            alterados.append(nome)
+
+    # Versões substituídas nesta execução ou de arquivos removidos
+    for nome, anterior in anteriores.items():
+        if nome not in arquivos or nome in alterados:
+            historico.append({**anterior, 'nome': nome, 'ate': agora})
+
+    tar_nome, tamanho_tar = None, 0
+    if alterados:
+        tar_nome = dbbackup_utils.filename_generate('tar', content_type='media')
+        tarball = dbbackup_utils.create_spooled_temporary_file()
+        with tarfile.open(fileobj=tarball, mode='w') as tar:
+            for nome in alterados:
+                try:
+                    tar.add(os.path.join(settings.MEDIA_ROOT, nome), arcname=nome)
+                except FileNotFoundError:
+                    # Removido durante o backup
+                    del arquivos[nome]
+                    continue
+                arquivos[nome]['arquivo'] = tar_nome
+        tamanho_tar = tarball.tell()
+
+        tarball.seek(0)
+        storage.write_file(tarball, tar_nome)
+        verificar_backup_midia(tar_nome)
+
+    em_uso = {info['arquivo'] for info in arquivos.values()}
+    em_uso.update(versao['arquivo'] for versao in historico)
+    # Tars referenciados só por versões que saíram do prazo já cumpriram a
+    # retenção; os que o manifesto nunca referenciou são contados a partir
+    # de quando foram vistos pela primeira vez
+    referenciados = {info['arquivo'] for info in anteriores.values()}
+    referenciados.update(versao['arquivo'] for versao in manifesto['historico'])
+
+    avulsos, expirados = {}, []
+    for tar in storage.list_backups(content_type='media'):
+        if tar in em_uso:
+            continue
+        desde = manifesto['avulsos'].get(tar, agora)
+        if tar in referenciados or desde < limite:
+            expirados.append(tar)
+        else:
+            avulsos[tar] = desde
+
+    _gravar_manifesto(storage, {
+        'arquivos': arquivos,
+        'historico': historico,
+        'avulsos': avulsos,
+    })
+
+    for tar in expirados:
+        storage.delete_file(tar)
+
+    return {
+        'arquivo': tar_nome,
+        'alterados': len(alterados),
+        'total': len(arquivos),
+        'tamanho': tamanho_tar,
+        'segundos': time.monotonic() - inicio,
+    }
+
+
+def verificar_backup_midia(nome):
+    """ Lê todos os arquivos do tar `nome` do storage """
+    with get_storage().read_file(nome) as arquivo, tarfile.open(fileobj=arquivo, mode='r') as tar:
+        for membro in tar:
+            if membro.isfile():
+                _ler_por_blocos(tar.extractfile(membro))
+
+
+def restaurar_midia(destino, removidos=False):
+    """
+    Restaura em `destino` a versão mais recente de cada arquivo do manifesto,
+    extraindo de cada tar só os arquivos que ele ainda representa. Com
+    `removidos`, restaura também a última versão guardada dos arquivos que
+    foram removidos do MEDIA_ROOT dentro do prazo de retenção.
+    """
+    storage = get_storage()
+    manifesto = _ler_manifesto(storage)
+    versoes = dict(manifesto['arquivos'])
+    if removidos:
+        for versao in sorted(manifesto['historico'], key=lambda versao: versao['ate']):
+            if versao['nome'] not in manifesto['arquivos']:
+                versoes[versao['nome']] = versao
+
+    por_tar = {}
+    for nome, info in versoes.items():
+        por_tar.setdefault(info['arquivo'], set()).add(nome)
+
+    for tar_nome, nomes in por_tar.items():
+        with storage.read_file(tar_nome) as arquivo, tarfile.open(fileobj=arquivo, mode='r') as tar:
+            membros = [m for m in tar.getmembers() if m.name in nomes]
+            tar.extractall(destino, members=membros, filter='data')
+
+    return sum(len(nomes) for nomes in por_tar.values())
@@ -0,0 +1,95 @@
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from root.models import Pessoa
+
+# Quantas pessoas a busca devolve, e o mínimo de caracteres para buscar
+# (o índice de trigramas não ajuda com termos menores)
+BUSCA_LIMITE = 20
+BUSCA_MIN_CARACTERES = 3
+
+PESSOA = Pessoa._meta.db_table
+
+# Executados por `manage.py preparar_busca` no PostgreSQL. unaccent() não é
+# IMMUTABLE e não pode ser usada num índice, daí a função f_unaccent.
+SQL_PREPARAR_BUSCA = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE EXTENSION IF NOT EXISTS unaccent",
+    """
+    CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+    """,
+    f"""
+    CREATE INDEX IF NOT EXISTS pessoa_nome_trgm_idx
+    ON {PESSOA} USING gin (f_unaccent(nome) gin_trgm_ops)
+    """,
+    f"""
+    CREATE INDEX IF NOT EXISTS pessoa_matricula_trgm_idx
+    ON {PESSOA} USING gin (matricula gin_trgm_ops)
+    """,
+]
+
+# Nomes que contêm o termo, ou parecidos com ele (erros de digitação), e
+# matrículas que começam com ele; todas as condições usam os índices acima
+SQL_BUSCA = f"""
+    SELECT id FROM {PESSOA}
+    WHERE f_unaccent(nome) ILIKE '%%' || f_unaccent(%(termo_like)s) || '%%'
+       OR f_unaccent(%(termo)s) <%% f_unaccent(nome)
+       OR matricula LIKE %(termo_like)s || '%%'
+    ORDER BY
+        matricula = %(termo)s DESC,
+        f_unaccent(nome) ILIKE '%%' || f_unaccent(%(termo_like)s) || '%%' DESC,
+        word_similarity(f_unaccent(%(termo)s), f_unaccent(nome)) DESC,
+        nome
+    LIMIT %(limite)s
+"""
+
+
+# Todos os nomes que contêm o termo, sem diferenciar acentos (índice de
+# trigramas do nome)
+SQL_NOME = f"""
+    SELECT id FROM {PESSOA}
+    WHERE f_unaccent(nome) ILIKE '%%' || f_unaccent(%s) || '%%'
+"""
+
+
+def _escapar_like(termo):
+    return termo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def ids_pessoas(termo, limite=BUSCA_LIMITE):
+    """
+    Ids das pessoas cujo nome ou matrícula corresponde a `termo`, das mais
+    relevantes para as menos; no PostgreSQL, sem diferenciar acentos.
+    """
+    termo = termo.strip()
+    if len(termo) < BUSCA_MIN_CARACTERES:
+        return []
+
+    if connection.vendor != 'postgresql':
+        # Sem pg_trgm: só nomes que contêm o termo e prefixos de matrícula
+        return list(
+            Pessoa.objects
+            .filter(Q(nome__icontains=termo) | Q(matricula__startswith=termo))
+            .order_by('nome')
+            .values_list('id', flat=True)[:limite]
+        )
+
+    with connection.cursor() as cursor:
+        cursor.execute(SQL_BUSCA, {
+            'termo': termo,
+            'termo_like': _escapar_like(termo),
+            'limite': limite,
+        })
+        return [linha[0] for linha in cursor.fetchall()]
+
+
+def filtro_nome(termo):
+    """
+    Filtro das pessoas cujo nome contém `termo`, sem limite, para quem
+    precisa ordenar todas elas; no PostgreSQL, sem diferenciar acentos.
+    """
+    if connection.vendor != 'postgresql':
+        return Q(nome__icontains=termo)
+    return Q(pk__in=RawSQL(SQL_NOME, [_escapar_like(termo)]))
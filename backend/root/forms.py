@@ -4,3 +4,14 @@ from django import forms
 class LoginForm(forms.Form):
     username = forms.CharField()
     password = forms.CharField(widget=forms.PasswordInput)
+
+
+class ImportarPessoasForm(forms.Form):
+    arquivo = forms.FileField(
+        help_text="CSV ou XLSX com as colunas matricula e nome; email, telefone e tipo são opcionais."
+    )
+    simular = forms.BooleanField(
+        required=False,
+        initial=True,
+        help_text="Só mostra o que seria inserido e alterado, sem gravar.",
+    )
@@ -0,0 +1,220 @@
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+from root.models import Pessoa
+import csv
+import io
+import os
+import pandas as pd
+import re
+import time
+import unicodedata
+
+# Linhas lidas, comparadas e gravadas por vez
+IMPORTACAO_LOTE = 2000
+
+# Máximo de alterações guardadas por lote para o relatório da simulação
+IMPORTACAO_MAX_ALTERACOES = 50
+
+# Cabeçalhos aceitos (sem acentos, minúsculos) para cada campo de Pessoa
+COLUNAS_PESSOA = {
+    'matricula': 'matricula',
+    'nome': 'nome',
+    'nome completo': 'nome',
+    'email': 'email',
+    'e-mail': 'email',
+    'telefone': 'telefone',
+    'celular': 'telefone',
+    'tipo': 'tipo',
+}
+
+TIPOS_PESSOA = {
+    'al': Pessoa.Tipo.ALUNO,
+    'aluno': Pessoa.Tipo.ALUNO,
+    'bo': Pessoa.Tipo.BOLSISTA,
+    'bolsista': Pessoa.Tipo.BOLSISTA,
+    'fu': Pessoa.Tipo.FUNCIONARIO,
+    'funcionario': Pessoa.Tipo.FUNCIONARIO,
+    'pr': Pessoa.Tipo.PROFESSOR,
+    'professor': Pessoa.Tipo.PROFESSOR,
+}
+
+
+def _sem_acentos(texto):
+    decomposto = unicodedata.normalize('NFKD', texto)
+    return ''.join(c for c in decomposto if not unicodedata.combining(c))
+
+
+def _tamanho(campo):
+    return Pessoa._meta.get_field(campo).max_length
+
+
+def normalizar_matricula(valor):
+    return re.sub(r'\s+', '', valor)[:_tamanho('matricula')]
+
+
+def normalizar_nome(valor):
+    return ' '.join(valor.split())[:_tamanho('nome')]
+
+
+def normalizar_email(valor):
+    valor = valor.strip().lower()
+    try:
+        validate_email(valor)
+    except ValidationError:
+        return None
+    return valor if len(valor) <= _tamanho('email') else None
+
+
+def normalizar_telefone(valor):
+    digitos = re.sub(r'\D', '', valor)
+    return digitos[:_tamanho('telefone')] or None
+
+
+def normalizar_tipo(valor):
+    tipo = TIPOS_PESSOA.get(_sem_acentos(valor.strip().lower()))
+    return tipo.value if tipo else None
+
+
+# Campos em que um valor vazio ou inválido é tratado como não informado,
+# preservando o que já está gravado
+CAMPOS_OPCIONAIS = ('email', 'telefone', 'tipo')
+
+NORMALIZADORES = {
+    'matricula': normalizar_matricula,
+    'nome': normalizar_nome,
+    'email': normalizar_email,
+    'telefone': normalizar_telefone,
+    'tipo': normalizar_tipo,
+}
+
+
+def _ler_lotes(arquivo, nome, encoding='utf-8-sig'):
+    """ DataFrames de até IMPORTACAO_LOTE linhas, com todas as colunas como texto """
+    extensao = os.path.splitext(nome)[1].lower()
+
+    if extensao == '.csv':
+        texto = io.TextIOWrapper(arquivo, encoding=encoding, newline='')
+        try:
+            delimitador = csv.Sniffer().sniff(texto.read(8192), delimiters=',;\t').delimiter
+        except csv.Error:
+            delimitador = ','
+        texto.seek(0)
+        yield from pd.read_csv(
+            texto, sep=delimitador, dtype=str, keep_default_na=False,
+            chunksize=IMPORTACAO_LOTE,
+        )
+
+    elif extensao == '.xlsx':
+        # O openpyxl não lê por partes; a planilha é lida inteira e fatiada
+        try:
+            planilha = pd.read_excel(arquivo, dtype=str, keep_default_na=False)
+        except ImportError as e:
+            raise ValueError("Importar planilhas .xlsx requer o pacote openpyxl.") from e
+        for inicio in range(0, len(planilha), IMPORTACAO_LOTE):
+            yield planilha.iloc[inicio:inicio + IMPORTACAO_LOTE]
+
+    else:
+        raise ValueError("O arquivo deve ser .csv ou .xlsx.")
+
+
+def _colunas(dataframe):
+    """ {coluna do arquivo: campo de Pessoa} """
+    colunas = {}
+    for coluna in dataframe.columns:
+        campo = COLUNAS_PESSOA.get(_sem_acentos(str(coluna).strip().lower()))
+        if campo and campo not in colunas.values():
+            colunas[coluna] = campo
+
+    faltando = {'matricula', 'nome'} - set(colunas.values())
+    if faltando:
+        raise ValueError(f"Colunas obrigatórias ausentes: {', '.join(sorted(faltando))}.")
+    return colunas
+
+
+def importar_pessoas(arquivo, nome, simular=False, encoding='utf-8-sig'):
+    """
+    Importa pessoas do CSV/XLSX `arquivo` (binário; `nome` dá a extensão),
+    inserindo as matrículas novas e atualizando as existentes cujos dados
+    mudaram. Cada lote é gravado numa transação, com um único
+    INSERT ... ON CONFLICT. Com `simular`, nada é gravado.
+
+    Gera, por lote, um dicionário com as contagens, o tempo gasto e as
+    alterações encontradas.
+    """
+    colunas = None
+    linha_inicial = 2  # A linha 1 é o cabeçalho
+    inicio = time.monotonic()
+
+    for numero, dataframe in enumerate(_ler_lotes(arquivo, nome, encoding), start=1):
+        if colunas is None:
+            colunas = _colunas(dataframe)
+        campos = [campo for campo in colunas.values() if campo != 'matricula']
+
+        registros = {}
+        invalidas = []
+        for linha, valores in enumerate(
+            dataframe[list(colunas)].itertuples(index=False, name=None), start=linha_inicial
+        ):
+            registro = {
+                campo: NORMALIZADORES[campo](str(valor))
+                for campo, valor in zip(colunas.values(), valores)
+            }
+            if not registro['matricula'] or not registro['nome']:
+                invalidas.append(linha)
+                continue
+            for campo in CAMPOS_OPCIONAIS:
+                if campo in registro and registro[campo] is None:
+                    del registro[campo]
+            # Matrícula repetida no arquivo: vale a última linha
+            registros[registro['matricula']] = registro
+        linha_inicial += len(dataframe)
+
+        existentes = {
+            pessoa['matricula']: pessoa
+            for pessoa in Pessoa.objects.filter(matricula__in=registros).values('matricula', *campos)
+        }
+
+        novos, alterados, alteracoes = [], [], []
+        for matricula, registro in registros.items():
+            atual = existentes.get(matricula)
+            if atual is None:
+                novos.append(registro)
+                continue
+            diferencas = {
+                campo: (atual[campo], valor)
+                for campo, valor in registro.items()
+                if campo != 'matricula' and atual[campo] != valor
+            }
+            if diferencas:
+                alterados.append(registro)
+                if len(alteracoes) < IMPORTACAO_MAX_ALTERACOES:
+                    alteracoes.append((matricula, diferencas))
+
+        if not simular and (novos or alterados):
+            # Cada INSERT ... ON CONFLICT atualiza só os campos informados:
+            # as linhas são agrupadas pelos campos que trazem. Campos ausentes
+            # ficam com o padrão ao inserir e mantêm o valor atual ao atualizar
+            grupos = {}
+            for registro in novos + alterados:
+                grupos.setdefault(frozenset(registro), []).append(registro)
+            with transaction.atomic():
+                for grupo in grupos.values():
+                    Pessoa.objects.bulk_create(
+                        [Pessoa(**registro) for registro in grupo],
+                        update_conflicts=True,
+                        unique_fields=['matricula'],
+                        update_fields=[campo for campo in grupo[0] if campo != 'matricula'],
+                    )
+
+        yield {
+            'lote': numero,
+            'linhas': len(dataframe),
+            'novos': len(novos),
+            'alterados': len(alterados),
+            'iguais': len(registros) - len(novos) - len(alterados),
+            'invalidas': invalidas,
+            'alteracoes': alteracoes,
+            'segundos': time.monotonic() - inicio,
+        }
+        inicio = time.monotonic()
@@ -0,0 +1,95 @@
+from django.apps import apps
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from root.storage import (
+    CAMPOS_CONTEUDO,
+    PASTA_CONTEUDO,
+    conteudo_storage,
+    referencias_arquivos,
+)
+import os
+
+
+class Command(BaseCommand):
+    help = (
+        "Move manuais, datasheets e anexos para o armazenamento por conteúdo, "
+        "juntando arquivos repetidos"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Só informa o que seria feito, sem alterar arquivos ou registros",
+        )
+        parser.add_argument(
+            '--limpar',
+            action='store_true',
+            help="Remove também os arquivos do armazenamento que nenhum registro usa",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        migrados, antigos = self._migrar(dry_run)
+
+        # Um arquivo antigo pode ser usado por vários registros: só apaga
+        # depois de todos terem sido migrados
+        if not dry_run:
+            antigos -= referencias_arquivos()
+            for nome in antigos:
+                default_storage.delete(nome)
+        removidos = len(antigos)
+
+        resumo = f"{migrados} registros migrados, {removidos} arquivos antigos removidos"
+        if options['limpar']:
+            resumo += f", {self._limpar(dry_run)} arquivos órfãos removidos"
+        if dry_run:
+            resumo += " (dry-run)"
+
+        self.stdout.write(self.style.SUCCESS(resumo + "."))
+
+    def _migrar(self, dry_run):
+        migrados = 0
+        antigos = set()
+
+        for modelo, campo in CAMPOS_CONTEUDO:
+            Modelo = apps.get_model(modelo)
+            pendentes = list(
+                Modelo._default_manager
+                .exclude(**{campo: ''}).exclude(**{f'{campo}__isnull': True})
+                .exclude(**{f'{campo}__startswith': f'{PASTA_CONTEUDO}/'})
+                .values_list('pk', campo)
+            )
+
+            for pk, nome in pendentes:
+                if not default_storage.exists(nome):
+                    self.stderr.write(f"{modelo} {pk}: arquivo {nome} não encontrado.")
+                    continue
+
+                if not dry_run:
+                    with default_storage.open(nome, 'rb') as arquivo:
+                        novo = conteudo_storage.save(nome, arquivo)
+                    Modelo._default_manager.filter(pk=pk).update(**{campo: novo})
+
+                antigos.add(nome)
+                migrados += 1
+
+        return migrados, antigos
+
+    def _limpar(self, dry_run):
+        if not conteudo_storage.exists(PASTA_CONTEUDO):
+            return 0
+
+        usados = referencias_arquivos()
+        removidos = 0
+
+        for subpasta in conteudo_storage.listdir(PASTA_CONTEUDO)[0]:
+            pasta = os.path.join(PASTA_CONTEUDO, subpasta)
+            for arquivo in conteudo_storage.listdir(pasta)[1]:
+                nome = f"{pasta}/{arquivo}"
+                if nome not in usados:
+                    if not dry_run:
+                        conteudo_storage.delete(nome)
+                    removidos += 1
+
+        return removidos
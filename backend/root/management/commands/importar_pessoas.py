@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from root.importacao import importar_pessoas
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Importa pessoas de um arquivo CSV ou XLSX (colunas matricula e nome; "
+        "email, telefone e tipo opcionais), atualizando as matrículas existentes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('arquivo', help="Caminho do arquivo .csv ou .xlsx")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Só mostra o que seria inserido e alterado, sem gravar",
+        )
+        parser.add_argument(
+            '--encoding',
+            default='utf-8-sig',
+            help="Codificação do CSV (padrão: utf-8-sig)",
+        )
+
+    def handle(self, *args, **options):
+        simular = options['dry_run']
+        totais = {'linhas': 0, 'novos': 0, 'alterados': 0, 'iguais': 0, 'invalidas': 0}
+        inicio = time.monotonic()
+
+        try:
+            with open(options['arquivo'], 'rb') as arquivo:
+                for lote in importar_pessoas(
+                    arquivo, options['arquivo'], simular=simular, encoding=options['encoding']
+                ):
+                    for chave in totais:
+                        totais[chave] += (
+                            len(lote[chave]) if chave == 'invalidas' else lote[chave]
+                        )
+
+                    self.stdout.write(
+                        f"Lote {lote['lote']}: {lote['linhas']} linhas, {lote['novos']} novas, "
+                        f"{lote['alterados']} alteradas, {lote['iguais']} iguais, "
+                        f"{len(lote['invalidas'])} inválidas em {lote['segundos']:.2f}s"
+                    )
+                    if lote['invalidas']:
+                        linhas = ', '.join(map(str, lote['invalidas'][:20]))
+                        self.stdout.write(f"  Sem matrícula ou nome nas linhas: {linhas}")
+                    if simular:
+                        for matricula, diferencas in lote['alteracoes']:
+                            mudancas = '; '.join(
+                                f"{campo}: {antes!r} -> {depois!r}"
+                                for campo, (antes, depois) in diferencas.items()
+                            )
+                            self.stdout.write(f"  {matricula}: {mudancas}")
+        except (OSError, UnicodeDecodeError, ValueError) as e:
+            raise CommandError(e)
+
+        resumo = (
+            f"{totais['linhas']} linhas: {totais['novos']} novas, "
+            f"{totais['alterados']} alteradas, {totais['iguais']} iguais, "
+            f"{totais['invalidas']} inválidas em {time.monotonic() - inicio:.1f}s"
+        )
+        if simular:
+            self.stdout.write(self.style.WARNING(f"Simulação, nada foi gravado. {resumo}."))
+        else:
+            self.stdout.write(self.style.SUCCESS(f"Importação concluída. {resumo}."))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from root.busca import SQL_PREPARAR_BUSCA
+
+
+class Command(BaseCommand):
+    help = (
+        "Cria no PostgreSQL as extensões pg_trgm e unaccent e os índices de "
+        "trigramas usados pela busca de pessoas"
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            self.stdout.write("Banco não é PostgreSQL; a busca usa a consulta simples.")
+            return
+
+        with transaction.atomic(), connection.cursor() as cursor:
+            for sql in SQL_PREPARAR_BUSCA:
+                cursor.execute(sql)
+
+        self.stdout.write(self.style.SUCCESS("Busca de pessoas preparada."))
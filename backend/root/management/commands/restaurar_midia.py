@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from root.backup import restaurar_midia
+
+
+class Command(BaseCommand):
+    help = "Restaura a mídia a partir dos backups incrementais de dbbackup_q2"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--destino',
+            default=settings.MEDIA_ROOT,
+            help="Pasta onde extrair os arquivos (padrão: MEDIA_ROOT)",
+        )
+        parser.add_argument(
+            '--removidos',
+            action='store_true',
+            help="Restaura também os arquivos removidos ainda guardados nos backups",
+        )
+
+    def handle(self, *args, **options):
+        total = restaurar_midia(options['destino'], removidos=options['removidos'])
+        self.stdout.write(self.style.SUCCESS(f"{total} arquivos restaurados em {options['destino']}."))
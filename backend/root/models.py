@@ -1,3 +1,4 @@
+from django.core.validators import MinValueValidator
 from django.db import models
 
 # Create your models here.
@@ -50,6 +51,9 @@ class Sala(models.Model):
     codigo = models.CharField(max_length=5, null=True)
     imagem = models.ImageField("Imagem", null=True, blank=True)
     e_informatica = models.BooleanField("É de Informática?", default=False)
+    horas_saida_automatica = models.PositiveSmallIntegerField(
+        "Saída automática após (horas)", default=4, validators=[MinValueValidator(1)]
+    )
 
     def __str__(self):
         return "[" + self.numero + "]" + " " + self.nome
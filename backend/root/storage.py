@@ -0,0 +1,150 @@
+from django.apps import apps
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import models
+from django.db.models.fields.files import FieldFile
+from django.utils.deconstruct import deconstructible
+import hashlib
+import os
+import re
+import tempfile
+
+# Pasta, dentro do MEDIA_ROOT, dos arquivos guardados pelo hash do conteúdo
+PASTA_CONTEUDO = 'cas'
+
+# Campos (modelo, campo) que usam o armazenamento por conteúdo; cada arquivo
+# pode ser compartilhado por vários registros desses campos
+CAMPOS_CONTEUDO = (
+    ('controle.Equipamento', 'manual'),
+    ('controle.Componente', 'datasheet'),
+    ('controle.Orcamento', 'anexo'),
+)
+
+
+def hash_conteudo(arquivo):
+    """ SHA-256 do conteúdo de `arquivo`, lido em blocos """
+    sha = hashlib.sha256()
+    arquivo.seek(0)
+    for bloco in arquivo.chunks():
+        sha.update(bloco)
+    arquivo.seek(0)
+    return sha.hexdigest()
+
+
+def referencias_arquivos():
+    """ Conjunto dos nomes de arquivo usados por algum registro """
+    nomes = set()
+    for modelo, campo in CAMPOS_CONTEUDO:
+        nomes.update(
+            apps.get_model(modelo)._default_manager
+            .exclude(**{campo: ''}).exclude(**{f'{campo}__isnull': True})
+            .values_list(campo, flat=True)
+        )
+    return nomes
+
+
+@deconstructible
+class ConteudoEnderecadoStorage(FileSystemStorage):
+    """
+    Guarda cada arquivo como cas/<hh>/<sha256><extensão>: o mesmo conteúdo
+    enviado várias vezes ocupa um único arquivo em disco.
+    """
+
+    def caminho_conteudo(self, name, content):
+        extensao = os.path.splitext(name)[1].lower()
+        if not re.fullmatch(r'\.\w{1,9}', extensao):
+            extensao = ''
+        sha = hash_conteudo(content)
+        return f"{PASTA_CONTEUDO}/{sha[:2]}/{sha}{extensao}"
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        name = self.caminho_conteudo(name, content)
+        if self.exists(name):
+            return name
+        return super().save(name, content, max_length=max_length)
+
+    def get_available_name(self, name, max_length=None):
+        # O nome vem do hash: um arquivo com o mesmo nome tem o mesmo conteúdo
+        return name
+
+    def _save(self, name, content):
+        """
+        Grava num arquivo temporário da mesma pasta e o liga ao caminho do
+        hash. Se outro envio do mesmo conteúdo chegou antes, o arquivo que já
+        está lá é mantido; o nome nunca é alterado.
+        """
+        caminho = self.path(name)
+        pasta = os.path.dirname(caminho)
+        os.makedirs(pasta, self.directory_permissions_mode or 0o777, exist_ok=True)
+
+        descritor, temporario = tempfile.mkstemp(dir=pasta, prefix='.envio-')
+        try:
+            with os.fdopen(descritor, 'wb') as arquivo:
+                for bloco in content.chunks():
+                    arquivo.write(bloco)
+            os.chmod(temporario, self.file_permissions_mode or 0o644)
+            os.link(temporario, caminho)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporario)
+        return name
+
+    def referencias(self, name, ignorar=None):
+        """ Quantos registros usam o arquivo `name`, sem contar `ignorar` """
+        total = 0
+        for modelo, campo in CAMPOS_CONTEUDO:
+            registros = apps.get_model(modelo)._default_manager.filter(**{campo: name})
+            if isinstance(ignorar, registros.model):
+                registros = registros.exclude(pk=ignorar.pk)
+            total += registros.count()
+        return total
+
+    def delete(self, name, ignorar=None):
+        """
+        Só apaga o arquivo quando nenhum registro (além de `ignorar`) o usa
+        mais. Arquivos que ficam órfãos são removidos por
+        `manage.py deduplicar_arquivos --limpar`.
+        """
+        if name and not self.referencias(name, ignorar):
+            super().delete(name)
+
+
+conteudo_storage = ConteudoEnderecadoStorage()
+
+
+class ArquivoConteudo(FieldFile):
+
+    def delete(self, save=True):
+        """
+        Como FieldFile.delete, mas o próprio registro, que ainda aponta para
+        o arquivo no banco, não conta como referência.
+        """
+        if not self:
+            return
+        if hasattr(self, '_file'):
+            self.close()
+            del self.file
+
+        self.storage.delete(self.name, ignorar=self.instance)
+
+        self.name = None
+        setattr(self.instance, self.field.attname, self.name)
+        self._committed = False
+
+        if save:
+            self.instance.save()
+
+    delete.alters_data = True
+
+
+class ArquivoConteudoField(models.FileField):
+    """ FileField guardado pelo hash do conteúdo em `conteudo_storage` """
+    attr_class = ArquivoConteudo
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('storage', conteudo_storage)
+        super().__init__(*args, **kwargs)
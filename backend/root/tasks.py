@@ -1,5 +1,31 @@
-from django.core import management
+from dbbackup.utils import bytes_to_str
+from root.backup import backup_banco, backup_midia, verificar_backup_banco
+import logging
+
+logger = logging.getLogger(__name__)
+
 
 def dbbackup_q2():
-    management.call_command('dbbackup', '--clean')
-    management.call_command('mediabackup', '--clean')
+    """
+    Backup do banco (comprimido) e da mídia (incremental), conferindo se os
+    arquivos gerados podem ser lidos de volta.
+    """
+    banco = backup_banco()
+    verificar_backup_banco(banco['arquivo'], banco['bruto'])
+    logger.info(
+        "Backup do banco %s: %s -> %s em %.1fs",
+        banco['arquivo'], bytes_to_str(banco['bruto']),
+        bytes_to_str(banco['tamanho']), banco['segundos'],
+    )
+
+    midia = backup_midia()
+    logger.info(
+        "Backup da mídia %s: %d de %d arquivos alterados, %s em %.1fs",
+        midia['arquivo'] or '(sem alterações)', midia['alterados'],
+        midia['total'], bytes_to_str(midia['tamanho']), midia['segundos'],
+    )
+
+    return (
+        f"Banco: {bytes_to_str(banco['tamanho'])} em {banco['segundos']:.1f}s; "
+        f"mídia: {midia['alterados']} arquivos em {midia['segundos']:.1f}s."
+    )
@@ -1,3 +1,377 @@
-from django.test import TestCase
+from datetime import timedelta
+from dbbackup.storage import get_storage
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+from unittest import mock, skipUnless
+from controle.models import ControleAcesso, Emprestimo, Equipamento, PessoaResumo
+from root import backup
+from root.busca import BUSCA_LIMITE
+from root.importacao import importar_pessoas
+from root.models import Pessoa
+from root.storage import PASTA_CONTEUDO, conteudo_storage
+import hashlib
+import io
+import openpyxl
+import os
+import random
+import tempfile
+import threading
+import time
 
-# Create your tests here.
+CACHE_LOCAL = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+DIA = 24 * 60 * 60
+
+
+class BackupMidiaTests(SimpleTestCase):
+
+    def setUp(self):
+        self.midia = tempfile.TemporaryDirectory()
+        self.backups = tempfile.TemporaryDirectory()
+        self.addCleanup(self.midia.cleanup)
+        self.addCleanup(self.backups.cleanup)
+
+        self.storage = get_storage()
+        self.storage.storage = FileSystemStorage(location=self.backups.name)
+        self.agora = 1_700_000_000
+        self.execucoes = 0
+
+        for alvo, substituto in (
+            ('get_storage', lambda: self.storage),
+            ('time.time', lambda: self.agora),
+            ('dbbackup_utils.filename_generate', self.nome_tar),
+        ):
+            patcher = mock.patch(f'root.backup.{alvo}', substituto)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        configuracao = override_settings(
+            MEDIA_ROOT=self.midia.name, DBBACKUP_MIDIA_RETENCAO_DIAS=7
+        )
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+
+    def nome_tar(self, extensao, content_type):
+        # Um nome por execução, no formato que o dbbackup reconhece
+        self.execucoes += 1
+        return f'servidor-2024-01-{self.execucoes:02d}-000000.{extensao}'
+
+    def escrever(self, nome, conteudo):
+        caminho = os.path.join(self.midia.name, nome)
+        with open(caminho, 'w') as arquivo:
+            arquivo.write(conteudo)
+        os.utime(caminho, ns=(self.agora * 10**9, self.agora * 10**9))
+
+    def tars(self):
+        return set(self.storage.list_backups(content_type='media'))
+
+    def restaurar(self, **kwargs):
+        with tempfile.TemporaryDirectory() as destino:
+            backup.restaurar_midia(destino, **kwargs)
+            return {
+                nome: open(os.path.join(destino, nome)).read()
+                for nome in os.listdir(destino)
+            }
+
+    def test_versoes_antigas_e_backups_legados_ficam_pelo_prazo(self):
+        legado = 'servidor-2023-12-31-000000.tar'
+        self.storage.storage.save(legado, open(os.devnull, 'rb'))
+        self.escrever('a.txt', 'a1')
+        self.escrever('b.txt', 'b1')
+
+        primeiro = backup.backup_midia()['arquivo']
+        self.assertEqual(self.tars(), {legado, primeiro})
+
+        self.agora += DIA
+        self.escrever('a.txt', 'a2')
+        os.remove(os.path.join(self.midia.name, 'b.txt'))
+        segundo = backup.backup_midia()['arquivo']
+
+        # O primeiro tar ainda guarda a.txt antigo e b.txt removido
+        self.assertEqual(self.tars(), {legado, primeiro, segundo})
+        self.assertEqual(self.restaurar(), {'a.txt': 'a2'})
+        self.assertEqual(self.restaurar(removidos=True), {'a.txt': 'a2', 'b.txt': 'b1'})
+
+        # Sete dias depois do primeiro backup, o legado ainda está no prazo
+        self.agora += 6 * DIA
+        backup.backup_midia()
+        self.assertEqual(self.tars(), {legado, primeiro, segundo})
+
+        self.agora += 2 * DIA
+        backup.backup_midia()
+        self.assertEqual(self.tars(), {segundo})
+        self.assertEqual(self.restaurar(removidos=True), {'a.txt': 'a2'})
+
+    def test_demapas_ficam_fora_do_backup(self):
+        os.makedirs(os.path.join(self.midia.name, 'demapa'))
+        self.escrever('demapa/abc.pdf', 'pdf')
+        self.escrever('a.txt', 'a1')
+
+        self.assertEqual(backup.backup_midia()['total'], 1)
+        self.assertEqual(self.restaurar(), {'a.txt': 'a1'})
+
+
+class ConteudoEnderecadoTests(TestCase):
+
+    def setUp(self):
+        midia = tempfile.TemporaryDirectory()
+        self.addCleanup(midia.cleanup)
+        configuracao = override_settings(MEDIA_ROOT=midia.name)
+        configuracao.enable()
+        self.addCleanup(configuracao.disable)
+
+        sha = hashlib.sha256(b'manual').hexdigest()
+        self.nome = f'{PASTA_CONTEUDO}/{sha[:2]}/{sha}.pdf'
+        self.pasta = os.path.join(midia.name, PASTA_CONTEUDO, sha[:2])
+
+    def equipamento(self, patrimonio):
+        equipamento = Equipamento(nome='Multímetro', patrimonio=patrimonio)
+        equipamento.manual.save('Manual.PDF', ContentFile(b'manual'))
+        return equipamento
+
+    def test_mesmo_conteudo_um_arquivo(self):
+        primeiro, segundo = self.equipamento('P1'), self.equipamento('P2')
+        self.assertEqual((primeiro.manual.name, segundo.manual.name), (self.nome, self.nome))
+        self.assertEqual(os.listdir(self.pasta), [os.path.basename(self.nome)])
+        self.assertEqual(Equipamento.objects.get(patrimonio='P2').manual.read(), b'manual')
+
+    def test_envios_simultaneos_nao_renomeiam(self):
+        # Os dois envios passam pelo exists() antes de qualquer um gravar
+        barreira = threading.Barrier(2)
+        nomes = []
+
+        def exists(name):
+            barreira.wait()
+            return False
+
+        def enviar():
+            nomes.append(conteudo_storage.save('manual.pdf', ContentFile(b'manual')))
+
+        with mock.patch.object(conteudo_storage, 'exists', exists):
+            envios = [threading.Thread(target=enviar) for _ in range(2)]
+            for envio in envios:
+                envio.start()
+            for envio in envios:
+                envio.join()
+
+        # Um terceiro envio que também não viu o arquivo já gravado
+        with mock.patch.object(conteudo_storage, 'exists', return_value=False):
+            nomes.append(conteudo_storage.save('manual.pdf', ContentFile(b'manual')))
+
+        self.assertEqual(nomes, [self.nome] * 3)
+        self.assertEqual(os.listdir(self.pasta), [os.path.basename(self.nome)])
+        with conteudo_storage.open(self.nome) as arquivo:
+            self.assertEqual(arquivo.read(), b'manual')
+
+    def test_arquivo_so_sai_com_a_ultima_referencia(self):
+        primeiro, segundo = self.equipamento('P1'), self.equipamento('P2')
+        caminho = conteudo_storage.path(self.nome)
+
+        primeiro.manual.delete()
+        self.assertTrue(os.path.exists(caminho))
+        self.assertFalse(Equipamento.objects.get(pk=primeiro.pk).manual)
+
+        segundo.manual.delete()
+        self.assertFalse(os.path.exists(caminho))
+        self.assertFalse(Equipamento.objects.get(pk=segundo.pk).manual)
+
+
+
+@override_settings(CACHES=CACHE_LOCAL)
+class BuscaPessoasTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('preparar_busca', stdout=open(os.devnull, 'w'))
+        cls.usuario = User.objects.create_user('funcionario')
+        cls.pessoas = {
+            nome: Pessoa.objects.create(nome=nome, matricula=matricula)
+            for nome, matricula in (
+                ('João Silva', '2020001'),
+                ('Joana Souza', '2020002'),
+                ('Ana Silveira', '2021003'),
+                ('Bruno Lima', '2021004'),
+            )
+        }
+        Emprestimo.objects.create(identificador='E1', responsavel=cls.pessoas['Joana Souza'])
+
+    def setUp(self):
+        self.client.force_login(self.usuario)
+
+    def nomes(self, url, **params):
+        resposta = self.client.get(url, params)
+        self.assertEqual(resposta.status_code, 200)
+        return [pessoa['nome'] for pessoa in resposta.json()]
+
+    def test_nome_ordena_por_emprestimo_e_acesso(self):
+        # Quem tem empréstimo ativo vem primeiro, como antes
+        self.assertEqual(
+            self.nomes('/api/root/pessoas/', nome='Jo'), ['Joana Souza', 'João Silva']
+        )
+        self.assertEqual(
+            self.nomes('/api/root/pessoas/', nome='Silv'), ['Ana Silveira', 'João Silva']
+        )
+        # Só o nome, ao contrário de /busca/
+        self.assertEqual(self.nomes('/api/root/pessoas/', nome='2021'), [])
+
+    def test_nome_ordena_antes_de_cortar(self):
+        Pessoa.objects.bulk_create(
+            Pessoa(nome=f'Aluno Silva {i:02d}', matricula=f'30{i:02d}') for i in range(BUSCA_LIMITE)
+        )
+        ultimo = Pessoa.objects.create(nome='Zélia Silva', matricula='3100')
+        ControleAcesso.objects.create(pessoa=ultimo)
+
+        nomes = self.nomes('/api/root/pessoas/', nome='Silva')
+        self.assertEqual(len(nomes), BUSCA_LIMITE)
+        # Fora das 20 primeiras por nome, mas com acesso registrado
+        self.assertEqual(nomes[:2], ['Zélia Silva', 'Aluno Silva 00'])
+        self.assertNotIn('João Silva', nomes)
+
+    def test_busca_por_nome_e_matricula(self):
+        self.assertEqual(
+            self.nomes('/api/root/pessoas/busca/', q='silv'), ['Ana Silveira', 'João Silva']
+        )
+        self.assertEqual(
+            self.nomes('/api/root/pessoas/busca/', q='2021'), ['Ana Silveira', 'Bruno Lima']
+        )
+
+    def test_busca_com_termo_curto_nao_busca(self):
+        self.assertEqual(self.nomes('/api/root/pessoas/busca/', q='Jo'), [])
+
+    @skipUnless(connection.vendor == 'postgresql', "Busca por trigramas só no PostgreSQL")
+    def test_busca_ignora_acentos_e_erros_de_digitacao(self):
+        self.assertEqual(self.nomes('/api/root/pessoas/busca/', q='joao')[0], 'João Silva')
+        self.assertIn('Bruno Lima', self.nomes('/api/root/pessoas/busca/', q='Bruno Lma'))
+        self.assertEqual(self.nomes('/api/root/pessoas/busca/', q='2021004')[0], 'Bruno Lima')
+
+
+@skipUnless(os.environ.get('BENCHMARK'), "Defina BENCHMARK=1 para medir")
+@override_settings(CACHES=CACHE_LOCAL)
+class BuscaPessoasBenchmarkTests(TestCase):
+    """ p95 da busca de pessoas com 50 mil alunos """
+
+    ALUNOS = 50_000
+    # Alvo no PostgreSQL, com os índices de `preparar_busca`
+    P95_ALVO_MS = 50
+
+    PRENOMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Érica', 'Fábio', 'Gabriela', 'Hugo',
+                'Iara', 'João', 'Larissa', 'Márcio', 'Natália', 'Otávio', 'Paula', 'Rafael']
+    SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Pereira', 'Lima', 'Gonçalves', 'Araújo',
+                  'Ribeiro', 'Carvalho', 'Mendonça', 'Barbosa', 'Conceição', 'Estêvão']
+    TERMOS = ['silva', 'Gonçalves', 'goncalves', 'Ana Lima', 'Mendonca', 'Conceicao Ara',
+              'Fabio', 'Larisa Souza', '2021', '20250', 'Natália Ribeiro', 'otavio barb']
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('preparar_busca', stdout=open(os.devnull, 'w'))
+        cls.usuario = User.objects.create_user('funcionario')
+        aleatorio = random.Random(0)
+        pessoas = Pessoa.objects.bulk_create(
+            Pessoa(
+                nome=' '.join([aleatorio.choice(cls.PRENOMES)] + aleatorio.sample(cls.SOBRENOMES, 2)),
+                matricula=str(2015_00000 + i),
+            )
+            for i in range(cls.ALUNOS)
+        )
+        PessoaResumo.objects.bulk_create(
+            PessoaResumo(
+                pessoa=pessoa, ultimo_acesso=now() - timedelta(days=aleatorio.randrange(365)),
+                emprestimo_ativo=aleatorio.random() < 0.05,
+            )
+            for pessoa in aleatorio.sample(pessoas, cls.ALUNOS // 5)
+        )
+
+    def setUp(self):
+        self.client.force_login(self.usuario)
+
+    def medir(self, url, parametro):
+        tempos = []
+        for _ in range(5):
+            for termo in self.TERMOS:
+                inicio = time.perf_counter()
+                resposta = self.client.get(url, {parametro: termo})
+                tempos.append((time.perf_counter() - inicio) * 1000)
+                self.assertEqual(resposta.status_code, 200)
+        tempos.sort()
+        return tempos[len(tempos) // 2], tempos[int(len(tempos) * 0.95)]
+
+    def test_p95(self):
+        for url, parametro in (('/api/root/pessoas/busca/', 'q'), ('/api/root/pessoas/', 'nome')):
+            p50, p95 = self.medir(url, parametro)
+            print(f"\n{url}?{parametro}= com {self.ALUNOS} alunos: "
+                  f"p50 {p50:.1f} ms, p95 {p95:.1f} ms")
+            if connection.vendor == 'postgresql':
+                self.assertLess(p95, self.P95_ALVO_MS)
+
+
+class ImportacaoPessoasTests(TestCase):
+
+    def importar(self, csv, **kwargs):
+        return list(importar_pessoas(io.BytesIO(csv.encode()), 'pessoas.csv', **kwargs))
+
+    def test_insere_e_atualiza(self):
+        Pessoa.objects.create(nome='Ana', matricula='1', email='ana@ufsm.br')
+        lotes = self.importar(
+            "Matrícula;Nome;E-mail;Tipo\n"
+            "1;Ana Lima;ana@ufsm.br;Bolsista\n"
+            "2;Bruno;bruno@ufsm.br;aluno\n"
+            ";Sem matrícula;;\n"
+        )
+        self.assertEqual(
+            [(lote['novos'], lote['alterados'], lote['invalidas']) for lote in lotes],
+            [(1, 1, [4])],
+        )
+        ana = Pessoa.objects.get(matricula='1')
+        self.assertEqual((ana.nome, ana.tipo), ('Ana Lima', Pessoa.Tipo.BOLSISTA))
+        self.assertEqual(Pessoa.objects.get(matricula='2').email, 'bruno@ufsm.br')
+
+    def test_celulas_vazias_ou_invalidas_preservam_o_valor(self):
+        Pessoa.objects.create(
+            nome='Ana', matricula='1', email='ana@ufsm.br', telefone='55999990000',
+            tipo=Pessoa.Tipo.PROFESSOR,
+        )
+        Pessoa.objects.create(nome='Bruno', matricula='2', email='bruno@ufsm.br')
+        lotes = self.importar(
+            "matricula,nome,email,telefone,tipo\n"
+            "1,Ana,,---,\n"
+            "2,Bruno Lima,invalido,(55) 3220-0000,xx\n"
+            "3,Carla,,,\n"
+        )
+        self.assertEqual((lotes[0]['novos'], lotes[0]['alterados'], lotes[0]['iguais']), (1, 1, 1))
+
+        ana = Pessoa.objects.get(matricula='1')
+        self.assertEqual(
+            (ana.email, ana.telefone, ana.tipo),
+            ('ana@ufsm.br', '55999990000', Pessoa.Tipo.PROFESSOR),
+        )
+        bruno = Pessoa.objects.get(matricula='2')
+        self.assertEqual(
+            (bruno.nome, bruno.email, bruno.telefone), ('Bruno Lima', 'bruno@ufsm.br', '5532200000')
+        )
+        carla = Pessoa.objects.get(matricula='3')
+        self.assertEqual((carla.email, carla.tipo), (None, Pessoa.Tipo.ALUNO))
+
+    def test_planilha_xlsx(self):
+        planilha = openpyxl.Workbook()
+        for linha in (['Matrícula', 'Nome', 'Tipo'], ['1', 'Ana', 'Bolsista'], [2, 'Bruno', '']):
+            planilha.active.append(linha)
+        arquivo = io.BytesIO()
+        planilha.save(arquivo)
+        arquivo.seek(0)
+
+        lotes = list(importar_pessoas(arquivo, 'pessoas.xlsx'))
+        self.assertEqual(lotes[0]['novos'], 2)
+        self.assertEqual(
+            list(Pessoa.objects.order_by('matricula').values_list('matricula', 'nome', 'tipo')),
+            [('1', 'Ana', Pessoa.Tipo.BOLSISTA), ('2', 'Bruno', Pessoa.Tipo.ALUNO)],
+        )
+
+    def test_simulacao_nao_grava(self):
+        lotes = self.importar("matricula,nome\n1,Ana\n", simular=True)
+        self.assertEqual(lotes[0]['novos'], 1)
+        self.assertFalse(Pessoa.objects.exists())
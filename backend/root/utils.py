@@ -0,0 +1,71 @@
+from datetime import date, datetime, time, timedelta
+from time import monotonic
+from django.utils.timezone import make_aware
+
+
+def _as_date(value):
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(value)
+
+
+def intervalo_dias(inicio, fim=None):
+    """
+    Converte datas locais (date ou "AAAA-MM-DD") no intervalo [inicio, fim)
+    de datetimes com fuso horário, incluindo o dia `fim` inteiro.
+
+    Levanta ValueError se alguma das datas for inválida.
+    """
+    inicio = _as_date(inicio)
+    fim = inicio if fim is None else _as_date(fim)
+    return (
+        make_aware(datetime.combine(inicio, time.min)),
+        make_aware(datetime.combine(fim + timedelta(days=1), time.min)),
+    )
+
+
+def filtro_dias(campo, inicio, fim=None):
+    """
+    Filtro de um DateTimeField pelos dias locais de `inicio` até `fim`.
+
+    Ao contrário de `campo__date`, compara a coluna diretamente com um
+    intervalo semiaberto, o que permite ao banco usar índices sobre ela.
+    """
+    limite_inferior, limite_superior = intervalo_dias(inicio, fim)
+    return {
+        f'{campo}__gte': limite_inferior,
+        f'{campo}__lt': limite_superior,
+    }
+
+
+# Mapa número -> id das salas, em memória do processo. É recarregado quando um
+# número não é encontrado ou após SALAS_CACHE_TTL segundos; números que não
+# existiam na última carga são lembrados até lá, para não recarregar a cada
+# leitura com uma sala inválida.
+SALAS_CACHE_TTL = 600
+_salas_por_numero = {}
+_salas_desconhecidas = set()
+_salas_carregadas_em = None
+
+
+def sala_id_por_numero(numero):
+    """ Id da Sala com esse número, ou None se não houver """
+    global _salas_por_numero, _salas_desconhecidas, _salas_carregadas_em
+    from root.models import Sala
+
+    if numero is None:
+        return None
+    numero = str(numero)
+
+    expirado = (
+        _salas_carregadas_em is None
+        or monotonic() - _salas_carregadas_em > SALAS_CACHE_TTL
+    )
+    if expirado or (numero not in _salas_por_numero and numero not in _salas_desconhecidas):
+        _salas_por_numero = dict(Sala.objects.order_by().values_list('numero', 'id'))
+        _salas_desconhecidas = set()
+        _salas_carregadas_em = monotonic()
+
+    if numero not in _salas_por_numero:
+        _salas_desconhecidas.add(numero)
+    return _salas_por_numero.get(numero)